@@ -0,0 +1,190 @@
+"""
+Boot flask, fastapi and fastapi_sync one after another against a fresh
+database, run the same workload mix against each and write a comparison.
+With several --workers counts or --concurrency levels every app is run at
+each of them, and a scaling table shows req/s at each point relative to the
+first. Several --profiles run every app under each SQLite connection preset.
+
+    python benchmark.py --requests 500 --concurrency 16
+    python benchmark.py --workers 1,2,4,8 --concurrency 64
+    python benchmark.py --concurrency 1,4,16,64
+    python benchmark.py --profiles sqlite,durable,balanced,fast --reads 0
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from serve import warm_up, wait_ready
+from stress_test import GET, Job, LoadStats, post_jobs, run_load, summarize
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+HOST = "127.0.0.1"
+
+# Port and database file per app. Every run gets its own empty working
+# directory with the database in it, and is launched through serve.py.
+APPS = {
+    "flask": {"port": 5000, "database": "contacts.db"},
+    "fastapi": {"port": 8000, "database": "db.sqlite3"},
+    "fastapi_sync": {"port": 8001, "database": "contacts.db"},
+}
+
+SERVE = os.path.join(ROOT, "serve.py")
+
+WARMUP_REQUESTS = 50
+
+REPORT_FILE = "benchmark_report"
+
+
+def start_app(name, workdir, extra_args=(), env=None, workers=1):
+    """Launch `name` through serve.py, with `extra_args` appended to its command line."""
+    config = APPS[name]
+    env = dict(os.environ, **(env or {}))
+    env.pop("DATABASE_URL", None)
+    command = [sys.executable, SERVE, name, "--host", HOST, "--port", str(config["port"]),
+               "--database", os.path.join(workdir, config["database"]), "--workers", str(workers),
+               "--warmup", "0", *extra_args]
+    log = open(os.path.join(workdir, "server.log"), "w")
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://{HOST}:{config['port']}"
+
+    if not wait_ready(base_url, process):
+        stop_app(process)
+        raise RuntimeError(f"{name} did not start, see {log.name}")
+    warm_up(base_url, WARMUP_REQUESTS)
+    return process, base_url
+
+
+def stop_app(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def run_workload(base_url, num_requests, num_reads, concurrency, rate=None):
+    """First-time inserts, repeat-owner pass, then list and by-id reads."""
+    stats = LoadStats()
+    for jobs in post_jobs(base_url + "/contacts", num_requests):
+        run_load(jobs, concurrency, rate, stats)
+    run_load([Job("GET /contacts", GET, base_url + "/contacts", None)] * num_reads, concurrency, rate, stats)
+    by_id = [Job("GET /contacts/{id}", GET, f"{base_url}/contacts/{i % num_requests + 1}", None)
+             for i in range(num_reads)]
+    run_load(by_id, concurrency, rate, stats)
+    return summarize(stats)
+
+
+def benchmark_app(name, args, workers=1, env=None, profile=None, concurrency=16):
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-{workers}w-")
+    extra_args = ["--sqlite-profile", profile] if profile else []
+    process, base_url = start_app(name, workdir, extra_args, env=env, workers=workers)
+    try:
+        return run_workload(base_url, args.requests, args.reads, concurrency, args.rate)
+    finally:
+        stop_app(process)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def format_comparison(results):
+    """One block per endpoint with a row per app, so frameworks line up."""
+    endpoints = []
+    for summary in results.values():
+        endpoints.extend(e for e in summary if e not in endpoints)
+
+    lines = []
+    for endpoint in endpoints:
+        lines.append(endpoint)
+        lines.append(f"  {'app':<28}{'reqs':>8}{'req/s':>10}{'err%':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for app, summary in results.items():
+            row = summary.get(endpoint)
+            if row is None:
+                continue
+            lines.append(
+                f"  {app:<28}{row['requests']:>8}{row['throughput']:>10.1f}{row['error_rate'] * 100:>8.2f}"
+                f"{row['p50']:>10.2f}{row['p90']:>10.2f}{row['p99']:>10.2f}{row['max']:>10.2f}"
+            )
+        lines.append("")
+    return "\n".join(lines)
+
+
+def format_scaling(results):
+    """req/s per endpoint at each sweep point ("4w", "c16"), and the speedup over the first."""
+    lines = []
+    for name, runs in results.items():
+        counts = list(runs)
+        lines.append(name)
+        lines.append(f"  {'endpoint':<32}" + "".join(f"{f'{n} req/s':>14}" for n in counts)
+                     + "".join(f"{f'{n} x':>10}" for n in counts[1:]))
+        for endpoint, row in runs[counts[0]].items():
+            throughput = [runs[n].get(endpoint, {}).get("throughput", 0.0) for n in counts]
+            lines.append(f"  {endpoint:<32}" + "".join(f"{value:>14.1f}" for value in throughput)
+                         + "".join(f"{value / throughput[0] if throughput[0] else 0.0:>10.2f}"
+                                   for value in throughput[1:]))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def sweep_points(worker_counts, levels):
+    """(workers, concurrency, label) for every combination; the label names only what varies."""
+    points = []
+    for workers in worker_counts:
+        for concurrency in levels:
+            parts = [f"{workers}w"] if len(worker_counts) > 1 else []
+            if len(levels) > 1:
+                parts.append(f"c{concurrency}")
+            points.append((workers, concurrency, " ".join(parts)))
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare flask, fastapi and fastapi_sync.")
+    parser.add_argument("--apps", default=",".join(APPS), help="comma separated subset of " + ", ".join(APPS))
+    parser.add_argument("--requests", type=int, default=200, help="contacts inserted per app")
+    parser.add_argument("--reads", type=int, default=200, help="GET requests per read endpoint")
+    parser.add_argument("--concurrency", default="16", help="comma separated client concurrency levels, e.g. 1,4,16,64")
+    parser.add_argument("--rate", type=float, default=None, help="open-loop rate in requests/second")
+    parser.add_argument("--workers", default="1", help="comma separated worker process counts, e.g. 1,2,4,8")
+    parser.add_argument("--profiles", default=None,
+                        help="comma separated SQLite presets to compare, e.g. sqlite,durable,balanced,fast")
+    parser.add_argument("--output", default=REPORT_FILE, help="report path without extension")
+    parser.add_argument("--keep", action="store_true", help="keep the per-app databases and server logs")
+    args = parser.parse_args()
+
+    worker_counts = [int(n) for n in args.workers.split(",")]
+    points = sweep_points(worker_counts, [int(n) for n in args.concurrency.split(",")])
+    # serve.py turns the per-process caches off for several workers; keep
+    # every point of a sweep on the same settings
+    env = {"IDENTITY_CACHE_SIZE": "0", "RESPONSE_CACHE_BYTES": "0"} if max(worker_counts) > 1 else None
+    profiles = args.profiles.split(",") if args.profiles else [None]
+    scaling = {}
+    for name in args.apps.split(","):
+        for profile in profiles:
+            label = f"{name} {profile}" if profile and len(profiles) > 1 else name
+            scaling[label] = {}
+            for workers, concurrency, point in points:
+                print(f"benchmarking {name} with {workers} worker(s) at concurrency {concurrency}"
+                      + (f", {profile} profile" if profile else "") + " ...")
+                scaling[label][point] = benchmark_app(name, args, workers, env, profile, concurrency)
+
+    if len(points) == 1:
+        results = {label: runs[points[0][2]] for label, runs in scaling.items()}
+        table = format_comparison(results)
+    else:
+        results = {f"{label} {point}": summary for label, runs in scaling.items() for point, summary in runs.items()}
+        table = format_comparison(results) + "\n" + format_scaling(scaling)
+    print(table)
+    config = {key: getattr(args, key) for key in ("requests", "reads", "concurrency", "rate", "workers", "profiles")}
+    with open(args.output + ".json", "w") as f:
+        json.dump({"config": config, "apps": results}, f, indent=2)
+    with open(args.output + ".txt", "w") as f:
+        f.write(table)
+
+
+if __name__ == "__main__":
+    main()
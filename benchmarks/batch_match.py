@@ -0,0 +1,120 @@
+"""
+Check that the vectorized batch matcher (common/batch_match.py) classifies
+exactly as POST /contacts does, then measure how many contacts per second it
+classifies against large opt-in tables.
+
+The check seeds an app database from small pools, as match_resolution does,
+so probes hit every branch, loads the snapshot through the app's engine and
+compares every probe with the app's match statement and with
+match_identities(). The throughput run classifies --probes generated
+contacts against --rows opt-in rows per table, vectorized and per row, up to
+the outcome of each.
+
+    python -m benchmarks.batch_match --rows 1000000 --probes 1000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+from benchmarks.match_resolution import OWNERS, seed, sql_path
+from common.apps import load_app
+from common.batch_match import OUTCOMES, MatchSnapshot, numpy, outcome, outcomes, snapshot_statements
+from common.matching import match_statement
+
+
+def columns(probes):
+    return ([probe["email"] for probe in probes], [probe["phonenumber"] for probe in probes],
+            [probe["matm_owner"] for probe in probes], [probe["username"] for probe in probes])
+
+
+def check(args, rng):
+    """Mismatches between the batch matcher and the app's per-row matching."""
+    pool = {
+        "email": [f"user{i}@test.com" for i in range(args.check_pool)],
+        "phonenumber": [1_000_000_000 + i for i in range(args.check_pool)],
+        "username": [f"user{i}" for i in range(8)],
+    }
+    path = os.path.join(tempfile.mkdtemp(prefix="batch-match-"), "contacts.db")
+    module = load_app("flask", database=path)
+    session = module.Session()
+    seed(module, session, args.check_rows, rng, pool)
+    with module.engine.connect() as conn:
+        email_rows, phone_rows = (conn.execute(statement).all()
+                                  for statement in snapshot_statements(module.ContactPointEmail,
+                                                                       module.ContactPointPhone))
+
+    probes = [{"email": rng.choice(pool["email"]), "phonenumber": rng.choice(pool["phonenumber"]),
+               "matm_owner": rng.choice(OWNERS), "username": rng.choice(pool["username"])}
+              for _ in range(args.check_rows)]
+    # unknown values, never in the snapshot
+    probes += [{"email": "nobody@test.com", "phonenumber": 1, "matm_owner": "TD99", "username": "nobody"}]
+    vectorized = MatchSnapshot(email_rows, phone_rows).classify(*columns(probes))
+    per_row = MatchSnapshot(email_rows, phone_rows, vectorized=False).classify(*columns(probes))
+    statement = match_statement(module.Contact)
+    mismatches = []
+    for probe, batch, python, kind in zip(probes, vectorized, per_row, outcomes(vectorized)):
+        sql, _ = sql_path(statement, session, probe)
+        if not batch == python == sql or kind != outcome(python):
+            mismatches.append((probe, batch, python, sql))
+    session.close()
+    module.engine.dispose()
+    os.remove(path)
+    return probes, per_row, mismatches
+
+
+def generate(count, rng, keys, usernames):
+    emails = [(f"user{rng.randrange(keys)}@test.com", rng.choice(OWNERS), f"user{rng.randrange(usernames)}",
+               f"{i:08x}") for i in range(count)]
+    phones = [(1_000_000_000 + rng.randrange(keys), owner, username, contact_id)
+              for _, owner, username, contact_id in emails]
+    return emails, phones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=1_000_000, help="rows per opt-in table for the throughput run")
+    parser.add_argument("--probes", type=int, default=1_000_000, help="contacts classified in the throughput run")
+    parser.add_argument("--batch", type=int, default=100_000, help="contacts per classify() call")
+    parser.add_argument("--check-rows", type=int, default=5000, help="opt-in rows and probes for the check")
+    parser.add_argument("--check-pool", type=int, default=2000, help="distinct emails/phones for the check")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if numpy is None:
+        print("numpy is not installed; both runs use the per-row matcher")
+
+    rng = random.Random(args.seed)
+    probes, matches, mismatches = check(args, rng)
+    kinds = Counter(map(outcome, matches))
+    print("outcomes:", ", ".join(f"{kind} {kinds[kind]}" for kind in OUTCOMES))
+    for probe, batch, python, sql in mismatches[:10]:
+        print("MISMATCH", probe, batch, python, sql)
+    print(f"{len(mismatches)} mismatches in {len(probes)} probes")
+
+    # about two rows per key, as a large import against a populated database would see
+    keys, usernames = max(args.rows // 2, 1), max(args.rows // 10, 1)
+    email_rows, phone_rows = generate(args.rows, rng, keys, usernames)
+    incoming, _ = generate(args.probes, rng, keys, usernames)
+    probes = [{"email": email, "phonenumber": 1_000_000_000 + rng.randrange(keys), "matm_owner": owner,
+               "username": username} for email, owner, username, _ in incoming]
+
+    # classify() and outcomes(): what a reconciliation needs per contact
+    print(f"{'matcher':<12}{'load s':>10}{'classify s':>12}{'contacts/s':>14}{'contacts/min':>15}")
+    for name, vectorized in (("vectorized", True), ("per row", False)):
+        if vectorized and numpy is None:
+            continue
+        start = time.perf_counter()
+        snapshot = MatchSnapshot(email_rows, phone_rows, vectorized=vectorized)
+        loaded = time.perf_counter()
+        for offset in range(0, len(probes), args.batch):
+            outcomes(snapshot.classify(*columns(probes[offset:offset + args.batch])))
+        elapsed = time.perf_counter() - loaded
+        rate = len(probes) / elapsed
+        print(f"{name:<12}{loaded - start:>10.2f}{elapsed:>12.2f}{rate:>14.0f}{rate * 60:>15.0f}")
+    raise SystemExit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
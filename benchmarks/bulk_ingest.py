@@ -0,0 +1,56 @@
+"""
+Ingest throughput in rows per second: one POST /contacts per row against
+POST /contacts/bulk batches. Runs the flask app in-process through its test
+client, on a fresh database per mode.
+
+    python -m benchmarks.bulk_ingest --rows 5000 --batch 1000
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from common.apps import load_app
+from stress_test import payload_dict, update_payload
+
+
+def single(client, rows, batch):
+    for row in rows:
+        # closing the response gives back its admission slot
+        with client.post("/contacts", json=row) as response:
+            assert response.status_code == 201, response.data
+
+
+def bulk(client, rows, batch):
+    for start in range(0, len(rows), batch):
+        with client.post("/contacts/bulk", json=rows[start:start + batch]) as response:
+            assert response.status_code == 201, response.data
+            assert response.get_json()["failed"] == 0, response.data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=1000, help="rows per bulk request")
+    args = parser.parse_args()
+
+    rows = [update_payload(payload_dict) for _ in range(args.rows)]
+    print(f"{'mode':<8}{'rows':>8}{'seconds':>10}{'rows/s':>10}")
+    for name, run in (("single", single), ("bulk", bulk)):
+        path = os.path.join(tempfile.mkdtemp(prefix="bulk-ingest-"), "contacts.db")
+        module = load_app("flask", database=path, module_name=f"flask_app_{name}")
+        client = module.app.test_client()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(client, rows, args.batch)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<8}{len(rows):>8}{elapsed:>10.2f}{len(rows) / elapsed:>10.0f}")
+        module.session.close()
+        module.engine.dispose()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
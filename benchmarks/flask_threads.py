@@ -0,0 +1,62 @@
+"""
+Flask throughput from 1 to N concurrent requests: the threaded server with a
+scoped session per request thread against the single-threaded server the
+module-global session used to require. Reads hit the database (the response
+cache is off); writes are first-time POST /contacts.
+
+    python -m benchmarks.flask_threads --threads 1,2,4,8,16 --requests 400
+"""
+import argparse
+import shutil
+import tempfile
+
+from benchmark import start_app, stop_app
+from benchmarks.post_scaling import seed
+from stress_test import GET, POST, Job, LoadStats, payload_dict, run_load, summarize, update_payload
+
+# serve.py options for one flask worker
+MODES = {
+    "single": ["--threads", "1"],
+    "threaded": ["--threads", "16"],
+}
+
+
+def workload(base_url, requests, seeded):
+    reads = [Job("GET /contacts/{id}", GET, f"{base_url}/contacts/{i % seeded + 1}", None)
+             for i in range(requests)]
+    writes = [Job("POST /contacts", POST, base_url + "/contacts", update_payload(payload_dict))
+              for _ in range(requests)]
+    return reads, writes
+
+
+def measure(mode, threads, args):
+    workdir = tempfile.mkdtemp(prefix=f"flask-threads-{mode}-")
+    process, base_url = start_app("flask", workdir, MODES[mode], env={"RESPONSE_CACHE_BYTES": "0"})
+    try:
+        seed(f"{workdir}/contacts.db", args.seed)
+        stats = LoadStats()
+        for jobs in workload(base_url, args.requests, args.seed):
+            run_load(jobs, threads, None, stats)
+        return summarize(stats)
+    finally:
+        stop_app(process)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", default="1,2,4,8,16", help="comma separated client concurrency levels")
+    parser.add_argument("--requests", type=int, default=400, help="requests per endpoint per run")
+    parser.add_argument("--seed", type=int, default=10_000, help="contacts in the database before the run")
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'threads':>8}{'endpoint':>22}{'req/s':>10}{'err%':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for threads in (int(n) for n in args.threads.split(",")):
+        for mode in MODES:
+            for endpoint, row in measure(mode, threads, args).items():
+                print(f"{mode:<10}{threads:>8}{endpoint:>22}{row['throughput']:>10.1f}"
+                      f"{row['error_rate'] * 100:>8.2f}{row['p50']:>10.2f}{row['p99']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
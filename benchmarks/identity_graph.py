@@ -0,0 +1,173 @@
+"""
+Individual resolution against N existing contacts: the persisted union-find
+in common/identity_graph.py against rescanning, i.e. following shared emails
+and phonenumbers through the opt-in tables until the set stops growing.
+
+Contacts are seeded as individuals of --set-size contacts under different
+owners, chained: neighbours share an email or a phonenumber, so a rescan
+needs a step per member while the graph walks one link to the root. Each
+probe POSTs a contact of a new owner that matches one end of a chain, then
+reads the individual back. Runs the flask app in-process through its test
+client.
+
+    python -m benchmarks.identity_graph --contacts 1000000 --set-size 8
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy.dialects import sqlite
+
+from common.apps import load_app
+from common.identity_graph import IndividualLinks, contact_walk_statement, members_statement
+
+SEED_CHUNK = 50_000
+
+RESCAN_SQL = """
+WITH RECURSIVE closure(contact_id, username, email, phonenumber) AS (
+    SELECT contact_id, username, email, phonenumber FROM contacts WHERE contact_id = ?
+    UNION
+    SELECT contacts.contact_id, contacts.username, contacts.email, contacts.phonenumber
+    FROM closure JOIN email_opt_in ON email_opt_in.email = closure.email AND email_opt_in.username = closure.username
+    JOIN contacts ON contacts.contact_id = email_opt_in.contact_id
+    UNION
+    SELECT contacts.contact_id, contacts.username, contacts.email, contacts.phonenumber
+    FROM closure JOIN mobile_opt_in ON mobile_opt_in.phonenumber = closure.phonenumber
+        AND mobile_opt_in.username = closure.username
+    JOIN contacts ON contacts.contact_id = mobile_opt_in.contact_id
+)
+SELECT contact_id FROM closure
+"""
+
+
+def member(index, set_size):
+    """(username, email, phonenumber, matm_owner, contact_id, root) of seeded contact `index`."""
+    group, position = divmod(index, set_size)
+    # 0-1 share an email, 1-2 a phonenumber, 2-3 an email, ...
+    return (f"user{group}", f"user{group}.{position // 2}@seed.com",
+            1_000_000_000 + group * set_size + (position + 1) // 2,
+            f"TD{position:02d}", f"{index:08x}", f"{group * set_size:08x}")
+
+
+def seed(path, rows, set_size):
+    """Fill contacts, both opt-in tables and individual_links with `rows` chained contacts."""
+    conn = sqlite3.connect(path)
+    for start in range(0, rows, SEED_CHUNK):
+        members = [member(i, set_size) for i in range(start, min(start + SEED_CHUNK, rows))]
+        conn.executemany(
+            "INSERT INTO contacts (username, email, phonenumber, email_opt_in_status, sms_opt_in_status, "
+            "matm_owner, contact_id, individual_id) VALUES (?, ?, ?, 1, 1, ?, ?, ?)", members)
+        conn.executemany(
+            "INSERT INTO email_opt_in (username, email, matm_owner, contact_id) VALUES (?, ?, ?, ?)",
+            ((username, email, owner, contact_id) for username, email, _, owner, contact_id, _ in members))
+        conn.executemany(
+            "INSERT INTO mobile_opt_in (username, phonenumber, matm_owner, contact_id) VALUES (?, ?, ?, ?)",
+            ((username, phone, owner, contact_id) for username, _, phone, owner, contact_id, _ in members))
+        conn.executemany(
+            "INSERT INTO individual_links (individual_id, parent, size) VALUES (?, ?, ?)",
+            ((root, root, set_size) for *_, contact_id, root in members if contact_id == root))
+        conn.commit()
+    conn.close()
+
+
+def time_joins(count):
+    """Microseconds per in-memory union of two random sets among `count` singletons."""
+    links = IndividualLinks((f"{i:08x}", f"{i:08x}", 1) for i in range(count))
+    pairs = [(f"{random.randrange(count):08x}", f"{random.randrange(count):08x}") for _ in range(count)]
+    start = time.perf_counter()
+    for pair in pairs:
+        links.join(pair)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def raw_sql(statement):
+    """(SQL, parameters) of a Core statement, so both sides run on the same sqlite3 connection."""
+    compiled = statement.compile(dialect=sqlite.dialect(), compile_kwargs={"render_postcompile": True})
+    return str(compiled), [compiled.params[name] for name in compiled.positiontup]
+
+
+def mean_ms(samples):
+    return sum(samples) / len(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--contacts", type=int, default=1_000_000, help="existing contacts")
+    parser.add_argument("--set-size", type=int, default=8, help="contacts per seeded individual")
+    parser.add_argument("--probes", type=int, default=50, help="POSTs and lookups timed")
+    args = parser.parse_args()
+
+    # every GET has to hit the database
+    os.environ["RESPONSE_CACHE_BYTES"] = "0"
+    path = os.path.join(tempfile.mkdtemp(prefix="identity-graph-"), "contacts.db")
+    module = load_app("flask", database=path)
+    start = time.perf_counter()
+    seed(path, args.contacts, args.set_size)
+    print(f"seeded {args.contacts} contacts in {args.contacts // args.set_size} individuals "
+          f"in {time.perf_counter() - start:.1f}s")
+    print(f"in-memory union: {time_joins(args.contacts):.2f} us/join over {args.contacts} singletons")
+
+    client = module.app.test_client()
+    conn = sqlite3.connect(path)
+    groups = random.sample(range(args.contacts // args.set_size), args.probes)
+    timings = {name: [] for name in ("post", "walk", "rescan", "get", "members", "rescan members")}
+    for group in groups:
+        username, email, _, _, contact_id, root = member(group * args.set_size, args.set_size)
+        payload = {"username": username, "email": email, "phonenumber": 9_000_000_000 + group,
+                   "email_opt_in_status": True, "sms_opt_in_status": True,
+                   "country": "US", "state": "CA", "matm_owner": "TDNEW"}
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            # closing the response gives back its admission slot
+            with client.post("/contacts", json=payload) as response:
+                timings["post"].append(time.perf_counter() - start)
+                assert response.status_code == 201, response.data
+        created, individual_id = conn.execute(
+            "SELECT contact_id, individual_id FROM contacts ORDER BY id DESC LIMIT 1").fetchone()
+        assert individual_id == root
+
+        walk = raw_sql(contact_walk_statement(module.Contact, module.IndividualLink, [contact_id]))
+        start = time.perf_counter()
+        conn.execute(*walk).fetchall()
+        timings["walk"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        conn.execute(RESCAN_SQL, (created,)).fetchall()
+        timings["rescan"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with client.get(f"/individual/{root}/contacts") as response:
+            timings["get"].append(time.perf_counter() - start)
+            assert len(response.json["contacts"]) == args.set_size + 1
+
+        members = raw_sql(members_statement(module.Contact, module.IndividualLink, root))
+        start = time.perf_counter()
+        conn.execute(*members).fetchall()
+        timings["members"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        rescanned = conn.execute(f"SELECT * FROM contacts WHERE contact_id IN ({RESCAN_SQL}) ORDER BY id",
+                                 (created,)).fetchall()
+        timings["rescan members"].append(time.perf_counter() - start)
+        assert len(rescanned) == args.set_size + 1
+
+    print(f"{'operation':<42}{'mean ms':>10}")
+    for name, label in (("post", "POST /contacts joining an individual"),
+                        ("walk", "  walk to the root (SQL)"),
+                        ("rescan", "  rescan closure instead (SQL)"),
+                        ("get", "GET /individual/{id}/contacts"),
+                        ("members", "  walk down from the root (SQL)"),
+                        ("rescan members", "  rescan closure instead (SQL)")):
+        print(f"{label:<42}{mean_ms(timings[name]):>10.3f}")
+    conn.close()
+    module.engine.dispose()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Check that MATCH_RESOLUTION=sql gives the same outcome as the Python
+matching on randomized data, and count the database round trips each takes.
+
+Opt-in rows are drawn from a bounded pool of emails, phones, owners and
+usernames so probes hit every branch: same contact, owner conflict, same
+individual, conflicts after earlier matches, and no match.
+
+    python -m benchmarks.match_resolution --rows 5000 --probes 5000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import event, select
+
+from common.apps import load_app
+from common.matching import match_from_row, match_identities, match_statement
+
+OWNERS = ["TD00", "TD01", "TD02"]
+
+
+def seed(module, session, rows, rng, pool):
+    contact_ids = [f"{i:08x}" for i in range(rows // 2)]
+    for contact_id in contact_ids:
+        # a few opt-in rows point at contacts that don't exist
+        if rng.random() < 0.95:
+            session.add(module.Contact(
+                username=rng.choice(pool["username"]), phonenumber=rng.choice(pool["phonenumber"]),
+                email=rng.choice(pool["email"]), email_opt_in_status=True, sms_opt_in_status=True,
+                matm_owner=rng.choice(OWNERS), contact_id=contact_id, individual_id=f"ind-{contact_id}"))
+    # opt-in rows are unique per (value, matm_owner, username); repeats are skipped
+    seeded = set()
+    for _ in range(rows):
+        for model, field in ((module.ContactPointEmail, "email"), (module.ContactPointPhone, "phonenumber")):
+            values = {"username": rng.choice(pool["username"]), field: rng.choice(pool[field]),
+                      "matm_owner": rng.choice(OWNERS), "contact_id": rng.choice(contact_ids)}
+            key = (field, values[field], values["matm_owner"], values["username"])
+            if key not in seeded:
+                seeded.add(key)
+                session.add(model(**values))
+    session.commit()
+
+
+def python_path(module, session, probe):
+    """What POST /contacts does with MATCH_RESOLUTION=python and a cold cache."""
+    Contact, Email, Phone = module.Contact, module.ContactPointEmail, module.ContactPointPhone
+    phone = session.execute(select(Phone.matm_owner, Phone.username, Phone.contact_id)
+                            .where(Phone.phonenumber == probe["phonenumber"]).order_by(Phone.id)).all()
+    email = session.execute(select(Email.matm_owner, Email.username, Email.contact_id)
+                            .where(Email.email == probe["email"]).order_by(Email.id)).all()
+    match = match_identities(email, phone, probe["matm_owner"], probe["username"])
+    contact_id = match.contact_id or match.individual_contact_id
+    contact = None
+    if contact_id:
+        contact = session.execute(select(Contact).where(Contact.contact_id == contact_id)).scalars().first()
+    return match, contact
+
+
+def sql_path(statement, session, probe):
+    row = session.execute(statement, probe).one()
+    return match_from_row(row), row[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=5000, help="rows per opt-in table")
+    parser.add_argument("--probes", type=int, default=5000)
+    parser.add_argument("--pool", type=int, default=2000, help="distinct emails/phones")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pool = {
+        "email": [f"user{i}@test.com" for i in range(args.pool)],
+        "phonenumber": [1_000_000_000 + i for i in range(args.pool)],
+        "username": [f"user{i}" for i in range(8)],
+    }
+    path = os.path.join(tempfile.mkdtemp(prefix="match-resolution-"), "contacts.db")
+    module = load_app("flask", database=path)
+    session = module.Session()
+    seed(module, session, args.rows, rng, pool)
+    statement = match_statement(module.Contact)
+
+    statements = [0]
+    event.listen(module.engine, "before_cursor_execute", lambda *a: statements.__setitem__(0, statements[0] + 1))
+
+    probes = [{"email": rng.choice(pool["email"]), "phonenumber": rng.choice(pool["phonenumber"]),
+               "matm_owner": rng.choice(OWNERS), "username": rng.choice(pool["username"])}
+              for _ in range(args.probes)]
+    outcomes = {}
+    totals = {}
+    for name, run in (("python", lambda p: python_path(module, session, p)),
+                      ("sql", lambda p: sql_path(statement, session, p))):
+        statements[0] = 0
+        start = time.perf_counter()
+        outcomes[name] = []
+        for probe in probes:
+            match, contact = run(probe)
+            outcomes[name].append((match, contact.id if contact else None,
+                                   contact.individual_id if contact else None))
+            session.expire_all()
+        totals[name] = (statements[0], time.perf_counter() - start)
+
+    mismatches = [(probe, a, b) for probe, a, b in zip(probes, outcomes["python"], outcomes["sql"]) if a != b]
+    kinds = {"same contact": 0, "owner conflict": 0, "same individual": 0, "no match": 0}
+    for match, _, _ in outcomes["python"]:
+        kinds["same contact" if match.contact_id else "same individual" if match.individual_contact_id
+              else "owner conflict" if match.conflict else "no match"] += 1
+
+    print("outcomes:", ", ".join(f"{k} {v}" for k, v in kinds.items()))
+    for name, (count, elapsed) in totals.items():
+        print(f"{name:<8}{count / len(probes):>6.2f} round trips/request{elapsed / len(probes) * 1e6:>10.1f} us/request")
+    for probe, a, b in mismatches[:10]:
+        print("MISMATCH", probe, a, b)
+    print(f"{len(mismatches)} mismatches in {len(probes)} probes")
+    raise SystemExit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+POST /contacts latency against opt-in tables that already hold N rows, with
+and without the dedup indexes. Runs the flask app in-process through its test
+client so only the handler and SQLite are measured.
+
+    python -m benchmarks.post_scaling --sizes 10000,100000,1000000
+"""
+import argparse
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import time
+
+from common.apps import load_app
+from stress_test import payload_dict, percentile, update_payload
+
+SEED_CHUNK = 50_000
+
+
+def seed(path, rows):
+    """Fill contacts and both opt-in tables with `rows` distinct contacts."""
+    conn = sqlite3.connect(path)
+    for start in range(0, rows, SEED_CHUNK):
+        chunk = range(start, min(start + SEED_CHUNK, rows))
+        conn.executemany(
+            "INSERT INTO contacts (username, phonenumber, email, email_opt_in_status, sms_opt_in_status, "
+            "matm_owner, contact_id) VALUES (?, ?, ?, 1, 1, 'TD00', ?)",
+            ((f"user{i}", 1_000_000_000 + i, f"user{i}@seed.com", f"{i:08x}") for i in chunk))
+        conn.executemany(
+            "INSERT INTO email_opt_in (username, email, matm_owner, contact_id) VALUES (?, ?, 'TD00', ?)",
+            ((f"user{i}", f"user{i}@seed.com", f"{i:08x}") for i in chunk))
+        conn.executemany(
+            "INSERT INTO mobile_opt_in (username, phonenumber, matm_owner, contact_id) VALUES (?, ?, 'TD00', ?)",
+            ((f"user{i}", 1_000_000_000 + i, f"{i:08x}") for i in chunk))
+        conn.commit()
+    conn.close()
+
+
+def set_indexes(module, enabled):
+    with module.engine.begin() as conn:
+        for table in module.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if enabled:
+                    index.create(conn, checkfirst=True)
+                else:
+                    index.drop(conn, checkfirst=True)
+
+
+def time_posts(client, count):
+    latencies = []
+    for _ in range(count):
+        payload = update_payload(payload_dict)
+        start = time.perf_counter()
+        # closing the response gives back its admission slot
+        with client.post("/contacts", json=payload) as response:
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 201, response.data
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="existing rows per table")
+    parser.add_argument("--posts", type=int, default=100, help="POSTs timed per size and mode")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10}  {'indexes':<8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        path = os.path.join(tempfile.mkdtemp(prefix="post-scaling-"), "contacts.db")
+        module = load_app("flask", database=path, module_name=f"flask_app_{size}")
+        seed(path, size)
+        client = module.app.test_client()
+        for enabled in (False, True):
+            set_indexes(module, enabled)
+            with contextlib.redirect_stdout(io.StringIO()):
+                latencies = time_posts(client, args.posts)
+            mean = sum(latencies) / len(latencies)
+            print(f"{size:>10}  {'on' if enabled else 'off':<8}{mean * 1000:>10.2f}"
+                  f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}")
+        module.session.close()
+        module.engine.dispose()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
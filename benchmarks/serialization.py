@@ -0,0 +1,86 @@
+"""
+Rows serialized per second for the list endpoints: ORM instances through
+marshmallow (flask) or jsonable_encoder (FastAPI) against plain Core rows
+encoded with orjson, and with the standard library json fallback. Reads the
+whole contacts table page by page from a seeded SQLite file, in-process.
+
+    python -m benchmarks.serialization --rows 100000 --page 1000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+
+from benchmarks.post_scaling import seed
+from common import serialization
+from common.apps import load_app
+from common.pagination import column_names, page, page_statement
+
+
+def orm_pages(module, session, limit, encode):
+    Contact = module.Contact
+    after, total = 0, 0
+    while True:
+        contacts = session.execute(select(Contact).where(Contact.id > after)
+                                   .order_by(Contact.id).limit(limit)).scalars().all()
+        if not contacts:
+            return total
+        encode(contacts)
+        total += len(contacts)
+        after = contacts[-1].id
+        session.expunge_all()
+
+
+def core_pages(module, session, limit, encode):
+    columns = column_names(module.Contact)
+    after, total = 0, 0
+    while True:
+        body = page("contacts", session.execute(page_statement(module.Contact, limit, after, columns)),
+                    limit, columns)
+        encode(body)
+        total += len(body["contacts"])
+        if body["next_cursor"] is None:
+            return total
+        after = body["next_cursor"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--page", type=int, default=1000, help="rows per page")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix="serialization-"), "contacts.db")
+    module = load_app("flask", database=path)
+    seed(path, args.rows)
+    session = module.Session()
+    contact_schema = module.ContactSchema(many=True)
+
+    def stdlib(body):
+        return json.dumps(body, separators=(",", ":")).encode()
+
+    paths = [
+        ("orm + marshmallow", orm_pages, lambda rows: json.dumps({"contacts": contact_schema.dump(rows)}).encode()),
+        ("orm + jsonable_encoder", orm_pages, lambda rows: stdlib(jsonable_encoder({"contacts": rows}))),
+        ("core + json", core_pages, stdlib),
+    ]
+    if serialization.orjson is not None:
+        paths.append(("core + orjson", core_pages, serialization.dumps))
+
+    print(f"{'path':<24}{'rows':>10}{'seconds':>10}{'rows/s':>12}")
+    for name, run, encode in paths:
+        start = time.perf_counter()
+        total = run(module, session, args.page, encode)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<24}{total:>10}{elapsed:>10.2f}{total / elapsed:>12.0f}")
+    session.close()
+    module.engine.dispose()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
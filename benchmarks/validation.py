@@ -0,0 +1,57 @@
+"""
+POST /contacts bodies validated per second: the framework validators the apps
+used to run on every request against the fast path in common/validation.py,
+for the flask (marshmallow) and FastAPI (pydantic) flavours. Bodies are the
+load test's payloads as JSON bytes; every path decodes and validates each one.
+
+    python -m benchmarks.validation --bodies 10000 --rounds 5
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from common.apps import load_app
+from stress_test import payload_dict, update_payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--bodies", type=int, default=10_000, help="distinct request bodies")
+    parser.add_argument("--rounds", type=int, default=5, help="passes over the bodies per path")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="validation-")
+    flask_app = load_app("flask", database=os.path.join(workdir, "flask.db"))
+    fastapi_app = load_app("fastapi", database=os.path.join(workdir, "fastapi.db"))
+    bodies = [json.dumps(update_payload(payload_dict)).encode() for _ in range(args.bodies)]
+
+    shared_schema = flask_app.ContactSchema()
+    ContactBase = fastapi_app.ContactBase
+    flask_parser = flask_app.contact_parser
+    fastapi_parser = fastapi_app.contact_parser
+
+    paths = [
+        ("flask", "marshmallow, schema per request", lambda body: not flask_app.ContactSchema().validate(json.loads(body))),
+        ("flask", "marshmallow, shared schema", lambda body: not shared_schema.validate(json.loads(body))),
+        ("flask", "fast path", lambda body: flask_parser.parse(body) is not None),
+        ("fastapi", "json.loads + ContactBase", lambda body: ContactBase(**json.loads(body)) is not None),
+        ("fastapi", "ContactBase.model_validate_json", lambda body: ContactBase.model_validate_json(body) is not None),
+        ("fastapi", "fast path", lambda body: fastapi_parser.parse(body) is not None),
+    ]
+
+    print(f"{'app':<9}{'path':<34}{'accepted':>10}{'seconds':>10}{'validations/s':>15}")
+    for app, name, validate in paths:
+        accepted = sum(validate(body) for body in bodies)
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for body in bodies:
+                validate(body)
+        elapsed = time.perf_counter() - start
+        total = args.rounds * len(bodies)
+        print(f"{app:<9}{name:<34}{accepted:>10}{elapsed:>10.2f}{total / elapsed:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Code shared by the flask, fastapi and fastapi_sync apps and the tooling around them."""
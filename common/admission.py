@@ -0,0 +1,221 @@
+"""
+Admission control in front of the database: at most `limit` requests of a
+class run at once, a bounded queue waits for a slot, and a request that
+would wait longer than the budget is turned away at once with 503 and
+Retry-After instead of piling up on SQLite's lock.
+
+Reads (GET and HEAD) and writes (everything else) get separate Limiters, so
+a burst of POSTs queueing for the single writer does not hold up GETs. A
+Limiter keeps a moving average of how long its requests take once admitted.
+A new arrival that finds every slot busy is estimated to wait
+(queued ahead + 1) * average / limit. It is shed when that is over `budget`
+or the queue already holds `queue_size` requests, and Retry-After is the
+estimate, rounded up to whole seconds. A queued request that still has no
+slot after `budget` seconds is shed as well. Slots are handed to queued
+requests in arrival order.
+
+AdmissionASGIMiddleware and AdmissionWSGIMiddleware wrap the apps inside the
+idempotency middleware, so replays skip the queue, and the metrics
+middleware, which counts the 503s. /metrics and /health/ are never limited.
+Limits are per process: with several workers the database sees up to
+workers * limit requests of a class.
+"""
+import asyncio
+import json
+import math
+import threading
+import time
+from collections import deque
+
+from common.metrics import ClosingIterator
+from common.timing import timed
+
+# moving average weight of the latest service time
+SMOOTHING = 0.1
+
+EXEMPT_PREFIXES = ("/metrics", "/health/")
+
+
+class Overloaded(Exception):
+    """Raised by Limiter.enter() for a shed request; retry_after is in whole seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """
+    `limit` concurrent requests, `queue_size` waiting. `event_type` is what a
+    queued request blocks on: threading.Event for threaded servers,
+    asyncio.Event on an event loop. A limit of 0 admits everything.
+    """
+
+    def __init__(self, limit, queue_size, budget, event_type=threading.Event):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.budget = budget
+        self.event_type = event_type
+        self.lock = threading.Lock()
+        self.active = 0
+        self.queue = deque()
+        self.service_time = 0.0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    @property
+    def enabled(self):
+        return self.limit > 0
+
+    def estimate(self):
+        """Seconds a request arriving now would wait for a slot."""
+        if self.active < self.limit:
+            return 0.0
+        return (len(self.queue) + 1) * self.service_time / self.limit
+
+    def enter(self):
+        """
+        None when admitted at once, an event that is set when a slot is handed
+        over when queued; raises Overloaded when shed.
+        """
+        with self.lock:
+            if self.active < self.limit and not self.queue:
+                self.active += 1
+                self.admitted += 1
+                return None
+            wait = self.estimate()
+            if len(self.queue) >= self.queue_size or wait > self.budget:
+                self.shed += 1
+                raise Overloaded(max(math.ceil(wait), 1))
+            event = self.event_type()
+            self.queue.append(event)
+            self.queued += 1
+            return event
+
+    def cancel(self, event):
+        """
+        After a queued wait ran out: raises Overloaded if the request was
+        still queued, and returns if a slot was handed over meanwhile.
+        """
+        with self.lock:
+            if event.is_set():
+                return
+            self.queue.remove(event)
+            self.timed_out += 1
+            self.shed += 1
+            wait = self.estimate()
+        raise Overloaded(max(math.ceil(wait), 1))
+
+    def withdraw(self, event):
+        """For a queued request that gives up without running: leave the queue, or pass on the slot it was handed."""
+        with self.lock:
+            if event.is_set():
+                self.release()
+            else:
+                self.queue.remove(event)
+
+    def leave(self, admitted_at):
+        """Release a slot taken at `admitted_at` (time.perf_counter()), to the first queued request if any."""
+        elapsed = time.perf_counter() - admitted_at
+        with self.lock:
+            self.service_time += SMOOTHING * (elapsed - self.service_time)
+            self.release()
+
+    def release(self):
+        # called with the lock held
+        if self.queue:
+            # the slot passes on without being released
+            self.admitted += 1
+            self.queue.popleft().set()
+        else:
+            self.active -= 1
+
+    def stats(self):
+        with self.lock:
+            return {"limit": self.limit, "active": self.active, "waiting": len(self.queue),
+                    "admitted": self.admitted, "queued": self.queued, "shed": self.shed,
+                    "timed_out": self.timed_out, "service_ms": self.service_time * 1000}
+
+
+def limiter_for(method, path, read, write):
+    """The Limiter a request goes through, or None."""
+    if path.startswith(EXEMPT_PREFIXES):
+        return None
+    limiter = read if method in ("GET", "HEAD") else write
+    return limiter if limiter.enabled else None
+
+
+def overloaded_body(key, retry_after):
+    return json.dumps({key: f"server overloaded, retry in {retry_after}s"}).encode()
+
+
+class AdmissionASGIMiddleware:
+
+    def __init__(self, app, read, write):
+        self.app = app
+        self.read = read
+        self.write = write
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        limiter = limiter_for(scope["method"], scope["path"], self.read, self.write)
+        if limiter is None:
+            return await self.app(scope, receive, send)
+        try:
+            event = limiter.enter()
+            if event is not None:
+                try:
+                    with timed("queue"):
+                        await asyncio.wait_for(event.wait(), limiter.budget)
+                except asyncio.TimeoutError:
+                    limiter.cancel(event)
+                except BaseException:
+                    # cancelled while queued: client gone or server shutting down
+                    limiter.withdraw(event)
+                    raise
+        except Overloaded as error:
+            await send({"type": "http.response.start", "status": 503,
+                        "headers": [(b"content-type", b"application/json"),
+                                    (b"retry-after", str(error.retry_after).encode())]})
+            await send({"type": "http.response.body", "body": overloaded_body("detail", error.retry_after)})
+            return
+        admitted_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.leave(admitted_at)
+
+
+class AdmissionWSGIMiddleware:
+
+    def __init__(self, app, read, write):
+        self.app = app
+        self.read = read
+        self.write = write
+
+    def __call__(self, environ, start_response):
+        limiter = limiter_for(environ["REQUEST_METHOD"], environ.get("PATH_INFO", ""), self.read, self.write)
+        if limiter is None:
+            return self.app(environ, start_response)
+        try:
+            event = limiter.enter()
+            if event is not None:
+                with timed("queue"):
+                    admitted = event.wait(limiter.budget)
+                if not admitted:
+                    limiter.cancel(event)
+        except Overloaded as error:
+            start_response("503 SERVICE UNAVAILABLE", [("Content-Type", "application/json"),
+                                                       ("Retry-After", str(error.retry_after))])
+            return [overloaded_body("message", error.retry_after)]
+        admitted_at = time.perf_counter()
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            limiter.leave(admitted_at)
+            raise
+        # held until the body is sent, streamed exports included
+        return ClosingIterator(body, lambda: limiter.leave(admitted_at))
@@ -0,0 +1,33 @@
+"""Import the three apps by path; their directories shadow the framework packages."""
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+APP_NAMES = ("flask", "fastapi", "fastapi_sync")
+
+# DATABASE_URL template per app for a given sqlite file
+DATABASE_URLS = {
+    "flask": "sqlite:///{path}",
+    "fastapi": "sqlite+aiosqlite:///{path}",
+    "fastapi_sync": "sqlite:///{path}",
+}
+
+
+def load_app(name, database=None, module_name=None):
+    """
+    Import `<name>/app.py` as a fresh module.
+
+    If `database` (a sqlite file path) is given, DATABASE_URL is pointed at it
+    first, so import-time schema creation in flask/fastapi_sync lands there.
+    `module_name` lets callers import the same app more than once.
+    """
+    if database is not None:
+        os.environ["DATABASE_URL"] = DATABASE_URLS[name].format(path=database)
+    module_name = module_name or f"{name}_app"
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, name, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
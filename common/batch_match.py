@@ -0,0 +1,234 @@
+"""
+Batch matching for reconciliation: classify many incoming contacts against
+the opt-in tables in one pass instead of per-row queries.
+
+MatchSnapshot loads the (key, matm_owner, username, contact_id) columns of
+email_opt_in and mobile_opt_in once (snapshot_statements()) and keeps them
+as compact arrays: strings become integer codes, and each table is sorted by
+key with ties left in id order. classify() then matches a whole batch as a
+sort-merge join. Every incoming key is located with searchsorted, the
+matching runs are expanded into one flat array of candidates, laid out email
+rows first and then phone rows, as match_identities() scans them, and the
+owner and username comparisons, the first conflict per row and the matches
+before it are all array operations.
+
+The result is the Match that match_identities() gives for the same rows, so
+it agrees with POST /contacts. Rows of a batch are classified against the
+snapshot only and do not see each other. Imports that write use
+common.bulk.plan_batch, which matches sequentially.
+
+Without numpy the snapshot keeps per-value row lists and runs
+match_identities() for every row.
+"""
+from itertools import repeat
+
+from sqlalchemy import select
+
+from common.identity_cache import IdentityRow
+from common.matching import Match, match_identities
+
+try:
+    import numpy
+except ImportError:  # optional
+    numpy = None
+
+# classify() outcomes, in the order POST /contacts picks its message
+SAME_CONTACT = "same contact"
+OWNER_CONFLICT = "owner conflict"
+SAME_INDIVIDUAL = "same individual"
+NO_MATCH = "no match"
+OUTCOMES = (SAME_CONTACT, OWNER_CONFLICT, SAME_INDIVIDUAL, NO_MATCH)
+
+
+def snapshot_statements(email_model, phone_model):
+    """SELECTs of (email, ...) and (phonenumber, ...) with matm_owner, username and contact_id, in id order."""
+    return [select(getattr(model, field), model.matm_owner, model.username, model.contact_id).order_by(model.id)
+            for model, field in ((email_model, "email"), (phone_model, "phonenumber"))]
+
+
+def outcome(match):
+    """Which of OUTCOMES a Match is; a same-contact match before a conflict still updates."""
+    if match.contact_id:
+        return SAME_CONTACT
+    if match.conflict:
+        return OWNER_CONFLICT
+    if match.individual_contact_id:
+        return SAME_INDIVIDUAL
+    return NO_MATCH
+
+
+class Codes:
+    """Dense integer codes for strings, and the strings back by code."""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def add(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode(self, values, count):
+        """Array of the codes of `values`; -1, which no row has, for values the snapshot has never seen."""
+        return numpy.fromiter(map(self.codes.get, values, repeat(-1, count)), numpy.int64, count)
+
+
+class MatchSnapshot:
+    """
+    The opt-in rows `email_rows` and `phone_rows`, each (value, matm_owner,
+    username, contact_id) in id order. With `vectorized` (the default when
+    numpy is installed) they are held as arrays for classify().
+    """
+
+    def __init__(self, email_rows, phone_rows, vectorized=None):
+        self.vectorized = numpy is not None if vectorized is None else vectorized
+        if not self.vectorized:
+            self.indexes = []
+            for rows in (email_rows, phone_rows):
+                index = {}
+                for value, matm_owner, username, contact_id in rows:
+                    index.setdefault(value, []).append(IdentityRow(matm_owner, username, contact_id))
+                self.indexes.append(index)
+            return
+
+        self.emails, self.owners, self.usernames, self.contact_ids = Codes(), Codes(), Codes(), Codes()
+        sections = []
+        for rows, key in ((email_rows, self.emails.add), (phone_rows, int)):
+            columns = ([], [], [], [])
+            for value, matm_owner, username, contact_id in rows:
+                columns[0].append(key(value))
+                columns[1].append(self.owners.add(matm_owner))
+                columns[2].append(self.usernames.add(username))
+                columns[3].append(self.contact_ids.add(contact_id))
+            keys, owners, usernames, contact_ids = (numpy.array(column, dtype=numpy.int64) for column in columns)
+            # a stable sort keeps rows with the same key in id order
+            order = numpy.argsort(keys, kind="stable")
+            sections.append((keys[order], owners[order], usernames[order], contact_ids[order]))
+        (self.email_keys, *email_columns), (self.phone_keys, *phone_columns) = sections
+        # email rows then phone rows in one array per column; phone rows start at len(email_keys)
+        self.owner, self.username, self.contact_id = (numpy.concatenate(pair)
+                                                      for pair in zip(email_columns, phone_columns))
+        # whether each contact_id counts as a match (it can be NULL)
+        self.truthy = numpy.array([bool(contact_id) for contact_id in self.contact_ids.values], dtype=bool)
+
+    def __len__(self):
+        if not self.vectorized:
+            return sum(len(rows) for index in self.indexes for rows in index.values())
+        return len(self.owner)
+
+    def classify(self, emails, phonenumbers, matm_owners, usernames):
+        """
+        The Match of every incoming contact, given as four equally long
+        sequences: a list, or a BatchMatches when vectorized.
+        """
+        if not self.vectorized:
+            email_index, phone_index = self.indexes
+            return [match_identities(email_index.get(email, ()), phone_index.get(phonenumber, ()),
+                                     matm_owner, username)
+                    for email, phonenumber, matm_owner, username
+                    in zip(emails, phonenumbers, matm_owners, usernames)]
+
+        count = len(emails)
+        email = self.emails.encode(emails, count)
+        owner = self.owners.encode(matm_owners, count)
+        username = self.usernames.encode(usernames, count)
+        phone = numpy.fromiter(phonenumbers, numpy.int64, count)
+
+        # each row's run of equal keys in either table
+        email_start = numpy.searchsorted(self.email_keys, email, "left")
+        email_count = numpy.searchsorted(self.email_keys, email, "right") - email_start
+        phone_start = numpy.searchsorted(self.phone_keys, phone, "left")
+        phone_count = numpy.searchsorted(self.phone_keys, phone, "right") - phone_start
+
+        # one candidate per (row, matching opt-in row), in scan order: row, email rows, phone rows
+        per_row = email_count + phone_count
+        row = numpy.repeat(numpy.arange(count), per_row)
+        position = numpy.arange(len(row))
+        offset = position - (numpy.cumsum(per_row) - per_row)[row]
+        in_email = offset < email_count[row]
+        candidate = numpy.where(in_email, email_start[row] + offset,
+                                len(self.email_keys) + phone_start[row] + offset - email_count[row])
+
+        same_owner = self.owner[candidate] == owner[row]
+        same_username = self.username[candidate] == username[row]
+
+        # the first conflict of each row ends its scan
+        conflicts = numpy.flatnonzero(same_owner & ~same_username)
+        conflict_rows, firsts = first_per_row(row[conflicts])
+        conflict_at = numpy.full(count, len(row))
+        conflict_at[conflict_rows] = conflicts[firsts]
+        before = position < conflict_at[row]
+
+        contact = numpy.full(count, -1)
+        matched = numpy.flatnonzero(same_owner & same_username & before)
+        matched_rows, firsts = first_per_row(row[matched])
+        contact[matched_rows] = self.contact_id[candidate[matched[firsts]]]
+
+        individuals = numpy.flatnonzero(~same_owner & same_username & before)
+        bounds = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(row[individuals], minlength=count))))
+
+        return BatchMatches(self.contact_ids.values, self.truthy, contact, conflict_at < len(row), bounds,
+                            self.contact_id[candidate[individuals]])
+
+
+class BatchMatches:
+    """
+    classify() result as arrays: per row the code of its same-contact match
+    (-1 for none) and whether it hit a conflict, and its individual matches
+    between bounds[row] and bounds[row + 1] of `individuals`. Indexing or
+    iterating builds Matches; outcomes() stays on the arrays.
+    """
+
+    def __init__(self, contact_ids, truthy, contact, conflict, bounds, individuals):
+        self.contact_ids = contact_ids
+        self.truthy = truthy
+        self.contact = contact
+        self.conflict = conflict
+        self.bounds = bounds
+        self.individuals = individuals
+
+    def __len__(self):
+        return len(self.contact)
+
+    def __getitem__(self, index):
+        individual = tuple(self.contact_ids[code]
+                           for code in self.individuals[self.bounds[index]:self.bounds[index + 1]].tolist())
+        code = int(self.contact[index])
+        return Match(self.contact_ids[code] if code >= 0 else None, bool(self.conflict[index]),
+                     individual[0] if individual else None, individual)
+
+    def __iter__(self):
+        contact_ids = self.contact_ids
+        individual_ids = [contact_ids[code] for code in self.individuals.tolist()]
+        for code, conflict, start, end in zip(self.contact.tolist(), self.conflict.tolist(),
+                                              self.bounds[:-1].tolist(), self.bounds[1:].tolist()):
+            individual = tuple(individual_ids[start:end])
+            yield Match(contact_ids[code] if code >= 0 else None, conflict,
+                        individual[0] if individual else None, individual)
+
+    def outcomes(self):
+        """outcome() of every row."""
+        # code -1 (no match) reads the False appended to truthy
+        truthy = numpy.append(self.truthy, False)
+        starts = self.bounds[:-1]
+        first = numpy.where(self.bounds[1:] > starts, numpy.append(self.individuals, -1)[starts], -1)
+        codes = numpy.select([truthy[self.contact], self.conflict, truthy[first]], [0, 1, 2], 3)
+        return [OUTCOMES[code] for code in codes.tolist()]
+
+
+def outcomes(matches):
+    """outcome() of every Match classify() returned."""
+    if isinstance(matches, BatchMatches):
+        return matches.outcomes()
+    return [outcome(match) for match in matches]
+
+
+def first_per_row(rows):
+    """For a sorted array of row numbers, the distinct rows and the index of each one's first entry."""
+    if not len(rows):
+        return rows, rows
+    first = numpy.flatnonzero(numpy.concatenate(([True], rows[1:] != rows[:-1])))
+    return rows[first], first
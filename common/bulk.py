@@ -0,0 +1,237 @@
+"""
+Batch version of POST /contacts for the /contacts/bulk endpoints.
+
+The apps parse and validate the batch, load the existing opt-in rows for all
+of its emails and phones with lookup_statements() and the contacts those
+point at with contact_statements(), and hand everything to plan_batch(). The
+plan holds plain dicts ready for executemany inserts and updates in one
+transaction, plus one outcome per input row.
+
+Rows are matched in order exactly as separate POSTs would be. Opt-in rows
+and contacts created by earlier rows of the batch are visible to later ones.
+
+contact_id is unique and only 8 hex digits, so a large batch against a
+large table is likely to draw an id that is already stored. The apps draw
+the batch's ids with new_contact_ids(), look them up with
+taken_statements(), and replace the taken ones (replace_taken()) before
+planning. A replacement that still collides fails the commit with an
+IntegrityError, and the batch is planned again.
+"""
+import json
+import time
+from uuid import uuid4
+
+from sqlalchemy import bindparam, insert, select, update
+
+from common.identity_cache import IdentityRow
+from common.identity_graph import link_statements
+from common.matching import MATCH_ERROR, match_identities
+from common.upsert import opt_in_insert
+
+# upper bound on rows per request
+MAX_BULK_ROWS = 10_000
+
+# values per IN (...) lookup, well under SQLite's bound parameter limit
+LOOKUP_CHUNK = 500
+
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonl", "application/ndjson")
+
+CONTACT_FIELDS = ("username", "phonenumber", "country", "state", "email", "email_opt_in_status",
+                  "sms_opt_in_status", "matm_owner", "individual_id", "status", "contact_id")
+
+
+class BulkBodyError(ValueError):
+    pass
+
+
+def parse_body(body, content_type):
+    """A JSON array, or one JSON object per line for NDJSON content types."""
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    try:
+        if content_type in NDJSON_TYPES:
+            rows = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            rows = json.loads(body)
+    except ValueError as error:
+        raise BulkBodyError(f"invalid JSON: {error}")
+    if not isinstance(rows, list):
+        raise BulkBodyError("expected a JSON array of contacts")
+    if len(rows) > MAX_BULK_ROWS:
+        raise BulkBodyError(f"at most {MAX_BULK_ROWS} contacts per request")
+    return rows
+
+
+def lookup_statements(model, field, values, columns=("matm_owner", "username", "contact_id")):
+    """SELECTs of (field, *columns) for rows with `field` in `values`, each chunk in id order."""
+    column = getattr(model, field)
+    selected = [column] + [getattr(model, name) for name in columns]
+    values = list(values)
+    for start in range(0, len(values), LOOKUP_CHUNK):
+        yield select(*selected).where(column.in_(values[start:start + LOOKUP_CHUNK])).order_by(model.id)
+
+
+def add_rows(index, rows):
+    for value, matm_owner, username, contact_id in rows:
+        index.setdefault(value, []).append(IdentityRow(matm_owner, username, contact_id))
+
+
+def new_contact_ids(count, exclude=()):
+    """`count` distinct new contact_ids, none of them in `exclude`."""
+    contact_ids = set()
+    while len(contact_ids) < count:
+        contact_id = uuid4().hex[:8]
+        if contact_id not in exclude:
+            contact_ids.add(contact_id)
+    return contact_ids
+
+
+def taken_statements(contact_model, contact_ids):
+    """SELECTs of the `contact_ids` already stored."""
+    return lookup_statements(contact_model, "contact_id", contact_ids, columns=())
+
+
+def replace_taken(contact_ids, taken):
+    """`contact_ids` with the `taken` ones swapped for new ids, which are not checked again."""
+    return (contact_ids - taken) | new_contact_ids(len(contact_ids & taken), exclude=contact_ids | taken)
+
+
+def contact_statements(contact_model, email_index, phone_index):
+    """
+    SELECTs of (contact_id, username, email, phonenumber, individual_id) for
+    every contact the loaded opt-in rows point at. An update that also matched
+    another owner's individual writes opt-in rows from the stored contact, not
+    the request, and created contacts join the individuals of their matches.
+    """
+    contact_ids = {row.contact_id for index in (email_index, phone_index)
+                   for rows in index.values() for row in rows}
+    return lookup_statements(contact_model, "contact_id", contact_ids,
+                             columns=("username", "email", "phonenumber", "individual_id"))
+
+
+def add_contacts(index, rows):
+    for contact_id, username, email, phonenumber, individual_id in rows:
+        index[contact_id] = {"username": username, "email": email, "phonenumber": phonenumber,
+                             "individual_id": individual_id}
+
+
+def contact_individuals(contact_index):
+    """individual_ids of the loaded contacts, to walk up from (common.identity_graph.walk_statements)."""
+    return {contact["individual_id"] for contact in contact_index.values() if contact["individual_id"]}
+
+
+class BulkPlan:
+
+    def __init__(self):
+        self.contacts = []
+        self.updates = []
+        self.email_opt_ins = []
+        self.phone_opt_ins = []
+        self.individuals = []
+        self.links = None
+        self.results = []
+
+    def summary(self):
+        messages = [result.get("message") for result in self.results]
+        return {
+            "inserted": len(self.contacts),
+            "updated": messages.count("contact Updated"),
+            "failed": sum(1 for result in self.results if "errors" in result),
+        }
+
+
+def plan_batch(rows, email_index, phone_index, contact_index, record_individuals=False, links=None,
+               contact_ids=None):
+    """
+    Decide every row of a validated batch.
+
+    `rows` is a list of (position, contact dict) and `email_index` /
+    `phone_index` map each value to its existing IdentityRows in id order
+    (see add_rows). Both indexes are extended as the batch adds opt-in rows.
+    `contact_index` holds the stored contacts they point at (add_contacts).
+    With `record_individuals`, updates and conflicts also get an Individual
+    row, as the FastAPI apps do for a single POST. With `links` (an
+    IndividualLinks loaded for the contacts in `contact_index`), every created
+    contact gets its individual_id as a single POST would assign it.
+    `contact_ids` holds at least one new id per row, by default unchecked
+    new_contact_ids().
+    """
+    if contact_ids is None:
+        contact_ids = new_contact_ids(len(rows))
+    new_ids = iter(contact_ids)
+    plan = BulkPlan()
+    plan.links = links
+    created = {}  # contact_id -> insert dict of contacts created by this batch
+    updated = {}  # contact_id -> update dict of existing contacts
+    for position, data in rows:
+        start_time = time.time()
+        contact = {field: data.get(field) for field in CONTACT_FIELDS}
+        contact["contact_id"] = next(new_ids)
+        message = "Contact added successfully"
+
+        match = match_identities(email_index.get(data["email"], ()), phone_index.get(data["phonenumber"], ()),
+                                 data["matm_owner"], data["username"])
+        if match.conflict:
+            contact["status"] = message = MATCH_ERROR
+
+        if match.contact_id:
+            contact = created.get(match.contact_id)
+            if contact is None:
+                contact = updated.setdefault(match.contact_id, {"b_contact_id": match.contact_id})
+            contact["state"] = data.get("state")
+            contact["country"] = data.get("country")
+            contact["status"] = f"updated - {start_time - time.time()}"
+            message = "contact Updated"
+        elif match.individual_contact_id:
+            contact["status"] = f"created - {time.time()}"
+
+        if links is not None and not match.contact_id:
+            contact["individual_id"] = links.assign(
+                (created.get(matched) or contact_index.get(matched) or {}).get("individual_id")
+                for matched in match.individual_contact_ids)
+
+        contact_id = match.contact_id or contact["contact_id"]
+        if message == "Contact added successfully" or match.individual_contact_id:
+            # from the contact as stored, which for an update is the matched one
+            stored = created.get(contact_id) or contact_index.get(contact_id) or data
+            identity = IdentityRow(data["matm_owner"], stored["username"], contact_id)
+            opt_in = {"username": stored["username"], "country": data.get("country"), "state": data.get("state"),
+                      "matm_owner": data["matm_owner"], "contact_id": contact_id}
+            plan.email_opt_ins.append(dict(opt_in, email=stored["email"]))
+            plan.phone_opt_ins.append(dict(opt_in, phonenumber=stored["phonenumber"]))
+            email_index.setdefault(stored["email"], []).append(identity)
+            phone_index.setdefault(stored["phonenumber"], []).append(identity)
+        elif record_individuals:
+            plan.individuals.append({"username": data["username"], "individual_id": uuid4().hex})
+
+        if not match.contact_id:
+            created[contact_id] = contact
+            plan.contacts.append(contact)
+        plan.results.append({"index": position, "message": message, "username": data["username"],
+                             "contact_id": contact_id})
+
+    plan.updates = list(updated.values())
+    return plan
+
+
+def plan_statements(plan, contact_model, email_model, phone_model, individual_model=None, link_model=None):
+    """(statement, rows) pairs that write a plan with executemany, inserts before updates."""
+    contacts = contact_model.__table__
+    writes = [
+        (insert(contacts), plan.contacts),
+        (update(contacts).where(contacts.c.contact_id == bindparam("b_contact_id")), plan.updates),
+        # an update writes its contact's opt-in rows again; those already stored are skipped
+        (opt_in_insert(email_model), plan.email_opt_ins),
+        (opt_in_insert(phone_model), plan.phone_opt_ins),
+    ]
+    if individual_model is not None:
+        writes.append((insert(individual_model.__table__), plan.individuals))
+    if link_model is not None and plan.links is not None:
+        writes.extend(link_statements(link_model, plan.links))
+    return [(statement, rows) for statement, rows in writes if rows]
+
+
+def merge_results(plan, errors):
+    """Outcomes of planned rows and validation errors, in input order."""
+    plan.results.extend({"index": position, "errors": error} for position, error in errors)
+    plan.results.sort(key=lambda result: result["index"])
+    return plan.results
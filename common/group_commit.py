@@ -0,0 +1,140 @@
+"""
+Group commit for the fastapi POST /contacts writes.
+
+Each POST still writes its contact, opt-in rows, links and Individual in one
+transaction of its own (common/upsert.py), but SQLite pays one fsync per
+commit. A GroupCommit puts those transactions from concurrent requests into
+one: requests submit() their writes, a single writer task takes whatever has
+queued up (at most `max_batch`, waiting up to `window` seconds for more when
+the batch is not full), runs each request's writes in a SAVEPOINT of a shared
+transaction, and commits once.
+
+A request's writes that raise are rolled back to their savepoint alone, and
+the error (StaleMatch, IntegrityError) reaches the request, which matches
+again as before. Every request of the batch gets its result or error only
+after the commit, so a response never reports a write that is not durable,
+and a retry reads what the batch committed. When the queue holds
+`max_pending` requests submit() blocks, which slows requests down instead of
+letting the backlog grow. stop() writes out everything queued before
+returning. A batch whose commit fails fails all of its requests. Writes run
+in their request's context, so their statements count towards its DB time
+(common.timing); the commit itself is shared and counted in stats().
+"""
+import asyncio
+import contextvars
+import time
+
+
+class GroupCommit:
+
+    def __init__(self, engine, max_batch=256, window=0.0, max_pending=1024):
+        self.engine = engine  # AsyncEngine
+        self.max_batch = max_batch
+        self.window = window
+        self.queue = asyncio.Queue(max_pending)
+        self.task = None
+        self.batches = 0
+        self.writes = 0
+        self.rolled_back = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.commit_seconds = 0.0
+        self.commit_seconds_max = 0.0
+
+    @property
+    def enabled(self):
+        return self.max_batch > 1
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self._run())
+
+    async def submit(self, write):
+        """
+        Run `write(conn)`, an async callable taking an AsyncConnection, in the
+        next group transaction; its result once that has committed. Runs in a
+        transaction of its own if the writer isn't running.
+        """
+        if not self.running:
+            async with self.engine.begin() as conn:
+                return await write(conn)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((write, contextvars.copy_context(), future))
+        # cancelling the request cancels the future; the writer then skips it
+        return await future
+
+    async def stop(self):
+        """Write out the queue and stop the writer."""
+        if not self.running:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _run(self):
+        # its own connection, so the writer never waits on a pool the queued requests have drained
+        async with self.engine.connect() as conn:
+            while True:
+                batch = [await self.queue.get()]
+                if self.window and self.queue.qsize() < self.max_batch - 1:
+                    await asyncio.sleep(self.window)
+                while len(batch) < self.max_batch and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                try:
+                    await self._commit(conn, batch)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+
+    async def _commit(self, conn, batch):
+        self.in_flight = len(batch)
+        outcomes = []
+        start = time.perf_counter()
+        try:
+            async with conn.begin():
+                # pysqlite would only BEGIN at the first INSERT, and a SAVEPOINT
+                # outside a transaction commits on release
+                await conn.exec_driver_sql("BEGIN IMMEDIATE")
+                for write, context, future in batch:
+                    if future.done():
+                        continue
+                    try:
+                        async with conn.begin_nested():
+                            result = await asyncio.create_task(write(conn), context=context)
+                        outcomes.append((future, result, None))
+                    except Exception as error:
+                        self.rolled_back += 1
+                        outcomes.append((future, None, error))
+        except Exception as error:
+            self.failures += 1
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        finally:
+            self.in_flight = 0
+        elapsed = time.perf_counter() - start
+        self.batches += 1
+        self.writes += len(outcomes)
+        self.commit_seconds += elapsed
+        self.commit_seconds_max = max(self.commit_seconds_max, elapsed)
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        return {"depth": self.queue.qsize() + self.in_flight, "batches": self.batches, "writes": self.writes,
+                "rolled_back": self.rolled_back, "failures": self.failures,
+                "commit_seconds_total": self.commit_seconds, "commit_seconds_max": self.commit_seconds_max}
@@ -0,0 +1,294 @@
+"""
+Idempotency-Key support: a POST carrying the header runs once, and retries
+with the same key get the recorded response back without reaching the app.
+
+The store keeps one record per (path, key): a digest of the request body,
+and once the first request has finished its status, headers and body.
+Records live for `ttl` seconds, and at most `maxsize` are kept, oldest
+dropped first. A retry with a different body is refused with 422. A retry
+that arrives while the first request is still running waits for it, up to
+`wait` seconds, and is answered 409 if it is still running then. Responses
+with a 5xx status, or requests that raise, are not recorded: the record is
+dropped and the next retry runs again.
+
+IdempotencyASGIMiddleware and IdempotencyWSGIMiddleware wrap the apps inside
+the metrics middleware, so replays are counted under the route they replay.
+Like the other caches the store is per process: with several workers, a
+retry that lands on another worker runs again.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from common.metrics import ROUTE_KEY
+from common.timing import timed
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+# describe the request that produced a response, not the replay
+PER_REQUEST_HEADERS = frozenset({"server-timing", "date"})
+
+StoredResponse = namedtuple("StoredResponse", ["status", "headers", "body", "route"])
+
+
+class Record:
+    """One key: the body digest, and the response once the first request has finished."""
+
+    __slots__ = ("fingerprint", "expires", "done", "response")
+
+    def __init__(self, fingerprint, expires, done):
+        self.fingerprint = fingerprint
+        self.expires = expires
+        self.done = done
+        self.response = None
+
+
+class IdempotencyStore:
+    """
+    Records by (path, key). `event_type` is what a waiting retry blocks on:
+    threading.Event for threaded servers, asyncio.Event on an event loop.
+    """
+
+    def __init__(self, maxsize, ttl, event_type=threading.Event):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.event_type = event_type
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.replayed = 0
+        self.waited = 0
+        self.mismatched = 0
+        self.abandoned = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def begin(self, key, fingerprint):
+        """(record, True) when the caller runs the request and must finish() or abandon() it, else (record, False)."""
+        now = time.monotonic()
+        with self.lock:
+            # records are never refreshed, so the oldest expires first
+            while self.entries:
+                oldest = next(iter(self.entries.values()))
+                if oldest.expires > now:
+                    break
+                self.entries.popitem(last=False)
+            record = self.entries.get(key)
+            if record is not None:
+                if record.fingerprint != fingerprint:
+                    self.mismatched += 1
+                elif record.response is None:
+                    self.waited += 1
+                else:
+                    self.replayed += 1
+                return record, False
+            record = self.entries[key] = Record(fingerprint, now + self.ttl, self.event_type())
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return record, True
+
+    def finish(self, record, response):
+        """Record the first request's response and release the retries waiting on it."""
+        record.response = response
+        with self.lock:
+            self.recorded += 1
+        record.done.set()
+
+    def abandon(self, key, record):
+        """Drop a record whose request failed, so the next retry runs again."""
+        with self.lock:
+            if self.entries.get(key) is record:
+                del self.entries[key]
+            self.abandoned += 1
+        record.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "maxsize": self.maxsize, "recorded": self.recorded,
+                    "replayed": self.replayed, "waited": self.waited, "mismatched": self.mismatched,
+                    "abandoned": self.abandoned, "evictions": self.evictions}
+
+
+def replayable(headers):
+    """Copy of a response's headers without the per-request ones; names may be str or bytes."""
+    return [(name, value) for name, value in headers
+            if (name.decode("latin-1") if isinstance(name, bytes) else name).lower() not in PER_REQUEST_HEADERS]
+
+
+def fingerprint(body):
+    return hashlib.blake2b(body, digest_size=16).digest()
+
+
+def error_body(key, message):
+    return json.dumps({key: message}).encode()
+
+
+class IdempotencyASGIMiddleware:
+
+    def __init__(self, app, store, paths, wait):
+        self.app = app
+        self.store = store
+        self.paths = frozenset(paths)
+        self.wait = wait
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths
+                or not self.store.enabled):
+            return await self.app(scope, receive, send)
+        key = dict(scope["headers"]).get(HEADER.lower().encode())
+        if key is None:
+            return await self.app(scope, receive, send)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return await self.respond(send, 400, f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters")
+
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(chunks)
+        store_key = (scope["path"], key)
+        digest = fingerprint(body)
+
+        while True:
+            record, owner = self.store.begin(store_key, digest)
+            if owner:
+                break
+            if record.fingerprint != digest:
+                return await self.respond(send, 422, f"{HEADER} was already used with a different request body")
+            if record.response is None:
+                try:
+                    with timed("queue"):
+                        await asyncio.wait_for(record.done.wait(), self.wait)
+                except asyncio.TimeoutError:
+                    return await self.respond(send, 409, "a request with this Idempotency-Key is still in progress")
+            if record.response is not None:
+                return await self.replay(scope, send, record.response)
+            # the first request failed; this one runs it again
+
+        replayed = False
+
+        async def receive_body():
+            nonlocal replayed
+            if replayed:
+                return await receive()
+            replayed = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        status, headers, parts = None, None, []
+
+        async def send_wrapper(message):
+            nonlocal status, headers
+            if message["type"] == "http.response.start":
+                # copied now: the metrics middleware adds its headers to this message
+                status, headers = message["status"], replayable(message.get("headers", ()))
+            elif message["type"] == "http.response.body":
+                parts.append(message.get("body", b""))
+                if not message.get("more_body") and status < 500:
+                    route = scope.get("route")
+                    self.store.finish(record, StoredResponse(status, headers, b"".join(parts), route))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body, send_wrapper)
+        finally:
+            if record.response is None:
+                self.store.abandon(store_key, record)
+
+    async def replay(self, scope, send, response):
+        if response.route is not None:
+            scope["route"] = response.route
+        await send({"type": "http.response.start", "status": response.status,
+                    "headers": [*response.headers, (REPLAYED_HEADER.lower().encode(), b"true")]})
+        await send({"type": "http.response.body", "body": response.body})
+
+    async def respond(self, send, status, message):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": error_body("detail", message)})
+
+
+class IdempotencyWSGIMiddleware:
+
+    def __init__(self, app, store, paths, wait):
+        self.app = app
+        self.store = store
+        self.paths = frozenset(paths)
+        self.wait = wait
+
+    def __call__(self, environ, start_response):
+        if (environ["REQUEST_METHOD"] != "POST" or environ.get("PATH_INFO") not in self.paths
+                or not self.store.enabled):
+            return self.app(environ, start_response)
+        key = environ.get("HTTP_" + HEADER.upper().replace("-", "_"))
+        if key is None:
+            return self.app(environ, start_response)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return self.respond(start_response, "400 BAD REQUEST",
+                                f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters")
+
+        body = environ["wsgi.input"].read(int(environ.get("CONTENT_LENGTH") or 0))
+        environ["wsgi.input"] = io.BytesIO(body)
+        store_key = (environ["PATH_INFO"], key)
+        digest = fingerprint(body)
+
+        while True:
+            record, owner = self.store.begin(store_key, digest)
+            if owner:
+                break
+            if record.fingerprint != digest:
+                return self.respond(start_response, "422 UNPROCESSABLE ENTITY",
+                                    f"{HEADER} was already used with a different request body")
+            if record.response is None:
+                with timed("queue"):
+                    done = record.done.wait(self.wait)
+                if not done:
+                    return self.respond(start_response, "409 CONFLICT",
+                                        "a request with this Idempotency-Key is still in progress")
+            if record.response is not None:
+                return self.replay(environ, start_response, record.response)
+
+        status = []
+
+        def start_response_wrapper(status_line, headers, exc_info=None):
+            # copied before an outer middleware can add its headers
+            status[:] = [status_line, replayable(headers)]
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            result = self.app(environ, start_response_wrapper)
+            try:
+                parts = list(result)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+            status_line, headers = status
+            if int(status_line.split(" ", 1)[0]) < 500:
+                self.store.finish(record, StoredResponse(status_line, headers, b"".join(parts),
+                                                         environ.get(ROUTE_KEY)))
+        finally:
+            if record.response is None:
+                self.store.abandon(store_key, record)
+        return parts
+
+    def replay(self, environ, start_response, response):
+        if response.route is not None:
+            environ[ROUTE_KEY] = response.route
+        start_response(response.status, [*response.headers, (REPLAYED_HEADER, "true")])
+        return [response.body]
+
+    def respond(self, start_response, status_line, message):
+        start_response(status_line, [("Content-Type", "application/json")])
+        return [error_body("message", message)]
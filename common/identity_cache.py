@@ -0,0 +1,105 @@
+"""
+In-process index of opt-in rows keyed by email and by phonenumber.
+
+POST /contacts only needs (matm_owner, username, contact_id) of the existing
+opt-in rows sharing the incoming email/phone. The cache keeps those tuples per
+key, in insertion (id) order, bounded by an LRU. Empty results are cached as
+well, so first-time inserts are served from memory too.
+
+Committed opt-in rows are written through with add(). A key that is not
+cached is left alone, because the cache can't know the key's other rows. A
+row whose (matm_owner, username) the key already holds is skipped: the
+insert was one ON CONFLICT DO NOTHING dropped, and matching only ever looks
+at the first such row anyway. The
+cache is per process: with several worker processes, or anything else writing
+to the database, run with IDENTITY_CACHE_SIZE=0.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+IdentityRow = namedtuple("IdentityRow", ["matm_owner", "username", "contact_id"])
+
+
+class IdentityCache:
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # keys with a database read in flight, and those written meanwhile
+        self.loading = {}
+        self.stale = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    def get(self, field, value):
+        """Cached rows for `field == value`, or None if the caller must read and fill()."""
+        if not self.enabled:
+            return None
+        key = (field, value)
+        with self.lock:
+            rows = self.entries.get(key)
+            if rows is None:
+                self.misses += 1
+                self.loading[key] = self.loading.get(key, 0) + 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return rows
+
+    def fill(self, field, value, rows):
+        """Store rows read from the database after get() missed."""
+        if not self.enabled:
+            return
+        key = (field, value)
+        with self.lock:
+            if not self.finish_loading(key):
+                # a row was committed while we were reading; the result may miss it
+                return
+            self.entries[key] = tuple(rows)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def abandon(self, field, value):
+        """After get() missed, for a database read that failed and will not fill()."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.finish_loading((field, value))
+
+    def finish_loading(self, key):
+        """End one read of `key`; whether its rows may be stored. Called with the lock held."""
+        remaining = self.loading.pop(key, 1) - 1
+        if remaining:
+            self.loading[key] = remaining
+        if key in self.stale:
+            if not remaining:
+                self.stale.discard(key)
+            return False
+        return True
+
+    def add(self, field, value, row):
+        """Write-through for an opt-in row that has just been committed."""
+        if not self.enabled:
+            return
+        key = (field, value)
+        with self.lock:
+            rows = self.entries.get(key)
+            if rows is not None:
+                if not any(cached.matm_owner == row.matm_owner and cached.username == row.username
+                           for cached in rows):
+                    self.entries[key] = rows + (row,)
+            elif key in self.loading:
+                self.stale.add(key)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "maxsize": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,166 @@
+"""
+Individual resolution: which contacts are the same person across matm_owners.
+
+POST /contacts finds individual matches: contacts of other owners with the
+same username that share the email or phonenumber (see common.matching).
+Those links form a union-find over individual ids, persisted in the
+individual_links table as (individual_id, parent, size) rows.
+
+- A created contact with no individual match starts a new individual: a row
+  that is its own parent, with size 1.
+- A created contact with matches joins their individuals. Their roots are
+  found, the smaller sets point at the largest (union by size), and the
+  contact takes the surviving root as its individual_id.
+
+contacts.individual_id is not rewritten when sets merge later. The
+individual a contact belongs to is the root above its individual_id. Union
+by size keeps paths O(log n) long, and each lookup points the nodes it
+walked straight at their root (path compression). So an insert costs one
+recursive SELECT and a few single-row writes, amortized near constant. It
+never rescans contacts.
+
+walk_statements() / contact_walk_statement() load the paths up to the roots.
+IndividualLinks applies unions in memory and records the rows it changed,
+and link_statements() turns those into executemany writes. The walk is read
+before the write transaction, so each UPDATE only applies while the row
+still has the parent and size that were walked. A union that loses a race
+matches fewer rows and is retried (common.upsert.check_updated).
+members_statement() walks down from a root for GET /individual/{id}/contacts.
+"""
+from uuid import uuid4
+
+from sqlalchemy import bindparam, insert, select, update
+
+# individual ids per IN (...) walk, as for the bulk lookups
+WALK_CHUNK = 500
+
+
+def walk_statement(link_model, starts):
+    """
+    SELECT (individual_id, parent, size) of every link on the paths from
+    `starts` (ids, or a SELECT of ids) up to their roots.
+    """
+    links = link_model.__table__
+    walk = (select(links.c.individual_id, links.c.parent, links.c.size)
+            .where(links.c.individual_id.in_(starts)).cte("walk", recursive=True))
+    step = links.alias("step")
+    walk = walk.union(select(step.c.individual_id, step.c.parent, step.c.size)
+                      .join_from(walk, step, step.c.individual_id == walk.c.parent)
+                      .where(walk.c.individual_id != walk.c.parent))
+    return select(walk.c.individual_id, walk.c.parent, walk.c.size)
+
+
+def walk_statements(link_model, individual_ids):
+    """walk_statement() over `individual_ids` in chunks, for batches."""
+    individual_ids = list(individual_ids)
+    for start in range(0, len(individual_ids), WALK_CHUNK):
+        yield walk_statement(link_model, individual_ids[start:start + WALK_CHUNK])
+
+
+def contact_walk_statement(contact_model, link_model, contact_ids):
+    """walk_statement() from the individuals of the contacts `contact_ids`."""
+    contacts = contact_model.__table__
+    return walk_statement(link_model, select(contacts.c.individual_id)
+                          .where(contacts.c.contact_id.in_(list(contact_ids))))
+
+
+def members_statement(contact_model, link_model, root, columns=None):
+    """SELECT of `columns` (default all) of the contacts in the set under `root`, in id order."""
+    links, contacts = link_model.__table__, contact_model.__table__
+    columns = [contacts.c[name] for name in columns] if columns else list(contacts.columns)
+    tree = select(links.c.individual_id).where(links.c.individual_id == root).cte("tree", recursive=True)
+    child = links.alias("child")
+    tree = tree.union(select(child.c.individual_id)
+                      .join_from(tree, child, child.c.parent == tree.c.individual_id)
+                      .where(child.c.individual_id != child.c.parent))
+    return (select(*columns).where(contacts.c.individual_id.in_(select(tree.c.individual_id)))
+            .order_by(contacts.c.id))
+
+
+class IndividualLinks:
+    """
+    The part of the persisted union-find a request has loaded, with its own
+    unions applied in memory and the rows they changed remembered.
+    """
+
+    def __init__(self, rows=()):
+        self.parent = {}
+        self.size = {}
+        # (parent, size) of each loaded link as walked, which its UPDATE expects
+        self.walked = {}
+        self.created = {}
+        self.changed = {}
+        self.add_rows(rows)
+
+    def add_rows(self, rows):
+        """Load walk rows; links already changed in memory keep their new values."""
+        for individual_id, parent, size in rows:
+            self.parent.setdefault(individual_id, parent)
+            self.size.setdefault(individual_id, size)
+            self.walked.setdefault(individual_id, (parent, size))
+
+    def find(self, individual_id):
+        root = individual_id
+        # a path can't be longer than the links loaded, unless the links form a cycle
+        for _ in range(len(self.parent)):
+            if self.parent[root] == root:
+                break
+            root = self.parent[root]
+        else:
+            raise ValueError(f"individual_links has a cycle above {individual_id}")
+        while individual_id != root:
+            parent = self.parent[individual_id]
+            if parent != root:
+                self.parent[individual_id] = root
+                self.changed[individual_id] = True
+            individual_id = parent
+        return root
+
+    def new(self):
+        individual_id = uuid4().hex
+        self.parent[individual_id] = individual_id
+        self.size[individual_id] = 1
+        self.created[individual_id] = True
+        return individual_id
+
+    def join(self, individual_ids):
+        """Union the sets of the known `individual_ids`; the surviving root, or None if none is known."""
+        roots = {self.find(individual_id) for individual_id in individual_ids if individual_id in self.parent}
+        if not roots:
+            return None
+        # the largest set keeps its root; ties go to the larger id so every process picks the same one
+        root = max(roots, key=lambda candidate: (self.size[candidate], candidate))
+        for other in roots - {root}:
+            self.parent[other] = root
+            self.size[root] += self.size[other]
+            self.changed[other] = self.changed[root] = True
+        return root
+
+    def assign(self, individual_ids=None):
+        """
+        individual_id for a created contact matching the individuals
+        `individual_ids`, by default every loaded one (a walk from exactly
+        the contact's matches); a new individual when there are none.
+        """
+        if individual_ids is None:
+            individual_ids = list(self.parent)
+        return self.join(individual_ids) or self.new()
+
+
+def link_statements(link_model, links):
+    """(statement, rows) pairs writing the links an IndividualLinks created or changed."""
+    table = link_model.__table__
+    created = [{"individual_id": individual_id, "parent": links.parent[individual_id],
+                "size": links.size[individual_id]} for individual_id in links.created]
+    changed = [{"b_individual_id": individual_id, "b_parent": links.walked[individual_id][0],
+                "b_size": links.walked[individual_id][1], "parent": links.parent[individual_id],
+                "size": links.size[individual_id]} for individual_id in links.changed
+               if individual_id not in links.created]
+    writes = [
+        (insert(table), created),
+        # a row another request changed since the walk is left alone; see check_updated()
+        (update(table).where(table.c.individual_id == bindparam("b_individual_id"),
+                             table.c.parent == bindparam("b_parent"), table.c.size == bindparam("b_size")),
+         changed),
+    ]
+    return [(statement, rows) for statement, rows in writes if rows]
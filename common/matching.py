@@ -0,0 +1,107 @@
+"""
+matm_owner matching for POST /contacts.
+
+An existing opt-in row sharing the incoming email or phonenumber is either
+the same contact (same owner, same username), an owner conflict (same owner,
+different username) or the same individual under another owner (different
+owner, same username). Rows are looked at email rows first, then phone rows,
+each in id order; the first conflict stops the scan, and a same-contact match
+wins over an individual match.
+
+match_identities() is that rule over rows already fetched. match_statement()
+is the same rule as one SQL statement that also returns the matched contact.
+"""
+from collections import namedtuple
+from itertools import chain
+
+from sqlalchemy import Boolean, String, column, select, text
+
+MATCH_ERROR = "matching error on contact data"
+
+# contact_id of the first same-contact match, whether an owner conflict was
+# hit, contact_id of the first individual match before that conflict, and
+# every individual match before it in scan order (see common.identity_graph)
+Match = namedtuple("Match", ["contact_id", "conflict", "individual_contact_id", "individual_contact_ids"])
+
+def match_identities(email_rows, phone_rows, matm_owner, username):
+    """Classify rows with .matm_owner/.username/.contact_id against the incoming contact."""
+    matched_contacts = []
+    matched_individuals = []
+    conflict = False
+    for row in chain(email_rows, phone_rows):
+        if row.matm_owner == matm_owner and row.username == username:
+            matched_contacts.append(row.contact_id)
+        elif row.matm_owner == matm_owner and row.username != username:
+            conflict = True
+            break
+        elif row.matm_owner != matm_owner and row.username == username:
+            matched_individuals.append(row.contact_id)
+    return Match(matched_contacts[0] if matched_contacts else None, conflict,
+                 matched_individuals[0] if matched_individuals else None, tuple(matched_individuals))
+
+
+# kind 1: same contact, 2: owner conflict, 3: same individual
+MATCH_SQL = """
+WITH matches AS (
+    SELECT 0 AS src, id, contact_id,
+           CASE WHEN matm_owner = :matm_owner AND username = :username THEN 1
+                WHEN matm_owner = :matm_owner THEN 2
+                WHEN username = :username THEN 3 END AS kind
+    FROM email_opt_in WHERE email = :email
+    UNION ALL
+    SELECT 1 AS src, id, contact_id,
+           CASE WHEN matm_owner = :matm_owner AND username = :username THEN 1
+                WHEN matm_owner = :matm_owner THEN 2
+                WHEN username = :username THEN 3 END AS kind
+    FROM mobile_opt_in WHERE phonenumber = :phonenumber
+),
+ranked AS (
+    SELECT contact_id, kind, ROW_NUMBER() OVER (ORDER BY src, id) AS pos
+    FROM matches WHERE kind IS NOT NULL
+),
+cut AS (
+    SELECT MIN(pos) AS conflict_pos FROM ranked WHERE kind = 2
+),
+firsts AS (
+    SELECT
+        (SELECT conflict_pos IS NOT NULL FROM cut) AS conflict,
+        (SELECT contact_id FROM ranked, cut WHERE kind = 1 AND (conflict_pos IS NULL OR pos < conflict_pos)
+         ORDER BY pos LIMIT 1) AS contact_id,
+        (SELECT contact_id FROM ranked, cut WHERE kind = 3 AND (conflict_pos IS NULL OR pos < conflict_pos)
+         ORDER BY pos LIMIT 1) AS individual_contact_id,
+        (SELECT group_concat(contact_id) FROM (
+            SELECT contact_id FROM ranked, cut WHERE kind = 3 AND (conflict_pos IS NULL OR pos < conflict_pos)
+            ORDER BY pos)) AS individual_contact_ids
+)
+SELECT {columns}, firsts.conflict, firsts.contact_id AS match_contact_id, firsts.individual_contact_id,
+       firsts.individual_contact_ids
+FROM firsts LEFT JOIN contacts ON contacts.contact_id = COALESCE(firsts.contact_id, firsts.individual_contact_id)
+LIMIT 1
+"""
+
+
+def match_statement(contact_model):
+    """
+    ORM statement returning one (Contact or None, conflict, match_contact_id,
+    individual_contact_id, individual_contact_ids) row.
+
+    The Contact is the matched one (same contact, else same individual), loaded
+    in the same round trip so the update path needs no further SELECT; it is
+    None if no contacts row carries the matched contact_id. Bind email,
+    phonenumber, matm_owner and username when executing.
+    """
+    table = contact_model.__table__
+    textual = text(MATCH_SQL.format(columns=", ".join(f"contacts.{c.name}" for c in table.columns))).columns(
+        *table.columns, column("conflict", Boolean), column("match_contact_id", String),
+        column("individual_contact_id", String), column("individual_contact_ids", String))
+    selected = textual.selected_columns
+    return select(contact_model, selected.conflict, selected.match_contact_id,
+                  selected.individual_contact_id, selected.individual_contact_ids).from_statement(textual)
+
+
+def match_from_row(row):
+    """Turn a match_statement() row into the Match match_identities() returns."""
+    _, conflict, contact_id, individual_contact_id, individual_contact_ids = row
+    # contact_ids are hex, so the comma separated list splits cleanly
+    return Match(contact_id, bool(conflict), individual_contact_id,
+                 tuple(individual_contact_ids.split(",")) if individual_contact_ids else ())
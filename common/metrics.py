@@ -0,0 +1,204 @@
+"""
+Request metrics for the apps, exposed in Prometheus text format on /metrics.
+
+Per route template (not raw path, so the label set stays bounded) this keeps
+a latency histogram, an in-flight gauge and a counter per status code.
+MetricsASGIMiddleware and MetricsWSGIMiddleware wrap the apps directly, with
+no per-request objects beyond a closure and the request's timings, and time a request until its body
+has been sent, streamed exports included. Nothing is printed.
+
+The route template is read from the scope (FastAPI sets scope["route"]) or
+from the WSGI environ under ROUTE_KEY, which the flask app fills in.
+
+The middlewares also open the request's common.timing context, add its
+Server-Timing header to the response, and count statements, DB time, time
+per phase and query budget overruns per route.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from common.timing import PHASES, begin_request, end_request
+
+# upper bounds in seconds, Prometheus' defaults plus a finer low end
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+ROUTE_KEY = "metrics.route"
+UNMATCHED = "unmatched"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metrics:
+
+    def __init__(self, app_name):
+        self.app_name = app_name
+        self.lock = threading.Lock()
+        self.histograms = {}  # (method, route) -> [bucket counts..., +Inf count, sum]
+        self.in_flight = {}  # method -> requests being served
+        self.statuses = {}  # (method, route, status) -> count
+        self.db = {}  # (method, route) -> [statements, DB seconds, over budget, *phase seconds]
+        self.gauges = []  # (prefix, callable returning {name: value})
+
+    def started(self, method):
+        with self.lock:
+            self.in_flight[method] = self.in_flight.get(method, 0) + 1
+
+    def finished(self, method, route, status, elapsed, timings=None):
+        index = bisect_left(BUCKETS, elapsed)
+        with self.lock:
+            if timings is not None:
+                db = self.db.get((method, route))
+                if db is None:
+                    db = self.db[(method, route)] = [0, 0.0, 0] + [0.0] * len(PHASES)
+                db[0] += timings.queries
+                db[1] += timings.db
+                db[2] += timings.over_budget
+                for i, phase in enumerate(PHASES, 3):
+                    db[i] += timings.phases[phase]
+            self.in_flight[method] -= 1
+            histogram = self.histograms.get((method, route))
+            if histogram is None:
+                histogram = self.histograms[(method, route)] = [0] * (len(BUCKETS) + 2)
+            histogram[index] += 1
+            histogram[-1] += elapsed
+            key = (method, route, status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def add_gauges(self, prefix, stats):
+        """Export the numbers returned by `stats()` as <prefix>_<name> gauges."""
+        self.gauges.append((prefix, stats))
+
+    def render(self):
+        label = f'app="{self.app_name}"'
+        with self.lock:
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+            in_flight = dict(self.in_flight)
+            statuses = dict(self.statuses)
+            db = {key: list(value) for key, value in self.db.items()}
+        lines = ["# HELP http_request_duration_seconds Time from request start to the end of the response body.",
+                 "# TYPE http_request_duration_seconds histogram"]
+        for (method, route), histogram in sorted(histograms.items()):
+            labels = f'{label},method="{method}",route="{_escape(route)}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"http_request_duration_seconds_sum{{{labels}}} {histogram[-1]}")
+            lines.append(f"http_request_duration_seconds_count{{{labels}}} {cumulative}")
+        lines += ["# HELP http_requests_in_flight Requests being served.",
+                  "# TYPE http_requests_in_flight gauge"]
+        for method, count in sorted(in_flight.items()):
+            lines.append(f'http_requests_in_flight{{{label},method="{method}"}} {count}')
+        lines += ["# HELP http_responses_total Responses by status code.",
+                  "# TYPE http_responses_total counter"]
+        for (method, route, status), count in sorted(statuses.items()):
+            lines.append(f'http_responses_total{{{label},method="{method}",route="{_escape(route)}",'
+                         f'status="{status}"}} {count}')
+        for name, index, help_text in (
+                ("db_statements_total", 0, "SQL statements run by requests."),
+                ("db_seconds_total", 1, "Time requests spent in SQL statements."),
+                ("db_query_budget_exceeded_total", 2, "Requests that ran more statements than QUERY_BUDGET.")):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (method, route), values in sorted(db.items()):
+                lines.append(f'{name}{{{label},method="{method}",route="{_escape(route)}"}} {values[index]}')
+        lines += ["# HELP request_phase_seconds_total Time requests spent validating and serializing.",
+                  "# TYPE request_phase_seconds_total counter"]
+        for (method, route), values in sorted(db.items()):
+            for phase, seconds in zip(PHASES, values[3:]):
+                lines.append(f'request_phase_seconds_total{{{label},method="{method}",route="{_escape(route)}",'
+                             f'phase="{phase}"}} {seconds}')
+        for prefix, stats in self.gauges:
+            for name, value in stats().items():
+                lines += [f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name}{{{label}}} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class MetricsASGIMiddleware:
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method = scope["method"]
+        status = 500
+        start = time.perf_counter()
+        timings = begin_request()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", ()), (b"server-timing", timings.header().encode())]
+            await send(message)
+
+        self.metrics.started(method)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            end_request(timings)
+            route = scope.get("route")
+            self.metrics.finished(method, route.path if route is not None else UNMATCHED, status,
+                                  time.perf_counter() - start, timings)
+
+
+class MetricsWSGIMiddleware:
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        status = [500]
+        start = time.perf_counter()
+        timings = begin_request()
+
+        def start_response_wrapper(status_line, headers, exc_info=None):
+            status[0] = int(status_line.split(" ", 1)[0])
+            return start_response(status_line, [*headers, ("Server-Timing", timings.header())], exc_info)
+
+        def finish():
+            end_request(timings)
+            self.metrics.finished(method, environ.get(ROUTE_KEY, UNMATCHED), status[0],
+                                  time.perf_counter() - start, timings)
+
+        self.metrics.started(method)
+        try:
+            body = self.app(environ, start_response_wrapper)
+        except BaseException:
+            finish()
+            raise
+        return ClosingIterator(body, finish)
+
+
+class ClosingIterator:
+    """Response body that reports once the server has sent it: when exhausted, or on close() if that comes first."""
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.reported = False
+
+    def __iter__(self):
+        yield from self.body
+        self.report()
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.report()
+
+    def report(self):
+        if not self.reported:
+            self.reported = True
+            self.on_close()
@@ -0,0 +1,47 @@
+"""
+Keyset pagination on `id` for the list endpoints.
+
+Every app takes `limit` and `after` query parameters and answers
+{<key>: [...], "next_cursor": <id or null>}. A page is the first `limit` rows
+with id > after, read through the primary key, so a page costs the same at
+any depth. Pass next_cursor back as `after` to get the next page; it is null
+on the last one. `limit` is capped at MAX_PAGE_SIZE.
+
+Pages are read as plain Core rows of the listed columns and turned straight
+into dicts, with no ORM instances or per-object encoder in between.
+"""
+import os
+
+from sqlalchemy import select
+
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000))
+
+
+def page_size(limit):
+    """Requested limit, defaulted and capped at MAX_PAGE_SIZE."""
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def column_names(model):
+    return [column.name for column in model.__table__.columns]
+
+
+def page_statement(model, limit, after, columns):
+    """
+    SELECT of the cursor id and `columns` for one page plus one row, which
+    tells whether another page follows.
+    """
+    table = model.__table__
+    return (select(table.c.id.label("cursor"), *(table.c[name] for name in columns))
+            .where(table.c.id > (after or 0)).order_by(table.c.id).limit(limit + 1))
+
+
+def page(key, rows, limit, columns):
+    """Response body for a page from rows fetched with page_statement()."""
+    rows = list(rows)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return {key: [dict(zip(columns, row[1:])) for row in rows], "next_cursor": rows[-1][0] if more else None}
@@ -0,0 +1,91 @@
+"""
+In-process cache of encoded GET responses, validated by per-table write
+versions, with strong ETags for conditional GETs.
+
+Every write path calls bump() with the tables it committed to. A cached body
+remembers the versions of the tables it was read from and is served only
+while they are unchanged. lookup() hands out the current versions before the
+caller reads the database, and store() files the body under those, so a write
+that commits while the page is being built leaves the entry already stale.
+
+Bodies are kept in an LRU bounded by their total size in bytes. With a size
+of 0 nothing is stored, but ETags and 304s still work. Like the identity
+cache this is per process: with several workers, or anything else writing to
+the database, run with RESPONSE_CACHE_BYTES=0.
+"""
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+CachedResponse = namedtuple("CachedResponse", ["etag", "body", "versions"])
+
+
+def make_etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against `etag`, as GET uses."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = (tag.strip() for tag in if_none_match.split(","))
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+class ResponseCache:
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.maxbytes > 0
+
+    def bump(self, *tables):
+        """Invalidate everything read from `tables`; call after their writes commit."""
+        with self.lock:
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+
+    def lookup(self, key, tables):
+        """(cached response or None, versions to store() a freshly built body under)."""
+        with self.lock:
+            versions = tuple(self.versions.get(table, 0) for table in tables)
+            entry = self.entries.get(key)
+            if entry is not None and entry.versions == versions:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry, versions
+            self.misses += 1
+            return None, versions
+
+    def store(self, key, versions, body):
+        """Wrap a built body with its ETag, and keep it if it fits."""
+        entry = CachedResponse(make_etag(body), body, versions)
+        if not self.enabled or len(body) > self.maxbytes:
+            return entry
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.body)
+            self.entries[key] = entry
+            self.size += len(body)
+            while self.size > self.maxbytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                self.evictions += 1
+        return entry
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "maxbytes": self.maxbytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,25 @@
+"""
+JSON encoding for the read endpoints.
+
+Uses orjson when it is installed and falls back to the standard library
+otherwise. Both produce compact UTF-8 bytes ready to be sent as the body.
+The time spent counts as the request's serialization phase.
+"""
+import json
+
+from common.timing import timed
+
+try:
+    import orjson
+except ImportError:  # optional
+    orjson = None
+
+JSON_MEDIA_TYPE = "application/json"
+
+
+def dumps(obj):
+    """Compact JSON for `obj` as bytes."""
+    with timed("serialization"):
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj, separators=(",", ":")).encode()
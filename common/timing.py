@@ -0,0 +1,163 @@
+"""
+Per-request breakdown of where the time goes, sent as a Server-Timing header.
+
+The metrics middlewares open a RequestTimings for every request in a context
+variable. instrument_engine() hooks SQLAlchemy's cursor events to count the
+statements a request runs and add up their time, wherever they run: in the
+handler, in tasks it spawned, or in a worker thread. Code that parses and
+validates the body or serializes the response wraps the work in
+timed("validation") / timed("serialization"), and waits for a turn are
+timed("queue"): the admission queue, a retry waiting on its Idempotency-Key,
+and for FastAPI's def endpoints the worker thread pool (timed_endpoint()).
+TimedRoute also counts FastAPI's response encoding after the endpoint as
+serialization. What no phase covers (routing, dependencies such as the
+session, reading the body) only shows in total.
+
+The header looks like
+
+    Server-Timing: db;dur=3.1;desc="5 queries", queue;dur=0.0, validation;dur=0.4,
+                   serialization;dur=0.2, total;dur=5.0
+
+and db-budget;desc="9>6" is added when a request runs more than
+QUERY_BUDGET statements. The same numbers go to /metrics.
+"""
+import contextvars
+import functools
+import inspect
+import os
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+try:
+    from starlette.concurrency import run_in_threadpool
+except ImportError:  # only the FastAPI apps time endpoints
+    run_in_threadpool = None
+
+# statements a single request may run before it is flagged
+QUERY_BUDGET = int(os.environ.get("QUERY_BUDGET", 6))
+
+PHASES = ("queue", "validation", "serialization")
+
+_current = contextvars.ContextVar("request_timings", default=None)
+
+
+class RequestTimings:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.handler_start = None
+        self.handler_end = None
+
+    @property
+    def over_budget(self):
+        return self.queries > QUERY_BUDGET
+
+    def header(self):
+        """Server-Timing value as of now, durations in milliseconds."""
+        total = time.perf_counter() - self.start
+        phases = dict(self.phases)
+        if self.handler_end is not None:
+            phases["serialization"] += time.perf_counter() - self.handler_end
+        parts = [f'db;dur={self.db * 1000:.3f};desc="{self.queries} queries"']
+        parts += [f"{name};dur={seconds * 1000:.3f}" for name, seconds in phases.items()]
+        parts.append(f"total;dur={total * 1000:.3f}")
+        if self.over_budget:
+            parts.append(f'db-budget;desc="{self.queries}>{QUERY_BUDGET}"')
+        return ", ".join(parts)
+
+
+def begin_request():
+    """Start timing a request in the current context; returns its RequestTimings."""
+    timings = RequestTimings()
+    timings.token = _current.set(timings)
+    return timings
+
+
+def end_request(timings):
+    _current.reset(timings.token)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to `phase` of the current request, if any."""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.phases[phase] += time.perf_counter() - start
+
+
+def instrument_engine(engine):
+    """Count statements and DB time per request on `engine` (sync, or an AsyncEngine)."""
+    engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        timings = _current.get()
+        if timings is not None:
+            timings.queries += 1
+            timings.db += elapsed
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+def timed_endpoint(endpoint):
+    """
+    Wrap a FastAPI endpoint so the time after it counts as serialization. A
+    def endpoint is handed to the thread pool here rather than by FastAPI, so
+    the wait for a free thread counts as queue.
+    """
+    def started():
+        timings = _current.get()
+        if timings is not None:
+            timings.handler_start = time.perf_counter()
+        return timings
+
+    def finished(timings):
+        if timings is not None:
+            timings.handler_end = time.perf_counter()
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            timings = started()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                finished(timings)
+    else:
+        def call(queued, args, kwargs):
+            timings = started()
+            if timings is not None:
+                timings.phases["queue"] += timings.handler_start - queued
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                finished(timings)
+
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            return await run_in_threadpool(call, time.perf_counter(), args, kwargs)
+    return wrapper
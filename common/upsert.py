@@ -0,0 +1,85 @@
+"""
+Write side of POST /contacts: one transaction, guarded by unique indexes.
+
+Opt-in rows are unique on (value, matm_owner, username), the key a match
+looks them up by, and contacts on contact_id. Opt-in rows are written with
+INSERT ... ON CONFLICT DO NOTHING in the same transaction as the contact, so
+a POST commits once.
+
+The match is read before the write transaction takes SQLite's write lock, so
+two requests for the same new contact can both decide to create it. The
+second one's opt-in insert then finds the first one's row and writes
+nothing. It raises StaleMatch, rolls back, and matches again; the retry sees
+the stored contact and updates it. An update that writes opt-in rows the
+contact already has just skips them. A contact_id collision fails the
+contact insert with an IntegrityError and is retried with a new id.
+
+The unique indexes replace non-unique lookup indexes on the same columns.
+create_index() drops those once the unique index is built. A database whose
+rows already break uniqueness keeps them instead, so the lookups stay
+indexed and only the guarantee is missing.
+
+Individual links are updated only while they still hold the values that
+were read (common/identity_graph.py); check_updated() raises StaleMatch
+when one of them changed in between.
+"""
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError
+
+# a POST matches at most this many times; the last attempt writes what it decided
+WRITE_ATTEMPTS = 2
+
+
+# the non-unique index each unique one replaced, by name
+SUPERSEDED_INDEXES = {
+    "uq_contacts_contact_id": "ix_contacts_contact_id",
+    "uq_email_opt_in_email_owner_user": "ix_email_opt_in_email_owner_user",
+    "uq_mobile_opt_in_phone_owner_user": "ix_mobile_opt_in_phone_owner_user",
+}
+
+
+class StaleMatch(Exception):
+    """A concurrent request stored the contact after this one was matched."""
+
+
+def opt_in_insert(model):
+    """INSERT of opt-in rows that skips any whose (value, matm_owner, username) is already stored."""
+    return insert(model.__table__).on_conflict_do_nothing()
+
+
+def create_index(conn, index):
+    """
+    Create `index` if it is missing. For a unique index, drop the lookup
+    index it supersedes, or keep one when stored duplicates prevent it.
+    """
+    superseded = SUPERSEDED_INDEXES.get(index.name)
+    try:
+        index.create(conn, checkfirst=True)
+    except IntegrityError as error:
+        # rows stored before the index was unique; writes work, without the guarantee
+        print(f"cannot create {index.name}: {error.orig}")
+        if superseded:
+            columns = ", ".join(column.name for column in index.columns)
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {superseded} ON {index.table.name} ({columns})"))
+        return
+    if superseded:
+        conn.execute(text(f"DROP INDEX IF EXISTS {superseded}"))
+
+
+def check_updated(statement, rows, result):
+    """
+    After an executemany of `rows`: raise StaleMatch when it was an UPDATE
+    and matched fewer rows, i.e. a row changed since it was read.
+    """
+    if statement.is_update and result.rowcount < len(rows):
+        raise StaleMatch()
+
+
+def check_created(result, final):
+    """
+    After inserting a new contact's opt-in row: raise StaleMatch when the row
+    was already there and another attempt is left.
+    """
+    if result.rowcount == 0 and not final:
+        raise StaleMatch()
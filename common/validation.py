@@ -0,0 +1,141 @@
+"""
+Fast decode-and-validate path for POST /contacts.
+
+ContactParser turns a JSON body (or an already decoded row) straight into a
+slotted ContactRecord using precompiled checks: exact JSON types, the
+username and phonenumber rules of ContactBase / ContactSchema, and an email
+pattern that is a strict subset of what both email-validator (pydantic's
+EmailStr) and marshmallow's Email accept, leaving the address unchanged.
+
+The fast path only says yes. Anything it does not accept as-is (a number sent
+as a string, an unusual but valid address, unknown fields for flask, and
+every invalid contact) gets None, and the caller runs the framework's own
+validator. Accepted values and error responses therefore stay exactly what
+they were; the common case just skips the framework.
+"""
+import email.message
+import json
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:  # optional
+    orjson = None
+
+# the ContactBase fields, in declaration order
+CONTACT_FIELDS = ("username", "email", "phonenumber", "email_opt_in_status", "sms_opt_in_status",
+                  "country", "state", "matm_owner")
+
+# dot-atom local part and lowercase hostname, ASCII only
+EMAIL_PATTERN = re.compile(r"[A-Za-z0-9_+-]+(?:\.[A-Za-z0-9_+-]+)*"
+                           r"@(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+([a-z]{2,6})")
+
+# special-use TLDs email-validator rejects
+SPECIAL_USE_TLDS = frozenset(("arpa", "invalid", "local", "localhost", "onion", "test", "internal", "example"))
+
+
+@dataclass(slots=True)
+class ContactRecord:
+    username: str
+    email: str
+    phonenumber: int
+    email_opt_in_status: bool
+    sms_opt_in_status: bool
+    country: Optional[str]
+    state: Optional[str]
+    matm_owner: str
+    # only flask reads these from the body
+    individual_id: Optional[str] = None
+    status: Optional[str] = None
+    contact_id: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(*(data.get(name) for name in cls.__slots__))
+
+    def contact_fields(self):
+        """The ContactBase fields as a dict."""
+        return {name: getattr(self, name) for name in CONTACT_FIELDS}
+
+
+def json_content_type(value):
+    """Whether FastAPI decodes a body with this Content-Type as JSON (application/json or */*+json)."""
+    if not value:
+        return False
+    message = email.message.Message()
+    message["content-type"] = value
+    if message.get_content_maintype() != "application":
+        return False
+    subtype = message.get_content_subtype()
+    return subtype == "json" or subtype.endswith("+json")
+
+
+def loads(body):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+class ContactParser:
+    """
+    `optional` maps each optional field to (key required, None allowed);
+    with `allow_unknown` other keys are ignored instead of rejected.
+    """
+
+    def __init__(self, optional, allow_unknown):
+        self.optional = dict(optional)
+        self.allow_unknown = allow_unknown
+        self.known = frozenset(CONTACT_FIELDS) | frozenset(self.optional)
+
+    def parse(self, body):
+        """ContactRecord for a JSON body the fast path accepts, else None."""
+        try:
+            data = loads(body)
+        except ValueError:
+            return None
+        return self.check(data)
+
+    def check(self, data):
+        """ContactRecord for a decoded row the fast path accepts, else None."""
+        if type(data) is not dict:
+            return None
+        try:
+            username = data["username"]
+            email = data["email"]
+            phonenumber = data["phonenumber"]
+            email_opt_in_status = data["email_opt_in_status"]
+            sms_opt_in_status = data["sms_opt_in_status"]
+            matm_owner = data["matm_owner"]
+        except KeyError:
+            return None
+        if (type(username) is not str or len(username) < 3
+                or type(phonenumber) is not int or not 1_000_000_000 <= phonenumber <= 9_999_999_999
+                or type(email_opt_in_status) is not bool or type(sms_opt_in_status) is not bool
+                or type(matm_owner) is not str or not self.valid_email(email)):
+            return None
+        if not self.allow_unknown and not self.known.issuperset(data):
+            return None
+        values = {}
+        for name, (required, nullable) in self.optional.items():
+            value = data.get(name)
+            if name not in data:
+                if required:
+                    return None
+            elif not (type(value) is str or (value is None and nullable)):
+                return None
+            values[name] = value
+        return ContactRecord(username, email, phonenumber, email_opt_in_status, sms_opt_in_status,
+                             values.get("country"), values.get("state"), matm_owner,
+                             values.get("individual_id"), values.get("status"), values.get("contact_id"))
+
+    @staticmethod
+    def valid_email(email):
+        if type(email) is not str or len(email) > 254:
+            return False
+        match = EMAIL_PATTERN.fullmatch(email)
+        at = email.find("@")
+        # email-validator refuses "ab--" labels that aren't punycode; skip any "--" in the domain
+        return (match is not None and match.group(1) not in SPECIAL_USE_TLDS
+                and at <= 64 and "--" not in email[at:])
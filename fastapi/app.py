@@ -1,43 +1,110 @@
-from http.client import HTTPException
-from fastapi import BackgroundTasks, FastAPI, Request, Depends, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi import FastAPI, Request, Depends, HTTPException, Query
+import asyncio
+import json
+import os
+import sys
 import time
-from pydantic import BaseModel, EmailStr, validator
-from sqlalchemy import select
+from pydantic import BaseModel, EmailStr, ValidationError, validator
+from sqlalchemy import Index, insert, select, text, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
-from fastapi.responses import Response
-from asyncio import create_task
-import string
-from typing import Optional
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, StreamingResponse
+from fastapi.routing import APIRoute
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
 from uuid import uuid4
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.admission import AdmissionASGIMiddleware, Limiter
+from common.bulk import (BulkBodyError, add_contacts, add_rows, contact_individuals, contact_statements,
+                         lookup_statements, merge_results, new_contact_ids, parse_body, plan_batch, plan_statements,
+                         replace_taken, taken_statements)
+from common.export import Export
+from common.group_commit import GroupCommit
+from common.identity_cache import IdentityCache, IdentityRow
+from common.idempotency import IdempotencyASGIMiddleware, IdempotencyStore
+from common.identity_graph import (IndividualLinks, contact_walk_statement, link_statements, members_statement,
+                                   walk_statement, walk_statements)
+from common.matching import MATCH_ERROR, match_from_row, match_identities, match_statement
+from common.metrics import CONTENT_TYPE, Metrics, MetricsASGIMiddleware
+from common.pagination import column_names, page, page_size, page_statement
+from common.response_cache import ResponseCache, etag_matches
+from common.serialization import JSON_MEDIA_TYPE, dumps
+from common.sqlite import configure_sqlite
+from common.timing import instrument_engine, timed, timed_endpoint
+from common.upsert import (WRITE_ATTEMPTS, StaleMatch, check_created, check_updated, create_index,
+                           opt_in_insert)
+from common.validation import ContactParser, json_content_type
+
 # SQLALCHEMY 
-engine = create_async_engine("sqlite+aiosqlite:///db.sqlite3", connect_args={"check_same_thread": False})
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///db.sqlite3")
+engine = create_async_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# statement counts and DB time per request, for Server-Timing and /metrics
+instrument_engine(engine)
+# WAL and a busy timeout, so worker processes can share the file
+configure_sqlite(engine)
 
 
 SessionLocal = async_sessionmaker(engine, expire_on_commit= False)
 
-class APITimingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        start_time = time.time()  # Capture the start time
-        response = await call_next(request)
-        process_time = time.time() - start_time  # Calculate processing time
-        
-        # Log the time taken to process the request
-        print(f"Request: {request.url.path} took {process_time} seconds")
-        
-        # Optionally, add the timing information to response headers
-        response.headers['X-Process-Time'] = str(process_time)
-        
-        return response
+identity_cache = IdentityCache(int(os.environ.get("IDENTITY_CACHE_SIZE", 100_000)))
+
+# encoded GET responses, invalidated by per-table write versions
+response_cache = ResponseCache(int(os.environ.get("RESPONSE_CACHE_BYTES", 32 * 1024 * 1024)))
+
+# "python": cached per-field lookups classified in Python; "sql": one statement
+MATCH_RESOLUTION = os.environ.get("MATCH_RESOLUTION", "python")
+
+# Connections opened at startup so the first requests don't pay for them
+POOL_WARMUP_CONNECTIONS = int(os.environ.get("POOL_WARMUP_CONNECTIONS", 5))
+
+# latency histograms, in-flight gauges and status counters served on /metrics
+metrics = Metrics("fastapi")
+metrics.add_gauges("identity_cache", identity_cache.stats)
+metrics.add_gauges("response_cache", response_cache.stats)
+
+# POST /contacts retries carrying the same Idempotency-Key get the first
+# response back: IDEMPOTENCY_KEYS records kept IDEMPOTENCY_TTL seconds, and a
+# retry of a request still running waits up to IDEMPOTENCY_WAIT seconds
+IDEMPOTENCY_KEYS = int(os.environ.get("IDEMPOTENCY_KEYS", 10_000))
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 3600))
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", 30))
+idempotency_store = IdempotencyStore(IDEMPOTENCY_KEYS, IDEMPOTENCY_TTL, asyncio.Event)
+metrics.add_gauges("idempotency", idempotency_store.stats)
+
+# DB-bound requests run at most ADMISSION_READ_LIMIT GETs and
+# ADMISSION_WRITE_LIMIT writes at once (0: no limit); up to
+# ADMISSION_QUEUE_SIZE more of each wait, and a request that would wait over
+# ADMISSION_WAIT_BUDGET seconds gets 503 with Retry-After
+ADMISSION_READ_LIMIT = int(os.environ.get("ADMISSION_READ_LIMIT", 16))
+ADMISSION_WRITE_LIMIT = int(os.environ.get("ADMISSION_WRITE_LIMIT", 4))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 64))
+ADMISSION_WAIT_BUDGET = float(os.environ.get("ADMISSION_WAIT_BUDGET", 1.0))
+read_limiter = Limiter(ADMISSION_READ_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_WAIT_BUDGET, asyncio.Event)
+write_limiter = Limiter(ADMISSION_WRITE_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_WAIT_BUDGET, asyncio.Event)
+metrics.add_gauges("admission_read", read_limiter.stats)
+metrics.add_gauges("admission_write", write_limiter.stats)
+
+# the transactions of up to GROUP_COMMIT_BATCH_SIZE concurrent POST /contacts
+# commit together (1: each commits alone), after waiting up to
+# GROUP_COMMIT_WINDOW seconds for more; POSTs wait once GROUP_COMMIT_QUEUE_SIZE
+# are queued
+GROUP_COMMIT_BATCH_SIZE = int(os.environ.get("GROUP_COMMIT_BATCH_SIZE", 256))
+GROUP_COMMIT_WINDOW = float(os.environ.get("GROUP_COMMIT_WINDOW", 0.0))
+GROUP_COMMIT_QUEUE_SIZE = int(os.environ.get("GROUP_COMMIT_QUEUE_SIZE", 1024))
+group_commit = GroupCommit(engine, GROUP_COMMIT_BATCH_SIZE, GROUP_COMMIT_WINDOW, GROUP_COMMIT_QUEUE_SIZE)
+metrics.add_gauges("group_commit", group_commit.stats)
 
 class Base(DeclarativeBase):
     pass
 
 class Contact(Base):
     __tablename__ = "contacts"
+    # generated ids are short; a collision fails the insert and is retried (common/upsert.py)
+    __table_args__ = (Index("uq_contacts_contact_id", "contact_id", unique=True),)
     id: Mapped[int] = mapped_column(primary_key=True,nullable=False)
     username: Mapped[str] = mapped_column( nullable=False)
     phonenumber: Mapped[int] = mapped_column(nullable=False)
@@ -47,12 +114,17 @@ class Contact(Base):
     email_opt_in_status: Mapped[bool] = mapped_column(nullable=False)
     sms_opt_in_status: Mapped[bool] = mapped_column(nullable=False)
     matm_owner: Mapped[str] = mapped_column(nullable=False)
-    individual_id: Mapped[str] = mapped_column(nullable=True)
+    individual_id: Mapped[str] = mapped_column(nullable=True, index=True)
     status: Mapped[str] = mapped_column(nullable=True)
     contact_id: Mapped[str] = mapped_column(nullable=True)
-    
+
+# what POST /contacts writes of a contact
+CONTACT_COLUMNS = [column.key for column in Contact.__table__.columns if column.key != "id"]
+
 class ContactPointEmail(Base):
     __tablename__ = "email_opt_in"
+    # POST /contacts dedup lookup and upsert key: by email, then matm_owner/username
+    __table_args__ = (Index("uq_email_opt_in_email_owner_user", "email", "matm_owner", "username", unique=True),)
     id: Mapped[int] = mapped_column(primary_key=True,nullable=False,autoincrement=True)
     username: Mapped[str] = mapped_column(nullable=False)
     email: Mapped[str] = mapped_column(nullable=False)
@@ -63,6 +135,9 @@ class ContactPointEmail(Base):
 
 class ContactPointPhone(Base):
     __tablename__ = "mobile_opt_in"
+    # POST /contacts dedup lookup and upsert key: by phonenumber, then matm_owner/username
+    __table_args__ = (Index("uq_mobile_opt_in_phone_owner_user", "phonenumber", "matm_owner", "username",
+                            unique=True),)
     id: Mapped[int] = mapped_column(primary_key=True,nullable=False,autoincrement=True)
     username: Mapped[str] = mapped_column(nullable=False)
     phonenumber: Mapped[int] = mapped_column(nullable=False)
@@ -76,13 +151,47 @@ class Individual(Base):
     id: Mapped[int] = mapped_column(primary_key=True,nullable=False,autoincrement=True)
     username: Mapped[str] = mapped_column(nullable=False)
     individual_id: Mapped[int] = mapped_column(nullable=False)
-    
 
+class IndividualLink(Base):
+    """Union-find over individual ids, see common/identity_graph.py."""
+    __tablename__ = "individual_links"
+    individual_id: Mapped[str] = mapped_column(primary_key=True, nullable=False)
+    parent: Mapped[str] = mapped_column(nullable=False, index=True)
+    size: Mapped[int] = mapped_column(nullable=False)
 
-async def get_db():
+
+def create_indexes(conn):
+    """Add indexes missing from databases created before they were declared."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            create_index(conn, index)
+
+
+async def warm_pool():
+    async def ping():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+    # checked out concurrently so the pool has to open that many connections
+    await asyncio.gather(*(ping() for _ in range(POOL_WARMUP_CONNECTIONS)))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create/verify the schema and warm the pool before accepting traffic."""
+    app.state.ready = False
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(create_indexes)
+    await warm_pool()
+    group_commit.start()
+    app.state.ready = True
+    yield
+    app.state.ready = False
+    await group_commit.stop()
+    await engine.dispose()
+
 
+async def get_db():
     db = SessionLocal()
     try:
         yield db
@@ -117,144 +226,366 @@ class ContactBase(BaseModel):
         return value
 
 
-# FASTAPI
-app = FastAPI()
-
-app.add_middleware(APITimingMiddleware)
-
-async def write_email_opt_in(data: Contact, db: AsyncSession):
-    print("write_email_opt_in")
-    try:
-        email_opt_in = ContactPointEmail(
-            username=data.username,
-            email=data.email,
-            country=data.country,
-            state=data.state,
-            matm_owner = data.matm_owner,
-            contact_id = data.contact_id
-        )
-        db.add(email_opt_in)
-        await db.commit()
-    except Exception as e:
-        print(e)
-
-
-async def write_mobile_opt_in(data: Contact, db:AsyncSession):
-    print("write_mobile_opt_in")
-    try:
-        mobile_opt_in = ContactPointPhone(
-            username=data.username,
-            phonenumber=data.phonenumber,
-            country=data.country,
-            state=data.state,
-            matm_owner = data.matm_owner,
-            contact_id = data.contact_id
-        )
-        db.add(mobile_opt_in)
-        await db.commit()
-    except Exception as e:
-        print(e)
-
-async def update_contact(data:Individual, db:AsyncSession):
-    individual_id_new = uuid4().hex
-    new_individual = Individual(username= data.username, individual_id = individual_id_new)
-    db.add(new_individual)
-    await db.commit()
+# bodies that are already valid ContactBase input skip pydantic
+contact_parser = ContactParser({"country": (True, True), "state": (True, True)}, allow_unknown=True)
+
+CONTACT_BODY = {"requestBody": {"content": {"application/json": {"schema": ContactBase.model_json_schema()}},
+                                "required": True}}
+
+
+async def read_contact(request: Request):
+    """
+    The POST /contacts body as a ContactRecord when the fast path accepts it,
+    otherwise validated into a ContactBase the way FastAPI validates a
+    `data: ContactBase` parameter, with the same 400 / 422 responses.
+    """
+    body = await request.body()
+    is_json = json_content_type(request.headers.get("content-type"))
+    with timed("validation"):
+        if is_json:
+            record = contact_parser.parse(body)
+            if record is not None:
+                return record
+        if not body:
+            raise RequestValidationError([{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}])
+        payload = body
+        if is_json:
+            try:
+                payload = json.loads(body)
+            except json.JSONDecodeError as error:
+                raise RequestValidationError([{"type": "json_invalid", "loc": ("body", error.pos),
+                                               "msg": "JSON decode error", "input": {},
+                                               "ctx": {"error": error.msg}}], body=error.doc)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="There was an error parsing the body")
+        try:
+            return ContactBase.model_validate(payload, from_attributes=True)
+        except ValidationError as error:
+            raise RequestValidationError([{**detail, "loc": ("body", *detail["loc"])}
+                                          for detail in error.errors(include_url=False)], body=payload)
+
+
+class TimedRoute(APIRoute):
+    """Marks where the endpoint starts and ends, for the Server-Timing breakdown."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
 
 
-@app.post("/contacts")
-async def index(data: ContactBase, db: AsyncSession = Depends(get_db)):
+# FASTAPI
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = TimedRoute
+
+# innermost first: admission control, then idempotency, so replays don't
+# queue, then metrics, which counts replays and 503s too
+app.add_middleware(AdmissionASGIMiddleware, read=read_limiter, write=write_limiter)
+app.add_middleware(IdempotencyASGIMiddleware, store=idempotency_store, paths=["/contacts"], wait=IDEMPOTENCY_WAIT)
+app.add_middleware(MetricsASGIMiddleware, metrics=metrics)
+
+
+@app.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness():
+    if not getattr(app.state, "ready", False):
+        raise HTTPException(status_code=503, detail="warming up")
+    return {"status": "ready"}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+match_contact_statement = match_statement(Contact)
+
+async def find_identities(db: AsyncSession, model, field: str, value, cached=True):
+    """(matm_owner, username, contact_id) of the opt-in rows where `field == value`."""
+    rows = identity_cache.get(field, value) if cached else None
+    if rows is None:
+        try:
+            result = await db.execute(select(model.matm_owner, model.username, model.contact_id)
+                                      .where(getattr(model, field) == value).order_by(model.id))
+            rows = [IdentityRow(*row) for row in result]
+        except BaseException:
+            # including a cancelled request
+            if cached:
+                identity_cache.abandon(field, value)
+            raise
+        if cached:
+            identity_cache.fill(field, value, rows)
+    return rows
+
+
+async def resolve_match(db: AsyncSession, data: ContactBase, cached=True):
+    """
+    Match for the incoming contact, plus the matched Contact when it came back
+    in the same round trip (MATCH_RESOLUTION=sql), else None.
+    """
+    if MATCH_RESOLUTION == "sql":
+        result = await db.execute(match_contact_statement, {
+            "email": data.email, "phonenumber": data.phonenumber,
+            "matm_owner": data.matm_owner, "username": data.username})
+        row = result.one()
+        return match_from_row(row), row[0]
+    phone = await find_identities(db, ContactPointPhone, "phonenumber", data.phonenumber, cached)
+    email = await find_identities(db, ContactPointEmail, "email", data.email, cached)
+    return match_identities(email, phone, data.matm_owner, data.username), None
+
+
+async def individual_links(db: AsyncSession, contact_ids):
+    """IndividualLinks holding the paths from the individuals of `contact_ids` to their roots."""
+    if not contact_ids:
+        return IndividualLinks()
+    return IndividualLinks(await db.execute(contact_walk_statement(Contact, IndividualLink, contact_ids)))
+
+
+@app.post("/contacts", openapi_extra=CONTACT_BODY)
+async def index(request: Request, db: AsyncSession = Depends(get_db)):
+    data = await read_contact(request)
     start_time = time.time()
-    contact_ins = Contact(username=data.username, phonenumber=data.phonenumber, country = data.country, state = data.state,
-                        sms_opt_in_status= data.sms_opt_in_status, email = data.email, email_opt_in_status = data.email_opt_in_status,
-                        matm_owner= data.matm_owner)
-    message = "Contact added successfully"
-    contact_ins.contact_id = uuid4().hex[:8]
-    phone_result = await db.execute(select(ContactPointPhone).filter(ContactPointPhone.phonenumber == data.phonenumber))
-    phone = phone_result.scalars().all()
-    email_result = await db.execute(select(ContactPointEmail).filter(ContactPointEmail.email == data.email))
-    email = email_result.scalars().all()
-
-    # check for Matm Owner if Phone or email already in db
-    matched_contacts = []
-    matched_individuals = []
-    try:
-        for result_email in email:
-            if result_email.matm_owner == data.matm_owner and result_email.username == data.username:
-                matched_contacts.append(result_email.contact_id)
-            elif result_email.matm_owner == data.matm_owner and result_email.username != data.username:
-                raise ValueError("matching error on contact data")
-            elif result_email.matm_owner != data.matm_owner and result_email.username == data.username:
-                matched_individuals.append(result_email.contact_id)
-
-        for result_phone in phone:
-            if result_phone.matm_owner == data.matm_owner and result_phone.username == data.username:
-                matched_contacts.append(result_phone.contact_id)
-            elif result_phone.matm_owner == data.matm_owner and result_phone.username != data.username:
-                raise ValueError("matching error on contact data")
-            elif result_phone.matm_owner != data.matm_owner and result_phone.username == data.username:
-                matched_individuals.append(result_phone.contact_id)
-
-    except Exception as error:
-        contact_ins.status = message = str(error)
-    
-    if matched_contacts:
-        contact_ins = await db.execute(select(Contact).filter(Contact.contact_id== matched_contacts[0]))
-        contact_ins = contact_ins.scalars().one()
-        contact_ins.state = data.state
-        contact_ins.country = data.country
-        contact_ins.status = f"updated - {start_time - time.time()}"
-        message = "contact Updated"
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            message = await save_contact(db, data, start_time, attempt)
+            break
+        except (StaleMatch, IntegrityError):
+            await db.rollback()
+            if attempt == WRITE_ATTEMPTS:
+                raise
 
-    elif matched_individuals:
-        individual_id = await db.execute(select(Contact.individual_id).filter(Contact.contact_id == matched_individuals[0]))
-        contact_ins.individual_id == individual_id
-        contact_ins.status = f"created - {time.time()}"
-
-    if message == "Contact added successfully" or matched_individuals:
-            
-        write_email_task = create_task(write_email_opt_in(contact_ins,db))
-        write_mobile_task = create_task(write_mobile_opt_in(contact_ins,db))
+    duration = time.time() - start_time
+    return ({'message': message, 'username': data.username, 'time taken':duration})
 
-    else:
-        write_individual_task = create_task(update_contact(contact_ins,db))
 
-    db.add(contact_ins)
-    await db.commit()
+async def save_contact(db: AsyncSession, data: ContactBase, start_time, attempt):
+    """
+    Match on `db`, then write the contact in one transaction, committed with
+    those of concurrent POSTs (common/group_commit.py); returns the response message.
+    """
+    contact = {"username": data.username, "phonenumber": data.phonenumber, "country": data.country,
+               "state": data.state, "email": data.email, "email_opt_in_status": data.email_opt_in_status,
+               "sms_opt_in_status": data.sms_opt_in_status, "matm_owner": data.matm_owner,
+               "individual_id": None, "status": None, "contact_id": uuid4().hex[:8]}
+    message = "Contact added successfully"
+    # a retry reads past the identity cache
+    match, matched_contact = await resolve_match(db, data, cached=attempt == 1)
+    if match.conflict:
+        contact["status"] = message = MATCH_ERROR
+
+    if match.contact_id:
+        if matched_contact is None:
+            matched_contact = await db.execute(select(Contact).filter(Contact.contact_id== match.contact_id))
+            matched_contact = matched_contact.scalars().one()
+        # values only: the request's session stays read-only, the writer owns the write lock
+        contact = {column: getattr(matched_contact, column) for column in CONTACT_COLUMNS}
+        contact["state"] = data.state
+        contact["country"] = data.country
+        contact["status"] = f"updated - {start_time - time.time()}"
+        message = "contact Updated"
 
-    await write_email_task
+    elif match.individual_contact_id:
+        contact["status"] = f"created - {time.time()}"
+
+    links = None
+    if not match.contact_id:
+        # joins the individuals of its matches, or starts a new one
+        links = await individual_links(db, match.individual_contact_ids)
+        contact["individual_id"] = links.assign()
+
+    # updates and conflicts without an individual match record an Individual
+    individual_added = not (message == "Contact added successfully" or match.individual_contact_id)
+
+    async def write(conn):
+        """The POST's statements, on the group transaction; the opt-in tables written."""
+        if links is not None:
+            for statement, params in link_statements(IndividualLink, links):
+                check_updated(statement, params, await conn.execute(statement, params))
+        if match.contact_id:
+            await conn.execute(update(Contact).where(Contact.contact_id == match.contact_id)
+                               .values(state=contact["state"], country=contact["country"], status=contact["status"]))
+        else:
+            await conn.execute(insert(Contact), contact)
+        written = []
+        if individual_added:
+            await conn.execute(insert(Individual), {"username": contact["username"], "individual_id": uuid4().hex})
+            return written
+        for model, field in ((ContactPointEmail, "email"), (ContactPointPhone, "phonenumber")):
+            result = await conn.execute(opt_in_insert(model), {
+                "username": contact["username"],
+                field: contact[field],
+                "country": contact["country"],
+                "state": contact["state"],
+                "matm_owner": contact["matm_owner"],
+                "contact_id": contact["contact_id"],
+            })
+            if not match.contact_id:
+                check_created(result, final=attempt == WRITE_ATTEMPTS)
+            if result.rowcount:
+                written.append((model, field))
+        return written
+
+    # give the read connection back to the pool while waiting for the writer
+    await db.rollback()
+    written = await group_commit.submit(write)
+    response_cache.bump(Contact.__tablename__)
+    if individual_added:
+        response_cache.bump(Individual.__tablename__)
+    identity_row = IdentityRow(contact["matm_owner"], contact["username"], contact["contact_id"])
+    for model, field in written:
+        identity_cache.add(field, contact[field], identity_row)
+        response_cache.bump(model.__tablename__)
+    return message
+
+@app.post("/contacts/bulk")
+async def bulk_contacts(request: Request, db: AsyncSession = Depends(get_db)):
+    """JSON array or NDJSON of contacts, matched as sequential POSTs and written in one transaction."""
+    start_time = time.time()
+    body = await request.body()
+    try:
+        with timed("validation"):
+            rows = parse_body(body, request.headers.get("content-type"))
+    except BulkBodyError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+    valid, errors = [], []
+    with timed("validation"):
+        for position, row in enumerate(rows):
+            if not isinstance(row, dict):
+                errors.append((position, [{"msg": "contact must be a JSON object"}]))
+                continue
+            record = contact_parser.check(row)
+            if record is not None:
+                valid.append((position, record.contact_fields()))
+                continue
+            try:
+                valid.append((position, dict(ContactBase(**row))))
+            except ValueError as error:
+                errors.append((position, jsonable_encoder(error.errors())))
+
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            plan = await save_batch(db, valid)
+            break
+        except (StaleMatch, IntegrityError):
+            await db.rollback()
+            if attempt == WRITE_ATTEMPTS:
+                raise
+    response_cache.bump(Contact.__tablename__, ContactPointEmail.__tablename__, ContactPointPhone.__tablename__,
+                        Individual.__tablename__)
+
+    for row in plan.email_opt_ins:
+        identity_cache.add("email", row["email"], IdentityRow(row["matm_owner"], row["username"], row["contact_id"]))
+    for row in plan.phone_opt_ins:
+        identity_cache.add("phonenumber", row["phonenumber"], IdentityRow(row["matm_owner"], row["username"], row["contact_id"]))
 
     duration = time.time() - start_time
-    return ({'message': message, 'username': data.username, 'time taken':duration})
+    return {"results": merge_results(plan, errors), **plan.summary(), "time taken": duration}
+
+
+async def save_batch(db: AsyncSession, valid):
+    """Match and write the valid rows of a batch in a single transaction; returns the plan."""
+    email_index, phone_index = {}, {}
+    for statement in lookup_statements(ContactPointEmail, "email", {data["email"] for _, data in valid}):
+        add_rows(email_index, await db.execute(statement))
+    for statement in lookup_statements(ContactPointPhone, "phonenumber", {data["phonenumber"] for _, data in valid}):
+        add_rows(phone_index, await db.execute(statement))
+    contact_index = {}
+    for statement in contact_statements(Contact, email_index, phone_index):
+        add_contacts(contact_index, await db.execute(statement))
+    links = IndividualLinks()
+    for statement in walk_statements(IndividualLink, contact_individuals(contact_index)):
+        links.add_rows(await db.execute(statement))
+    contact_ids, taken = new_contact_ids(len(valid)), set()
+    for statement in taken_statements(Contact, contact_ids):
+        taken.update((await db.execute(statement)).scalars())
+    plan = plan_batch(valid, email_index, phone_index, contact_index, record_individuals=True, links=links,
+                      contact_ids=replace_taken(contact_ids, taken))
+
+    for statement, params in plan_statements(plan, Contact, ContactPointEmail, ContactPointPhone, Individual,
+                                             IndividualLink):
+        check_updated(statement, params, await db.execute(statement, params))
+    await db.commit()
+    return plan
+
+def cached_response(request: Request, entry):
+    """The cached body with its ETag, or 304 if the client already has it."""
+    headers = {"ETag": entry.etag}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type=JSON_MEDIA_TYPE, headers=headers)
+
+async def list_page(request: Request, key, model, limit, after, db: AsyncSession):
+    """One page of `model` as plain rows, encoded straight to JSON bytes and cached."""
+    limit = page_size(limit)
+    cache_key = (request.url.path, limit, after)
+    entry, versions = response_cache.lookup(cache_key, (model.__tablename__,))
+    if entry is None:
+        columns = column_names(model)
+        rows = await db.execute(page_statement(model, limit, after, columns))
+        entry = response_cache.store(cache_key, versions, dumps(page(key, rows, limit, columns)))
+    return cached_response(request, entry)
 
 @app.get("/contacts")
-async def get_users(db: AsyncSession = Depends(get_db)):
-    results = await db.execute(select(Contact))
-    users = results.scalars().all()
-    return {"contacts": users}
+async def get_users(request: Request, limit: Optional[int] = Query(None, ge=1),
+                    after: int = Query(0, ge=0), db: AsyncSession = Depends(get_db)):
+    return await list_page(request, "contacts", Contact, limit, after, db)
 
 @app.get("/email")
-async def get_email(db: AsyncSession = Depends(get_db)):
-    results = await db.execute(select(ContactPointEmail))
-    emails = results.scalars().all()
-    return {"email": emails}
+async def get_email(request: Request, limit: Optional[int] = Query(None, ge=1),
+                    after: int = Query(0, ge=0), db: AsyncSession = Depends(get_db)):
+    return await list_page(request, "email", ContactPointEmail, limit, after, db)
 
 @app.get("/mobile")
-async def get_mobile(db: AsyncSession = Depends(get_db)):
-    results = await db.execute(select(ContactPointPhone))
-    mobile_numbers = results.scalars().all()
-    return {"Phone numbers": mobile_numbers}
+async def get_mobile(request: Request, limit: Optional[int] = Query(None, ge=1),
+                     after: int = Query(0, ge=0), db: AsyncSession = Depends(get_db)):
+    return await list_page(request, "mobile", ContactPointPhone, limit, after, db)
+
+def export_response(model, fmt):
+    export = Export(model, fmt)
+    return StreamingResponse(export.astream(engine), media_type=export.media_type, headers=export.headers)
+
+@app.get("/contacts/export")
+async def export_contacts(fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format")):
+    return export_response(Contact, fmt)
+
+@app.get("/email/export")
+async def export_email(fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format")):
+    return export_response(ContactPointEmail, fmt)
+
+@app.get("/mobile/export")
+async def export_mobile(fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format")):
+    return export_response(ContactPointPhone, fmt)
 
 @app.get("/contacts/{item_id}")
-async def get_contact(item_id: int, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Contact).where(Contact.id == item_id))
-    contact =result.scalars().first()
-    if contact == None:
+async def get_contact(item_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    cache_key = (request.url.path,)
+    entry, versions = response_cache.lookup(cache_key, (Contact.__tablename__,))
+    if entry is None:
+        result = await db.execute(select(*Contact.__table__.columns).where(Contact.id == item_id))
+        contact = result.mappings().first()
+        if contact == None:
             raise HTTPException(status_code=404, detail="contact not found")
-    return {"user": contact}
+        entry = response_cache.store(cache_key, versions, dumps({"user": dict(contact)}))
+    return cached_response(request, entry)
 
 @app.get("/individual")
-async def get_individual(db: AsyncSession = Depends(get_db)):
-    results = await db.execute(select(Individual))
-    individual= results.scalars().all()
-    return {"individuals": individual}
\ No newline at end of file
+async def get_individual(request: Request, limit: Optional[int] = Query(None, ge=1),
+                         after: int = Query(0, ge=0), db: AsyncSession = Depends(get_db)):
+    return await list_page(request, "individuals", Individual, limit, after, db)
+
+
+@app.get("/individual/{individual_id}/contacts")
+async def get_individual_contacts(individual_id: str, request: Request, db: AsyncSession = Depends(get_db)):
+    # links only change when a contact is created, which bumps the contacts version
+    cache_key = (request.url.path,)
+    entry, versions = response_cache.lookup(cache_key, (Contact.__tablename__,))
+    if entry is None:
+        links = IndividualLinks(await db.execute(walk_statement(IndividualLink, [individual_id])))
+        if individual_id not in links.parent:
+            raise HTTPException(status_code=404, detail="individual not found")
+        root = links.find(individual_id)
+        result = await db.execute(members_statement(Contact, IndividualLink, root))
+        entry = response_cache.store(cache_key, versions, dumps(
+            {"individual_id": root, "contacts": [dict(contact) for contact in result.mappings()]}))
+    return cached_response(request, entry)
@@ -1,41 +1,108 @@
-from typing import Optional
-from fastapi import FastAPI, Depends, HTTPException, Request, status,BackgroundTasks
+from typing import Literal, Optional
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status
 from requests import Session
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, PrimaryKeyConstraint, select
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, Index, PrimaryKeyConstraint, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from pydantic import BaseModel, EmailStr, validator
-from fastapi.responses import Response
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from pydantic import BaseModel, EmailStr, ValidationError, validator
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, StreamingResponse
+from fastapi.routing import APIRoute
+from anyio import to_thread
+from contextlib import asynccontextmanager
+import asyncio
+import json
+import os
+import sys
 import time
 from uuid import uuid4
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.admission import AdmissionASGIMiddleware, Limiter
+from common.bulk import (BulkBodyError, add_contacts, add_rows, contact_individuals, contact_statements,
+                         lookup_statements, merge_results, new_contact_ids, parse_body, plan_batch, plan_statements,
+                         replace_taken, taken_statements)
+from common.export import Export
+from common.identity_cache import IdentityCache, IdentityRow
+from common.idempotency import IdempotencyASGIMiddleware, IdempotencyStore
+from common.identity_graph import (IndividualLinks, contact_walk_statement, link_statements, members_statement,
+                                   walk_statement, walk_statements)
+from common.matching import MATCH_ERROR, match_from_row, match_identities, match_statement
+from common.metrics import CONTENT_TYPE, Metrics, MetricsASGIMiddleware
+from common.pagination import column_names, page, page_size, page_statement
+from common.response_cache import ResponseCache, etag_matches
+from common.serialization import JSON_MEDIA_TYPE, dumps
+from common.sqlite import configure_sqlite
+from common.timing import instrument_engine, timed, timed_endpoint
+from common.upsert import (WRITE_ATTEMPTS, StaleMatch, check_created, check_updated, create_index,
+                           opt_in_insert)
+from common.validation import ContactParser, json_content_type
+
 # Database connection details (replace with your actual credentials)
-DATABASE_URL = "sqlite:///contacts.db"
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///contacts.db")
+
+# Endpoints and their session dependency are plain functions
+# that FastAPI runs on a pool of THREADPOOL_SIZE threads, each checking out one
+# pooled connection; by default there is a connection for every thread
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", DB_POOL_SIZE + DB_MAX_OVERFLOW))
 
 # Define database engine
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False},
+                       pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                       pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)))
+# statement counts and DB time per request, for Server-Timing and /metrics
+instrument_engine(engine)
+# WAL and a busy timeout, so worker processes can share the file
+configure_sqlite(engine)
+
+# (matm_owner, username, contact_id) of opt-in rows by email / phonenumber
+identity_cache = IdentityCache(int(os.environ.get("IDENTITY_CACHE_SIZE", 100_000)))
+
+# encoded GET responses, invalidated by per-table write versions
+response_cache = ResponseCache(int(os.environ.get("RESPONSE_CACHE_BYTES", 32 * 1024 * 1024)))
+
+# "python": cached per-field lookups classified in Python; "sql": one statement
+MATCH_RESOLUTION = os.environ.get("MATCH_RESOLUTION", "python")
 
 # Create a declarative base for SQLAlchemy models
 Base = declarative_base()
 
-# class APITimingMiddleware(BaseHTTPMiddleware):
-#     async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-#         start_time = time.time()  # Capture the start time
-#         response = await call_next(request)
-#         process_time = time.time() - start_time  # Calculate processing time
-        
-#         # Log the time taken to process the request
-#         print(f"Request: {request.url.path} took {process_time} seconds")
-        
-#         # Optionally, add the timing information to response headers
-#         response.headers['X-Process-Time'] = str(process_time)
-        
-#         return response
+# latency histograms, in-flight gauges and status counters served on /metrics
+metrics = Metrics("fastapi_sync")
+metrics.add_gauges("identity_cache", identity_cache.stats)
+metrics.add_gauges("response_cache", response_cache.stats)
+
+# POST /contacts retries carrying the same Idempotency-Key get the first
+# response back: IDEMPOTENCY_KEYS records kept IDEMPOTENCY_TTL seconds, and a
+# retry of a request still running waits up to IDEMPOTENCY_WAIT seconds
+IDEMPOTENCY_KEYS = int(os.environ.get("IDEMPOTENCY_KEYS", 10_000))
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 3600))
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", 30))
+idempotency_store = IdempotencyStore(IDEMPOTENCY_KEYS, IDEMPOTENCY_TTL, asyncio.Event)
+metrics.add_gauges("idempotency", idempotency_store.stats)
+
+# DB-bound requests run at most ADMISSION_READ_LIMIT GETs and
+# ADMISSION_WRITE_LIMIT writes at once (0: no limit); up to
+# ADMISSION_QUEUE_SIZE more of each wait, and a request that would wait over
+# ADMISSION_WAIT_BUDGET seconds gets 503 with Retry-After
+ADMISSION_READ_LIMIT = int(os.environ.get("ADMISSION_READ_LIMIT", 16))
+ADMISSION_WRITE_LIMIT = int(os.environ.get("ADMISSION_WRITE_LIMIT", 4))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 64))
+ADMISSION_WAIT_BUDGET = float(os.environ.get("ADMISSION_WAIT_BUDGET", 1.0))
+read_limiter = Limiter(ADMISSION_READ_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_WAIT_BUDGET, asyncio.Event)
+write_limiter = Limiter(ADMISSION_WRITE_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_WAIT_BUDGET, asyncio.Event)
+metrics.add_gauges("admission_read", read_limiter.stats)
+metrics.add_gauges("admission_write", write_limiter.stats)
     
 # Define SQLAlchemy ORM models based on the provided schema
 class Contact(Base):
     __tablename__ = "contacts"
+    # generated ids are short; a collision fails the insert and is retried (common/upsert.py)
+    __table_args__ = (Index("uq_contacts_contact_id", "contact_id", unique=True),)
 
     id = Column(Integer, primary_key=True, nullable=False)
     username = Column(String, nullable=False)
@@ -46,12 +113,14 @@ class Contact(Base):
     email_opt_in_status = Column(Boolean, nullable=False)
     sms_opt_in_status = Column(Boolean, nullable=False)
     matm_owner = Column(String, nullable=False)
-    individual_id = Column(String, nullable=True)
+    individual_id = Column(String, nullable=True, index=True)
     status = Column(String, nullable=True)
     contact_id = Column(String, nullable=True)
     
 class ContactPointEmail(Base):
     __tablename__ = "email_opt_in"
+    # POST /contacts dedup lookup and upsert key: by email, then matm_owner/username
+    __table_args__ = (Index("uq_email_opt_in_email_owner_user", "email", "matm_owner", "username", unique=True),)
     id = Column(Integer, primary_key=True, nullable=False)
     username = Column(String, nullable=False)
     email = Column(String, nullable=False)
@@ -62,6 +131,9 @@ class ContactPointEmail(Base):
 
 class ContactPointPhone(Base):
     __tablename__ = "mobile_opt_in"
+    # POST /contacts dedup lookup and upsert key: by phonenumber, then matm_owner/username
+    __table_args__ = (Index("uq_mobile_opt_in_phone_owner_user", "phonenumber", "matm_owner", "username",
+                            unique=True),)
     id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
     username = Column(String, nullable=False)
     phonenumber = Column(Integer, nullable=False)
@@ -76,14 +148,31 @@ class Individual(Base):
     username = Column(Integer, nullable=False)
     individual_id = Column(Integer, nullable=False)
 
+class IndividualLink(Base):
+    """Union-find over individual ids, see common/identity_graph.py."""
+    __tablename__ = "individual_links"
+    individual_id = Column(String, primary_key=True, nullable=False)
+    parent = Column(String, nullable=False, index=True)
+    size = Column(Integer, nullable=False)
+
+
+def create_indexes(conn):
+    """Add indexes missing from databases created before they were declared."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            create_index(conn, index)
+
+
 # Create all database tables if they don't exist
 Base.metadata.create_all(engine)
+with engine.begin() as conn:
+    create_indexes(conn)
 
 # Create a dependency for database sessions
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, expire_on_commit= False)
 
 
-async def get_db():
+def get_db():
     db = SessionLocal()
     try:
         yield db
@@ -91,7 +180,57 @@ async def get_db():
         db.close()
 
 
-app = FastAPI()
+class TimedRoute(APIRoute):
+    """Marks where the endpoint starts and ends, for the Server-Timing breakdown."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+
+# the limiter anyio sizes the endpoint threadpool with, set at startup
+thread_limiter = None
+
+
+def threadpool_stats():
+    if thread_limiter is None:
+        return {}
+    return {"size": thread_limiter.total_tokens, "busy": thread_limiter.borrowed_tokens,
+            "waiting": thread_limiter.statistics().tasks_waiting}
+
+
+metrics.add_gauges("threadpool", threadpool_stats)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global thread_limiter
+    thread_limiter = to_thread.current_default_thread_limiter()
+    thread_limiter.total_tokens = THREADPOOL_SIZE
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = TimedRoute
+# innermost first: admission control, then idempotency, so replays don't
+# queue, then metrics, which counts replays and 503s too
+app.add_middleware(AdmissionASGIMiddleware, read=read_limiter, write=write_limiter)
+app.add_middleware(IdempotencyASGIMiddleware, store=idempotency_store, paths=["/contacts"], wait=IDEMPOTENCY_WAIT)
+app.add_middleware(MetricsASGIMiddleware, metrics=metrics)
+
+
+# Schema is created at import time above, so the app is ready once it serves
+@app.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness():
+    return {"status": "ready"}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
 
 
 # PYDANTIC
@@ -120,133 +259,328 @@ class ContactBase(BaseModel):
         if not isinstance(value, int) or len(str(value)) != 10 or not (1 <= value <= 9999999999):
             raise ValueError("phonenumber must be a valid 10-digit integer")
         return value
-    
-async def write_email_opt_in(data: Contact, db:Session = Depends(get_db)):
-    print("write_email_opt_in")
-    try:
-        email_opt_in = ContactPointEmail(
-            username=data.username,
-            email=data.email,
-            country=data.country,
-            state=data.state,
-            matm_owner = data.matm_owner,
-            contact_id = data.contact_id
-        )
-        db.add(email_opt_in)
-        db.commit()
-    except Exception as e:
-        print(e)
-
-
-async def write_mobile_opt_in(data: Contact, db:Session = Depends(get_db)):
-    print("write_mobile_opt_in")
+
+
+# bodies that are already valid ContactBase input skip pydantic
+contact_parser = ContactParser({"country": (True, True), "state": (True, True)}, allow_unknown=True)
+
+CONTACT_BODY = {"requestBody": {"content": {"application/json": {"schema": ContactBase.model_json_schema()}},
+                                "required": True}}
+
+
+async def read_contact(request: Request):
+    """
+    The POST /contacts body as a ContactRecord when the fast path accepts it,
+    otherwise validated into a ContactBase the way FastAPI validates a
+    `data: ContactBase` parameter, with the same 400 / 422 responses.
+
+    A dependency, so the body is read on the event loop before the endpoint
+    goes to a worker thread.
+    """
+    body = await request.body()
+    is_json = json_content_type(request.headers.get("content-type"))
+    with timed("validation"):
+        if is_json:
+            record = contact_parser.parse(body)
+            if record is not None:
+                return record
+        if not body:
+            raise RequestValidationError([{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}])
+        payload = body
+        if is_json:
+            try:
+                payload = json.loads(body)
+            except json.JSONDecodeError as error:
+                raise RequestValidationError([{"type": "json_invalid", "loc": ("body", error.pos),
+                                               "msg": "JSON decode error", "input": {},
+                                               "ctx": {"error": error.msg}}], body=error.doc)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="There was an error parsing the body")
+        try:
+            return ContactBase.model_validate(payload, from_attributes=True)
+        except ValidationError as error:
+            raise RequestValidationError([{**detail, "loc": ("body", *detail["loc"])}
+                                          for detail in error.errors(include_url=False)], body=payload)
+
+
+async def read_bulk_rows(request: Request):
+    """The POST /contacts/bulk rows, read on the event loop like read_contact."""
+    body = await request.body()
     try:
-        mobile_opt_in = ContactPointPhone(
-            username=data.username,
-            phonenumber=data.phonenumber,
-            country=data.country,
-            state=data.state,
-            matm_owner = data.matm_owner,
-            contact_id = data.contact_id
-        )
-        db.add(mobile_opt_in)
-        db.commit()
-    except Exception as e:
-        print(e)
-
-async def update_contact(data:Individual, db,individual_id_new = str):
-    new_individual = Individual(username= data.username, individual_id = individual_id_new)
-    db.add(new_individual)
-    db.commit()
+        with timed("validation"):
+            return parse_body(body, request.headers.get("content-type"))
+    except BulkBodyError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
 
-@app.post("/contacts", response_model=dict, status_code=status.HTTP_201_CREATED)
-async def create_contact(data: ContactBase,background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
 
+def update_contact(data: Contact, db: Session):
+    """New Individual for an updated contact, committed with the request."""
+    new_individual = Individual(username= data.username, individual_id = uuid4().hex)
+    db.add(new_individual)
+
+match_contact_statement = match_statement(Contact)
+
+def find_identities(db: Session, model, field: str, value, cached=True):
+    """(matm_owner, username, contact_id) of the opt-in rows where `field == value`."""
+    rows = identity_cache.get(field, value) if cached else None
+    if rows is None:
+        try:
+            result = db.execute(select(model.matm_owner, model.username, model.contact_id)
+                                .where(getattr(model, field) == value).order_by(model.id))
+            rows = [IdentityRow(*row) for row in result]
+        except BaseException:
+            if cached:
+                identity_cache.abandon(field, value)
+            raise
+        if cached:
+            identity_cache.fill(field, value, rows)
+    return rows
+
+def resolve_match(db: Session, data: ContactBase, cached=True):
+    """
+    Match for the incoming contact, plus the matched Contact when it came back
+    in the same round trip (MATCH_RESOLUTION=sql), else None.
+    """
+    if MATCH_RESOLUTION == "sql":
+        result = db.execute(match_contact_statement, {
+            "email": data.email, "phonenumber": data.phonenumber,
+            "matm_owner": data.matm_owner, "username": data.username})
+        row = result.one()
+        return match_from_row(row), row[0]
+    phone = find_identities(db, ContactPointPhone, "phonenumber", data.phonenumber, cached)
+    email = find_identities(db, ContactPointEmail, "email", data.email, cached)
+    return match_identities(email, phone, data.matm_owner, data.username), None
+
+def individual_links(db: Session, contact_ids):
+    """IndividualLinks holding the paths from the individuals of `contact_ids` to their roots."""
+    if not contact_ids:
+        return IndividualLinks()
+    # read out in full: an open cursor pins the WAL snapshot and the INSERTs below fail as locked
+    return IndividualLinks(db.execute(contact_walk_statement(Contact, IndividualLink, contact_ids)).all())
+
+@app.post("/contacts", response_model=dict, status_code=status.HTTP_201_CREATED, openapi_extra=CONTACT_BODY)
+def create_contact(data=Depends(read_contact), db: Session = Depends(get_db)):
     start_time = time.time()
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            message = save_contact(db, data, start_time, attempt)
+            break
+        except (StaleMatch, IntegrityError):
+            db.rollback()
+            if attempt == WRITE_ATTEMPTS:
+                raise
+
+    duration = time.time() - start_time
+    return ({'message': message, 'username': data.username, 'time taken':duration})
+
+
+def save_contact(db: Session, data: ContactBase, start_time, attempt):
+    """Match and write one contact in a single transaction; returns the response message."""
     contact_ins = Contact(username=data.username, phonenumber=data.phonenumber, country = data.country, state = data.state,
                         sms_opt_in_status= data.sms_opt_in_status, email = data.email, email_opt_in_status = data.email_opt_in_status,
                         matm_owner= data.matm_owner)
     message = "Contact added successfully"
     contact_ins.contact_id = uuid4().hex[:8]
-    phone_result = db.execute(select(ContactPointPhone).filter(ContactPointPhone.phonenumber == data.phonenumber))
-    phone = phone_result.scalars().all()
-    email_result = db.execute(select(ContactPointEmail).filter(ContactPointEmail.email == data.email))
-    email = email_result.scalars().all()
-
-    # check for Matm Owner if Phone or email already in db
-    matched_contacts = []
-    matched_individuals = []
-    try:
-        for result_email in email:
-            if result_email.matm_owner == data.matm_owner and result_email.username == data.username:
-                matched_contacts.append(result_email.contact_id)
-            elif result_email.matm_owner == data.matm_owner and result_email.username != data.username:
-                raise ValueError("matching error on contact data")
-            elif result_email.matm_owner != data.matm_owner and result_email.username == data.username:
-                matched_individuals.append(result_email.contact_id)
-
-        for result_phone in phone:
-            if result_phone.matm_owner == data.matm_owner and result_phone.username == data.username:
-                matched_contacts.append(result_phone.contact_id)
-            elif result_phone.matm_owner == data.matm_owner and result_phone.username != data.username:
-                raise ValueError("matching error on contact data")
-            elif result_phone.matm_owner != data.matm_owner and result_phone.username == data.username:
-                matched_individuals.append(result_phone.contact_id)
-
-    except Exception as error:
-        contact_ins.status = message = str(error)
+    # a retry reads past the identity cache
+    match, matched_contact = resolve_match(db, data, cached=attempt == 1)
+    if match.conflict:
+        contact_ins.status = message = MATCH_ERROR
     
-    if matched_contacts:
-        contact_ins = db.execute(select(Contact).filter(Contact.contact_id== matched_contacts[0]))
-        contact_ins = contact_ins.scalars().one()
+    if match.contact_id:
+        if matched_contact is None:
+            matched_contact = db.execute(select(Contact).filter(Contact.contact_id== match.contact_id))
+            matched_contact = matched_contact.scalars().one()
+        contact_ins = matched_contact
         contact_ins.state = data.state
         contact_ins.country = data.country
         contact_ins.status = f"updated - {start_time - time.time()}"
         message = "contact Updated"
 
-    elif matched_individuals:
-        individual_id = db.execute(select(Contact.individual_id).filter(Contact.contact_id == matched_individuals[0]))
-        contact_ins.individual_id == individual_id
+    elif match.individual_contact_id:
         contact_ins.status = f"created - {time.time()}"
 
-    if message == "Contact added successfully" or matched_individuals:
-            
-        background_tasks.add_task(write_email_opt_in, contact_ins, db)
-        background_tasks.add_task(write_mobile_opt_in, contact_ins, db)
-
+    if not match.contact_id:
+        # joins the individuals of its matches, or starts a new one
+        links = individual_links(db, match.individual_contact_ids)
+        contact_ins.individual_id = links.assign()
+        for statement, params in link_statements(IndividualLink, links):
+            check_updated(statement, params, db.execute(statement, params))
+
+    written = []
+    # updates and conflicts without an individual match record an Individual
+    individual_added = not (message == "Contact added successfully" or match.individual_contact_id)
+    if not individual_added:
+        for model, field in ((ContactPointEmail, "email"), (ContactPointPhone, "phonenumber")):
+            result = db.execute(opt_in_insert(model), {
+                "username": contact_ins.username,
+                field: getattr(contact_ins, field),
+                "country": contact_ins.country,
+                "state": contact_ins.state,
+                "matm_owner": contact_ins.matm_owner,
+                "contact_id": contact_ins.contact_id,
+            })
+            if not match.contact_id:
+                check_created(result, final=attempt == WRITE_ATTEMPTS)
+            if result.rowcount:
+                written.append((model, field))
     else:
-        individual_id_new = uuid4().hex
-        background_tasks.add_task(update_contact,contact_ins,db,individual_id_new),
+        update_contact(contact_ins, db)
 
     db.add(contact_ins)
     db.commit()
+    response_cache.bump(Contact.__tablename__)
+    if individual_added:
+        response_cache.bump(Individual.__tablename__)
+    identity_row = IdentityRow(contact_ins.matm_owner, contact_ins.username, contact_ins.contact_id)
+    for model, field in written:
+        identity_cache.add(field, getattr(contact_ins, field), identity_row)
+        response_cache.bump(model.__tablename__)
+    return message
+
+
+@app.post("/contacts/bulk", status_code=status.HTTP_201_CREATED)
+def bulk_contacts(rows: list = Depends(read_bulk_rows), db: Session = Depends(get_db)):
+    """JSON array or NDJSON of contacts, matched as sequential POSTs and written in one transaction."""
+    start_time = time.time()
+    valid, errors = [], []
+    with timed("validation"):
+        for position, row in enumerate(rows):
+            if not isinstance(row, dict):
+                errors.append((position, [{"msg": "contact must be a JSON object"}]))
+                continue
+            record = contact_parser.check(row)
+            if record is not None:
+                valid.append((position, record.contact_fields()))
+                continue
+            try:
+                valid.append((position, dict(ContactBase(**row))))
+            except ValueError as error:
+                errors.append((position, jsonable_encoder(error.errors())))
+
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            plan = save_batch(db, valid)
+            break
+        except (StaleMatch, IntegrityError):
+            db.rollback()
+            if attempt == WRITE_ATTEMPTS:
+                raise
+    response_cache.bump(Contact.__tablename__, ContactPointEmail.__tablename__, ContactPointPhone.__tablename__,
+                        Individual.__tablename__)
+
+    for row in plan.email_opt_ins:
+        identity_cache.add("email", row["email"], IdentityRow(row["matm_owner"], row["username"], row["contact_id"]))
+    for row in plan.phone_opt_ins:
+        identity_cache.add("phonenumber", row["phonenumber"], IdentityRow(row["matm_owner"], row["username"], row["contact_id"]))
 
     duration = time.time() - start_time
-    return ({'message': message, 'username': data.username, 'time taken':duration})
-
+    return {"results": merge_results(plan, errors), **plan.summary(), "time taken": duration}
+
+
+def save_batch(db: Session, valid):
+    """Match and write the valid rows of a batch in a single transaction; returns the plan."""
+    email_index, phone_index = {}, {}
+    for statement in lookup_statements(ContactPointEmail, "email", {data["email"] for _, data in valid}):
+        add_rows(email_index, db.execute(statement))
+    for statement in lookup_statements(ContactPointPhone, "phonenumber", {data["phonenumber"] for _, data in valid}):
+        add_rows(phone_index, db.execute(statement))
+    contact_index = {}
+    for statement in contact_statements(Contact, email_index, phone_index):
+        add_contacts(contact_index, db.execute(statement))
+    links = IndividualLinks()
+    for statement in walk_statements(IndividualLink, contact_individuals(contact_index)):
+        links.add_rows(db.execute(statement))
+    contact_ids, taken = new_contact_ids(len(valid)), set()
+    for statement in taken_statements(Contact, contact_ids):
+        taken.update(db.execute(statement).scalars())
+    plan = plan_batch(valid, email_index, phone_index, contact_index, record_individuals=True, links=links,
+                      contact_ids=replace_taken(contact_ids, taken))
+
+    for statement, params in plan_statements(plan, Contact, ContactPointEmail, ContactPointPhone, Individual,
+                                             IndividualLink):
+        check_updated(statement, params, db.execute(statement, params))
+    db.commit()
+    return plan
+
+
+def cached_response(request: Request, entry):
+    """The cached body with its ETag, or 304 if the client already has it."""
+    headers = {"ETag": entry.etag}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type=JSON_MEDIA_TYPE, headers=headers)
+
+def list_page(request: Request, key, model, limit, after, db: Session):
+    """One page of `model` as plain rows, encoded straight to JSON bytes and cached."""
+    limit = page_size(limit)
+    cache_key = (request.url.path, limit, after)
+    entry, versions = response_cache.lookup(cache_key, (model.__tablename__,))
+    if entry is None:
+        columns = column_names(model)
+        rows = db.execute(page_statement(model, limit, after, columns))
+        entry = response_cache.store(cache_key, versions, dumps(page(key, rows, limit, columns)))
+    return cached_response(request, entry)
 
 @app.get("/contacts") 
-async def read_contacts(db: Session = Depends(get_db)):
-    results = db.execute(select(Contact))
-    users = results.scalars().all()
-    return {"users": users}
+def read_contacts(request: Request, limit: Optional[int] = Query(None, ge=1),
+                  after: int = Query(0, ge=0), db: Session = Depends(get_db)):
+    return list_page(request, "contacts", Contact, limit, after, db)
 
 @app.get("/email") 
-async def read_contacts(db: Session = Depends(get_db)):
-    results = db.execute(select(Contact))
-    users = results.scalars().all()
-    return {"email": users}
+def read_email(request: Request, limit: Optional[int] = Query(None, ge=1),
+               after: int = Query(0, ge=0), db: Session = Depends(get_db)):
+    return list_page(request, "email", ContactPointEmail, limit, after, db)
 
 @app.get("/mobile") 
-async def read_contacts(db: Session = Depends(get_db)):
-    results = db.execute(select(Contact))
-    users = results.scalars().all()
-    return {"users": users}
-
-
-@app.get("/contacts/{contact_id}", response_model=dict)
-async def read_contact_by_id(contact_id: int, db: Session = Depends(get_db)):
-    contact = db.query(Contact).filter(Contact.id == contact_id).first()
-    if not contact:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Contact not found")
-    return contact
\ No newline at end of file
+def read_mobile(request: Request, limit: Optional[int] = Query(None, ge=1),
+                after: int = Query(0, ge=0), db: Session = Depends(get_db)):
+    return list_page(request, "mobile", ContactPointPhone, limit, after, db)
+
+@app.get("/individual") 
+def read_individual(request: Request, limit: Optional[int] = Query(None, ge=1),
+                    after: int = Query(0, ge=0), db: Session = Depends(get_db)):
+    return list_page(request, "individuals", Individual, limit, after, db)
+
+@app.get("/individual/{individual_id}/contacts")
+def read_individual_contacts(individual_id: str, request: Request, db: Session = Depends(get_db)):
+    # links only change when a contact is created, which bumps the contacts version
+    cache_key = (request.url.path,)
+    entry, versions = response_cache.lookup(cache_key, (Contact.__tablename__,))
+    if entry is None:
+        links = IndividualLinks(db.execute(walk_statement(IndividualLink, [individual_id])))
+        if individual_id not in links.parent:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Individual not found")
+        root = links.find(individual_id)
+        contacts = db.execute(members_statement(Contact, IndividualLink, root)).mappings()
+        entry = response_cache.store(cache_key, versions, dumps(
+            {"individual_id": root, "contacts": [dict(contact) for contact in contacts]}))
+    return cached_response(request, entry)
+
+
+def export_response(model, fmt):
+    export = Export(model, fmt)
+    return StreamingResponse(export.stream(engine), media_type=export.media_type, headers=export.headers)
+
+@app.get("/contacts/export")
+async def export_contacts(fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format")):
+    return export_response(Contact, fmt)
+
+@app.get("/email/export")
+async def export_email(fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format")):
+    return export_response(ContactPointEmail, fmt)
+
+@app.get("/mobile/export")
+async def export_mobile(fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format")):
+    return export_response(ContactPointPhone, fmt)
+
+
+@app.get("/contacts/{contact_id}")
+def read_contact_by_id(contact_id: int, request: Request, db: Session = Depends(get_db)):
+    cache_key = (request.url.path,)
+    entry, versions = response_cache.lookup(cache_key, (Contact.__tablename__,))
+    if entry is None:
+        contact = db.execute(select(*Contact.__table__.columns).where(Contact.id == contact_id)).mappings().first()
+        if not contact:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Contact not found")
+        entry = response_cache.store(cache_key, versions, dumps(dict(contact)))
+    return cached_response(request, entry)
\ No newline at end of file
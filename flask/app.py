@@ -1,27 +1,98 @@
+import os
+import sys
 import time
 from uuid import uuid4
-from flask import Flask, request, jsonify
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
+from flask import Flask, Response, request, jsonify
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, Index, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from marshmallow import Schema, ValidationError, fields, validates
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.admission import AdmissionWSGIMiddleware, Limiter
+from common.bulk import (BulkBodyError, add_contacts, add_rows, contact_individuals, contact_statements,
+                         lookup_statements, merge_results, new_contact_ids, parse_body, plan_batch, plan_statements,
+                         replace_taken, taken_statements)
+from common.export import MEDIA_TYPES, Export
+from common.identity_cache import IdentityCache, IdentityRow
+from common.idempotency import IdempotencyStore, IdempotencyWSGIMiddleware
+from common.identity_graph import (IndividualLinks, contact_walk_statement, link_statements, members_statement,
+                                   walk_statement, walk_statements)
+from common.matching import MATCH_ERROR, match_from_row, match_identities, match_statement
+from common.metrics import CONTENT_TYPE, ROUTE_KEY, Metrics, MetricsWSGIMiddleware
+from common.pagination import page, page_size, page_statement
+from common.response_cache import ResponseCache, etag_matches
+from common.serialization import JSON_MEDIA_TYPE, dumps
+from common.sqlite import configure_sqlite
+from common.timing import instrument_engine, timed
+from common.upsert import (WRITE_ATTEMPTS, StaleMatch, check_created, check_updated, create_index,
+                           opt_in_insert)
+from common.validation import ContactParser, ContactRecord
+
 # Flask app initialization
 app = Flask(__name__)
 
+# latency histograms, in-flight gauges and status counters served on /metrics
+metrics = Metrics("flask")
+
+# POST /contacts retries carrying the same Idempotency-Key get the first
+# response back: IDEMPOTENCY_KEYS records kept IDEMPOTENCY_TTL seconds, and a
+# retry of a request still running waits up to IDEMPOTENCY_WAIT seconds
+IDEMPOTENCY_KEYS = int(os.environ.get("IDEMPOTENCY_KEYS", 10_000))
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 3600))
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", 30))
+idempotency_store = IdempotencyStore(IDEMPOTENCY_KEYS, IDEMPOTENCY_TTL)
+metrics.add_gauges("idempotency", idempotency_store.stats)
+
+# DB-bound requests run at most ADMISSION_READ_LIMIT GETs and
+# ADMISSION_WRITE_LIMIT writes at once (0: no limit); up to
+# ADMISSION_QUEUE_SIZE more of each wait, and a request that would wait over
+# ADMISSION_WAIT_BUDGET seconds gets 503 with Retry-After
+ADMISSION_READ_LIMIT = int(os.environ.get("ADMISSION_READ_LIMIT", 16))
+ADMISSION_WRITE_LIMIT = int(os.environ.get("ADMISSION_WRITE_LIMIT", 4))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 64))
+ADMISSION_WAIT_BUDGET = float(os.environ.get("ADMISSION_WAIT_BUDGET", 1.0))
+read_limiter = Limiter(ADMISSION_READ_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_WAIT_BUDGET)
+write_limiter = Limiter(ADMISSION_WRITE_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_WAIT_BUDGET)
+metrics.add_gauges("admission_read", read_limiter.stats)
+metrics.add_gauges("admission_write", write_limiter.stats)
+
+# replays are answered inside the metrics middleware, so they are counted too,
+# and before admission control, so they don't queue
+app.wsgi_app = MetricsWSGIMiddleware(
+    IdempotencyWSGIMiddleware(AdmissionWSGIMiddleware(app.wsgi_app, read_limiter, write_limiter),
+                              idempotency_store, ["/contacts"], IDEMPOTENCY_WAIT), metrics)
+
 @app.before_request
 def before_request():
-    request.start_time = time.time()
-
-@app.after_request
-def after_request(response):
-    duration = time.time() - request.start_time
-    print(f"Request took {duration} seconds")
-    response.headers['X-Response-Time'] = str(duration)
-    return response
+    # route template for the metrics middleware
+    if request.url_rule is not None:
+        request.environ[ROUTE_KEY] = request.url_rule.rule
 
 # Configure connection string to your database
-engine = create_engine('sqlite:///contacts.db')
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///contacts.db")
+# one pooled connection per request thread; requests beyond pool_size +
+# max_overflow wait up to pool_timeout seconds for a connection
+engine = create_engine(DATABASE_URL,
+                       pool_size=int(os.environ.get("DB_POOL_SIZE", 10)),
+                       max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+                       pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)))
+# statement counts and DB time per request, for Server-Timing and /metrics
+instrument_engine(engine)
+# WAL and a busy timeout, so worker processes can share the file
+configure_sqlite(engine)
+
+# (matm_owner, username, contact_id) of opt-in rows by email / phonenumber
+identity_cache = IdentityCache(int(os.environ.get("IDENTITY_CACHE_SIZE", 100_000)))
+metrics.add_gauges("identity_cache", identity_cache.stats)
+
+# encoded GET responses, invalidated by per-table write versions
+response_cache = ResponseCache(int(os.environ.get("RESPONSE_CACHE_BYTES", 32 * 1024 * 1024)))
+metrics.add_gauges("response_cache", response_cache.stats)
+
+# "python": cached per-field lookups classified in Python; "sql": one statement
+MATCH_RESOLUTION = os.environ.get("MATCH_RESOLUTION", "python")
 
 # Create a declarative base for ORM classes
 Base = declarative_base()
@@ -74,12 +145,14 @@ class ContactPointPhoneSchema(Schema):
 
 class IndividualSchema(Schema):
     username = fields.Str(required=True)  # Consider changing type to String
-    individual_id = fields.Int(required=True)
+    individual_id = fields.Str(required=True)
 
 
 # Define ORM classes based on provided schema
 class Contact(Base):
     __tablename__ = "contacts"
+    # generated ids are short; a collision fails the insert and is retried (common/upsert.py)
+    __table_args__ = (Index("uq_contacts_contact_id", "contact_id", unique=True),)
 
     id = Column(Integer, primary_key=True, nullable=False)
     username = Column(String, nullable=False)
@@ -90,7 +163,7 @@ class Contact(Base):
     email_opt_in_status = Column(Boolean, nullable=False)
     sms_opt_in_status = Column(Boolean, nullable=False)
     matm_owner = Column(String, nullable=False)
-    individual_id = Column(String, nullable=True)
+    individual_id = Column(String, nullable=True, index=True)
     status = Column(String, nullable=True)
     contact_id = Column(String, nullable=True)
 
@@ -98,6 +171,9 @@ class Contact(Base):
 class ContactPointEmail(Base):
     __tablename__ = "email_opt_in"
 
+    # POST /contacts dedup lookup and upsert key: by email, then matm_owner/username
+    __table_args__ = (Index("uq_email_opt_in_email_owner_user", "email", "matm_owner", "username", unique=True),)
+
     id = Column(Integer, primary_key=True, nullable=False)
     username = Column(String, nullable=False)
     email = Column(String, nullable=False)
@@ -110,6 +186,10 @@ class ContactPointEmail(Base):
 class ContactPointPhone(Base):
     __tablename__ = "mobile_opt_in"
 
+    # POST /contacts dedup lookup and upsert key: by phonenumber, then matm_owner/username
+    __table_args__ = (Index("uq_mobile_opt_in_phone_owner_user", "phonenumber", "matm_owner", "username",
+                            unique=True),)
+
     id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
     username = Column(String, nullable=False)
     phonenumber = Column(Integer, nullable=False)
@@ -126,150 +206,358 @@ class Individual(Base):
     username = Column(Integer, nullable=False)  # Consider changing type to String
     individual_id = Column(Integer, nullable=False)
 
+
+class IndividualLink(Base):
+    """Union-find over individual ids, see common/identity_graph.py."""
+    __tablename__ = "individual_links"
+
+    individual_id = Column(String, primary_key=True, nullable=False)
+    parent = Column(String, nullable=False, index=True)
+    size = Column(Integer, nullable=False)
+
+
+def create_indexes(conn):
+    """Add indexes missing from databases created before they were declared."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            create_index(conn, index)
+
+
 # Create database tables (Comment out after initial creation)
 Base.metadata.create_all(engine)
+with engine.begin() as conn:
+    create_indexes(conn)
 
 # Create a session object
 Session = sessionmaker(bind=engine)
-session = Session()
+# one session per request thread, removed (and its connection returned to the
+# pool) when the request's app context ends
+session = scoped_session(Session)
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    session.remove()
 
 contact_schema = ContactSchema(many=True)
+contact_create_schema = ContactSchema()
+# bodies that are already valid ContactSchema input skip marshmallow
+contact_parser = ContactParser({name: (False, False) for name in
+                                ('country', 'state', 'individual_id', 'status', 'contact_id')}, allow_unknown=False)
 email_schema = ContactPointEmailSchema(many=True)
 mobile_schema = ContactPointPhoneSchema(many = True)
-individual_schema = ContactPointEmailSchema(many = True)
+individual_schema = IndividualSchema(many = True)
+
+# Schema is created at import time above, so the app is ready once it serves
+@app.route('/health/live', methods=['GET'])
+def liveness():
+    return jsonify({'status': 'ok'})
+
+@app.route('/health/ready', methods=['GET'])
+def readiness():
+    return jsonify({'status': 'ready'})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+def page_args():
+    """(limit, after) from the query string, or None if either is invalid."""
+    try:
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        return None
+    if (limit is not None and limit < 1) or after < 0:
+        return None
+    return page_size(limit), after
+
+def cached_response(entry):
+    """The cached body with its ETag, or 304 if the client already has it."""
+    if etag_matches(request.headers.get('If-None-Match'), entry.etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, mimetype=JSON_MEDIA_TYPE)
+    response.headers['ETag'] = entry.etag
+    return response
+
+def list_page(key, model, schema):
+    """One page of `model` as plain rows of the schema's fields, encoded straight to JSON bytes and cached."""
+    args = page_args()
+    if args is None:
+        return jsonify({'message': 'limit must be a positive integer and after a non-negative integer'}), 400
+    limit, after = args
+    cache_key = (request.path, limit, after)
+    entry, versions = response_cache.lookup(cache_key, (model.__tablename__,))
+    if entry is None:
+        columns = list(schema.fields)
+        rows = session.execute(page_statement(model, limit, after, columns))
+        entry = response_cache.store(cache_key, versions, dumps(page(key, rows, limit, columns)))
+    return cached_response(entry)
 
 @app.route('/contacts', methods=['GET'])
 def get_contacts():
-    # Get all contacts
-    contacts = session.query(Contact).all()
-    return jsonify(contact_schema.dump(contacts))
+    return list_page('contacts', Contact, contact_schema)
+
+match_contact_statement = match_statement(Contact)
+
+def find_identities(model, field, value, cached=True):
+    """(matm_owner, username, contact_id) of the opt-in rows where `field == value`."""
+    rows = identity_cache.get(field, value) if cached else None
+    if rows is None:
+        try:
+            rows = [IdentityRow(*row) for row in session.query(model.matm_owner, model.username, model.contact_id)
+                    .filter(getattr(model, field) == value).order_by(model.id)]
+        except BaseException:
+            if cached:
+                identity_cache.abandon(field, value)
+            raise
+        if cached:
+            identity_cache.fill(field, value, rows)
+    return rows
+
+def resolve_match(data, cached=True):
+    """
+    Match for the incoming contact, plus the matched Contact when it came back
+    in the same round trip (MATCH_RESOLUTION=sql), else None.
+    """
+    if MATCH_RESOLUTION == "sql":
+        row = session.execute(match_contact_statement, {
+            'email': data.email, 'phonenumber': data.phonenumber,
+            'matm_owner': data.matm_owner, 'username': data.username}).one()
+        return match_from_row(row), row[0]
+    phone = find_identities(ContactPointPhone, 'phonenumber', data.phonenumber, cached)
+    email = find_identities(ContactPointEmail, 'email', data.email, cached)
+    return match_identities(email, phone, data.matm_owner, data.username), None
+
+def individual_links(contact_ids):
+    """IndividualLinks holding the paths from the individuals of `contact_ids` to their roots."""
+    if not contact_ids:
+        return IndividualLinks()
+    return IndividualLinks(session.execute(contact_walk_statement(Contact, IndividualLink, contact_ids)))
 
 @app.route('/contacts', methods=['POST'])    
 def post_contact():
     start_time = time.time()
-    content = request.get_json()
-    schema = ContactSchema()
     # Validate data
-    errors = schema.validate(content)
-    if errors:
-        return jsonify(errors), 400  # Bad request
+    with timed('validation'):
+        data = contact_parser.parse(request.get_data()) if request.is_json else None
+        if data is None:
+            content = request.get_json()
+            errors = contact_create_schema.validate(content)
+            if errors:
+                return jsonify(errors), 400  # Bad request
+            data = ContactRecord.from_dict(content)
+
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            message = save_contact(data, start_time, attempt)
+            break
+        except (StaleMatch, IntegrityError):
+            session.rollback()
+            if attempt == WRITE_ATTEMPTS:
+                raise
+    duration = time.time() - start_time
 
+    return jsonify({'message': message, 'username': data.username, 'time taken':duration}), 201
+
+def save_contact(data, start_time, attempt):
+    """Match and write one contact in a single transaction; returns the response message."""
     new_contact = Contact(
-        username=content['username'],
-        phonenumber=content['phonenumber'],
-        country=content.get('country'),
-        state=content.get('state'),
-        email=content['email'],
-        email_opt_in_status=content['email_opt_in_status'],
-        sms_opt_in_status=content['sms_opt_in_status'],
-        matm_owner=content['matm_owner'],
-        individual_id=content.get('individual_id'),
-        status=content.get('status'),
-        contact_id=content.get('contact_id')
+        username=data.username,
+        phonenumber=data.phonenumber,
+        country=data.country,
+        state=data.state,
+        email=data.email,
+        email_opt_in_status=data.email_opt_in_status,
+        sms_opt_in_status=data.sms_opt_in_status,
+        matm_owner=data.matm_owner,
+        individual_id=data.individual_id,
+        status=data.status,
+        contact_id=data.contact_id
     )
 
     message = "Contact added successfully"
     new_contact.contact_id = uuid4().hex[:8]
-
-    new_contact.contact_id = uuid4().hex[:8]
-    phone = session.query(ContactPointPhone).filter_by(phonenumber = content['phonenumber']).all()
-    email = session.query(ContactPointEmail).filter_by(email = content['email']).all()
-    print(type(phone))
-    print(type(email))
-    matched_contacts = []
-    matched_individuals = []
-    try:
-        for result_email in email:
-            if result_email.matm_owner == content['matm_owner'] and result_email.username == content['username']:
-                matched_contacts.append(result_email.contact_id)
-            elif result_email.matm_owner == content['matm_owner'] and result_email.username != content['username']:
-                raise ValueError("matching error on contact data")
-            elif result_email.matm_owner != content['matm_owner'] and result_email.username == content['username']:
-                matched_individuals.append(result_email.contact_id)
-
-        for result_phone in phone:
-            if result_phone.matm_owner == content['matm_owner'] and result_phone.username == content['username']:
-                matched_contacts.append(result_phone.contact_id)
-            elif result_phone.matm_owner == content['matm_owner'] and result_phone.username != content['username']:
-                raise ValueError("matching error on contact data")
-            elif result_phone.matm_owner != content['matm_owner'] and result_phone.username == content['username']:
-                matched_individuals.append(result_phone.contact_id)
-
-    except Exception as error:
-        new_contact.status = message = str(error)
+    # a retry reads past the identity cache
+    match, matched_contact = resolve_match(data, cached=attempt == 1)
+    if match.conflict:
+        new_contact.status = message = MATCH_ERROR
     
-    if matched_contacts:
-        new_contact = session.query(Contact).filter_by(contact_id = matched_contacts[0]).first()
-        new_contact.state = content["state"]
-        new_contact.country = content["country"]
+    if match.contact_id:
+        new_contact = matched_contact or session.query(Contact).filter_by(contact_id = match.contact_id).first()
+        new_contact.state = data.state
+        new_contact.country = data.country
         new_contact.status = f"updated - {start_time - time.time()}"
         message = "contact Updated"
 
-    elif matched_individuals:
-        individual_id = session.query(Contact.individual_id).filter_by(contact_id = matched_individuals[0]).first()
-        new_contact.individual_id == individual_id
+    elif match.individual_contact_id:
         new_contact.status = f"created - {time.time()}"
 
-    if message == "Contact added successfully" or matched_individuals:
+    if not match.contact_id:
+        # joins the individuals of its matches, or starts a new one
+        links = individual_links(match.individual_contact_ids)
+        new_contact.individual_id = links.assign()
+        for statement, params in link_statements(IndividualLink, links):
+            check_updated(statement, params, session.execute(statement, params))
+
+    written = []
+    if message == "Contact added successfully" or match.individual_contact_id:
+        for model, field in ((ContactPointEmail, 'email'), (ContactPointPhone, 'phonenumber')):
+            result = session.execute(opt_in_insert(model), {
+                'username': new_contact.username,
+                field: getattr(new_contact, field),
+                'country': new_contact.country,
+                'state': new_contact.state,
+                'matm_owner': new_contact.matm_owner,
+                'contact_id': new_contact.contact_id,
+            })
+            if not match.contact_id:
+                check_created(result, final=attempt == WRITE_ATTEMPTS)
+            if result.rowcount:
+                written.append((model, field))
 
-        try:
-            email_opt_in = ContactPointEmail(
-                username=new_contact.username,
-                email=new_contact.email,
-                country=new_contact.country,
-                state=new_contact.state,
-                matm_owner = new_contact.matm_owner,
-                contact_id = new_contact.contact_id
-            )
-            session.add(email_opt_in)
-        except Exception as e:
-            print(e)
-
-        try:
-            mobile_opt_in = ContactPointPhone(
-                username=new_contact.username,
-                phonenumber=new_contact.phonenumber,
-                country=new_contact.country,
-                state=new_contact.state,
-                matm_owner = new_contact.matm_owner,
-                contact_id = new_contact.contact_id
-            )
-            session.add(mobile_opt_in)
-        except Exception as e:
-            print(e)
-        
-    
     session.add(new_contact)
 
     session.commit()
+    response_cache.bump(Contact.__tablename__)
+    identity_row = IdentityRow(new_contact.matm_owner, new_contact.username, new_contact.contact_id)
+    for model, field in written:
+        identity_cache.add(field, getattr(new_contact, field), identity_row)
+        response_cache.bump(model.__tablename__)
+    return message
+
+@app.route('/contacts/bulk', methods=['POST'])
+def post_contacts_bulk():
+    """JSON array or NDJSON of contacts, matched as sequential POSTs and written in one transaction."""
+    start_time = time.time()
+    body = request.get_data()
+    try:
+        with timed("validation"):
+            rows = parse_body(body, request.content_type)
+    except BulkBodyError as error:
+        return jsonify({'message': str(error)}), 400
+
+    valid, errors = [], []
+    with timed('validation'):
+        for position, row in enumerate(rows):
+            record = contact_parser.check(row)
+            if record is not None:
+                valid.append((position, record.contact_fields()))
+                continue
+            # the loaded values, as a POST stores them: a phonenumber sent as a string is an int
+            try:
+                valid.append((position, contact_create_schema.load(row)))
+            except ValidationError as error:
+                errors.append((position, error.messages))
+
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            plan = save_batch(valid)
+            break
+        except (StaleMatch, IntegrityError):
+            session.rollback()
+            if attempt == WRITE_ATTEMPTS:
+                raise
+    response_cache.bump(Contact.__tablename__, ContactPointEmail.__tablename__, ContactPointPhone.__tablename__)
+
+    for row in plan.email_opt_ins:
+        identity_cache.add('email', row['email'], IdentityRow(row['matm_owner'], row['username'], row['contact_id']))
+    for row in plan.phone_opt_ins:
+        identity_cache.add('phonenumber', row['phonenumber'], IdentityRow(row['matm_owner'], row['username'], row['contact_id']))
+
     duration = time.time() - start_time
+    return jsonify({'results': merge_results(plan, errors), **plan.summary(), 'time taken': duration}), 201
+
+def save_batch(valid):
+    """Match and write the valid rows of a batch in a single transaction; returns the plan."""
+    email_index, phone_index = {}, {}
+    for statement in lookup_statements(ContactPointEmail, 'email', {data['email'] for _, data in valid}):
+        add_rows(email_index, session.execute(statement))
+    for statement in lookup_statements(ContactPointPhone, 'phonenumber', {data['phonenumber'] for _, data in valid}):
+        add_rows(phone_index, session.execute(statement))
+    contact_index = {}
+    for statement in contact_statements(Contact, email_index, phone_index):
+        add_contacts(contact_index, session.execute(statement))
+    links = IndividualLinks()
+    for statement in walk_statements(IndividualLink, contact_individuals(contact_index)):
+        links.add_rows(session.execute(statement))
+    contact_ids, taken = new_contact_ids(len(valid)), set()
+    for statement in taken_statements(Contact, contact_ids):
+        taken.update(session.execute(statement).scalars())
+    plan = plan_batch(valid, email_index, phone_index, contact_index, links=links,
+                      contact_ids=replace_taken(contact_ids, taken))
 
-    return jsonify({'message': message, 'username': content['username'], 'time taken':duration}), 201
+    try:
+        for statement, params in plan_statements(plan, Contact, ContactPointEmail, ContactPointPhone,
+                                                 link_model=IndividualLink):
+            check_updated(statement, params, session.execute(statement, params))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return plan
+
+def export_response(model):
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in MEDIA_TYPES:
+        return jsonify({'message': f"format must be one of {', '.join(MEDIA_TYPES)}"}), 400
+    export = Export(model, fmt)
+    return Response(export.stream(engine), mimetype=export.media_type, headers=export.headers)
+
+@app.route('/contacts/export', methods=['GET'])
+def export_contacts():
+    return export_response(Contact)
+
+@app.route('/email/export', methods=['GET'])
+def export_email():
+    return export_response(ContactPointEmail)
+
+@app.route('/mobile/export', methods=['GET'])
+def export_mobile():
+    return export_response(ContactPointPhone)
 
 @app.route('/contacts/<int:id>', methods=['GET'])
 def contact(id):
     # Get contact by id
-    contact = session.query(Contact).filter_by(id=id).first()
-    if not contact:
-        return jsonify({'message': 'Contact not found'}), 404  # Not found
-
-    return jsonify(ContactSchema().dump(contact))
+    cache_key = (request.path,)
+    entry, versions = response_cache.lookup(cache_key, (Contact.__tablename__,))
+    if entry is None:
+        columns = list(contact_create_schema.fields)
+        contact = session.execute(select(*(Contact.__table__.c[name] for name in columns))
+                                  .where(Contact.id == id)).first()
+        if not contact:
+            return jsonify({'message': 'Contact not found'}), 404  # Not found
+        entry = response_cache.store(cache_key, versions, dumps(dict(zip(columns, contact))))
+    return cached_response(entry)
 
     
 @app.route('/email', methods=['GET'])
 def get_email():
-    emails = session.query(ContactPointEmail).all()
-    return jsonify(email_schema.dump(emails))
+    return list_page('email', ContactPointEmail, email_schema)
 
 @app.route('/mobile', methods=['GET'])
 def get_phone():
-    mobile = session.query(ContactPointPhone).all()
-    return jsonify(mobile_schema.dump(mobile))
+    return list_page('mobile', ContactPointPhone, mobile_schema)
 
 @app.route('/individual', methods=['GET'])
 def get_individual():
-    individual = session.query(ContactPointPhone).all()
-    return jsonify(individual_schema.dump(individual))
+    return list_page('individuals', Individual, individual_schema)
+
+@app.route('/individual/<individual_id>/contacts', methods=['GET'])
+def get_individual_contacts(individual_id):
+    # links only change when a contact is created, which bumps the contacts version
+    cache_key = (request.path,)
+    entry, versions = response_cache.lookup(cache_key, (Contact.__tablename__,))
+    if entry is None:
+        links = IndividualLinks(session.execute(walk_statement(IndividualLink, [individual_id])))
+        if individual_id not in links.parent:
+            return jsonify({'message': 'Individual not found'}), 404
+        root = links.find(individual_id)
+        columns = list(contact_create_schema.fields)
+        contacts = session.execute(members_statement(Contact, IndividualLink, root, columns))
+        entry = response_cache.store(cache_key, versions, dumps(
+            {'individual_id': root, 'contacts': [dict(zip(columns, row)) for row in contacts]}))
+    return cached_response(entry)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,227 @@
+"""
+Import a large CSV or NDJSON file of contacts straight into an app's database.
+
+The file is streamed through a generator pipeline (read, validate, chunk) so
+memory stays flat whatever its size. Rows are validated with the app's own
+rules (ContactSchema for flask, ContactBase for the FastAPI apps) and matched
+exactly as POST /contacts would match them, one chunk at a time. Each chunk is
+written with executemany in one transaction together with a checkpoint, so an
+interrupted import resumes after the last committed chunk when run again.
+
+    python import_contacts.py --app flask contacts.db dump.csv --chunk 5000
+    python import_contacts.py --app fastapi db.sqlite3 dump.ndjson --errors rejected.ndjson
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+from sqlalchemy import Boolean, Column, Integer, MetaData, String, Table, create_engine, select
+from sqlalchemy.exc import IntegrityError
+
+from common.apps import APP_NAMES, load_app
+from common.bulk import (add_contacts, add_rows, contact_individuals, contact_statements, lookup_statements,
+                         new_contact_ids, plan_batch, plan_statements, replace_taken, taken_statements)
+from common.identity_graph import IndividualLinks, walk_statements
+from common.matching import MATCH_ERROR
+from common.sqlite import configure_sqlite
+from common.upsert import WRITE_ATTEMPTS, StaleMatch, check_updated
+
+DEFAULT_CHUNK = 1000
+
+# one row per imported file: data rows committed so far, and whether it finished
+checkpoints = Table(
+    "import_checkpoint", MetaData(),
+    Column("source", String, primary_key=True),
+    Column("rows", Integer, nullable=False),
+    Column("finished", Boolean, nullable=False),
+)
+
+
+def read_records(path, fmt):
+    """(line number, raw record or None, parse error or None) for each data row."""
+    with open(path, newline="", encoding="utf-8") as handle:
+        if fmt == "csv":
+            reader = csv.DictReader(handle)
+            for record in reader:
+                # empty cells are missing optional fields, not empty strings
+                yield reader.line_num, {k: v for k, v in record.items() if k and v not in ("", None)}, None
+            return
+        for number, line in enumerate(handle, 1):
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line), None
+            except ValueError as error:
+                yield number, None, f"invalid JSON: {error}"
+
+
+def validator(app, module):
+    """Function turning a raw record into (contact dict, None) or (None, errors)."""
+    if app == "flask":
+        from marshmallow import ValidationError
+        schema = module.ContactSchema()
+
+        def validate(record):
+            try:
+                return schema.load(record), None
+            except ValidationError as error:
+                return None, error.messages
+        return validate
+
+    def validate(record):
+        try:
+            return dict(module.ContactBase(**record)), None
+        except ValueError as error:
+            return None, json.loads(error.json())
+    return validate
+
+
+def validated(records, validate, start=0):
+    """(position, line, contact, errors) with positions counting data rows from `start`."""
+    for position, (line, record, error) in enumerate(records, start):
+        if error is None and not isinstance(record, dict):
+            error = "contact must be a JSON object"
+        if error is not None:
+            yield position, line, None, error
+            continue
+        contact, errors = validate(record)
+        yield position, line, contact, errors
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def import_chunk(conn, module, chunk, record_individuals):
+    """Match and write one chunk in the caller's transaction; return its plan."""
+    Contact, Email, Phone = module.Contact, module.ContactPointEmail, module.ContactPointPhone
+    valid = [(position, contact) for position, _, contact, _ in chunk if contact is not None]
+    email_index, phone_index, contact_index = {}, {}, {}
+    for statement in lookup_statements(Email, "email", {data["email"] for _, data in valid}):
+        add_rows(email_index, conn.execute(statement))
+    for statement in lookup_statements(Phone, "phonenumber", {data["phonenumber"] for _, data in valid}):
+        add_rows(phone_index, conn.execute(statement))
+    for statement in contact_statements(Contact, email_index, phone_index):
+        add_contacts(contact_index, conn.execute(statement))
+    links = IndividualLinks()
+    for statement in walk_statements(module.IndividualLink, contact_individuals(contact_index)):
+        links.add_rows(conn.execute(statement))
+    contact_ids, taken = new_contact_ids(len(valid)), set()
+    for statement in taken_statements(Contact, contact_ids):
+        taken.update(conn.execute(statement).scalars())
+    plan = plan_batch(valid, email_index, phone_index, contact_index, record_individuals=record_individuals,
+                      links=links, contact_ids=replace_taken(contact_ids, taken))
+    individual = module.Individual if record_individuals else None
+    for statement, params in plan_statements(plan, Contact, Email, Phone, individual, module.IndividualLink):
+        check_updated(statement, params, conn.execute(statement, params))
+    return plan
+
+
+def load_checkpoint(conn, source):
+    row = conn.execute(select(checkpoints.c.rows, checkpoints.c.finished)
+                       .where(checkpoints.c.source == source)).first()
+    return (row.rows, row.finished) if row else (0, False)
+
+
+def save_checkpoint(conn, source, rows, finished):
+    updated = conn.execute(checkpoints.update().where(checkpoints.c.source == source)
+                           .values(rows=rows, finished=finished))
+    if not updated.rowcount:
+        conn.execute(checkpoints.insert().values(source=source, rows=rows, finished=finished))
+
+
+def run_import(args):
+    module = load_app(args.app, database=args.database)
+    engine = create_engine(f"sqlite:///{args.database}")
+    # can run while the app is serving the same file
+    configure_sqlite(engine)
+    module.Base.metadata.create_all(engine)
+    checkpoints.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        module.create_indexes(conn)
+
+    source = os.path.abspath(args.file)
+    fmt = args.format or ("csv" if args.file.lower().endswith(".csv") else "ndjson")
+    with engine.begin() as conn:
+        if args.restart:
+            save_checkpoint(conn, source, 0, False)
+        done, finished = load_checkpoint(conn, source)
+    if finished:
+        print(f"{args.file} was already imported ({done} rows); use --restart to import it again")
+        return 0
+    if done:
+        print(f"resuming {args.file} after row {done}")
+
+    # the FastAPI apps record an Individual for updates and conflicts, as they do per POST
+    record_individuals = args.app != "flask"
+    rows = validated(islice(read_records(args.file, fmt), done, None), validator(args.app, module), done)
+    errors = open(args.errors, "a", encoding="utf-8") if args.errors else None
+    totals = {"rows": 0, "inserted": 0, "updated": 0, "conflicts": 0, "failed": 0}
+    start = last_report = time.perf_counter()
+    try:
+        for chunk in chunked(rows, args.chunk):
+            for attempt in range(1, WRITE_ATTEMPTS + 1):
+                try:
+                    with engine.begin() as conn:
+                        plan = import_chunk(conn, module, chunk, record_individuals)
+                        save_checkpoint(conn, source, done + totals["rows"] + len(chunk), False)
+                    break
+                except (StaleMatch, IntegrityError):
+                    # a server on the same file changed links this chunk walked, or a new contact_id collided
+                    if attempt == WRITE_ATTEMPTS:
+                        raise
+
+            summary = plan.summary()
+            totals["rows"] += len(chunk)
+            totals["inserted"] += summary["inserted"]
+            totals["updated"] += summary["updated"]
+            totals["conflicts"] += sum(1 for r in plan.results if r["message"] == MATCH_ERROR)
+            for position, line, contact, row_errors in chunk:
+                if contact is None:
+                    totals["failed"] += 1
+                    if errors:
+                        errors.write(json.dumps({"row": position + 1, "line": line, "errors": row_errors}) + "\n")
+
+            now = time.perf_counter()
+            if now - last_report >= args.progress:
+                last_report = now
+                report(totals, now - start, sys.stderr)
+    finally:
+        if errors:
+            errors.close()
+
+    with engine.begin() as conn:
+        save_checkpoint(conn, source, done + totals["rows"], True)
+    report(totals, time.perf_counter() - start, sys.stdout)
+    return 0
+
+
+def report(totals, elapsed, stream):
+    rate = totals["rows"] / elapsed if elapsed else 0.0
+    print(f"{totals['rows']} rows ({totals['inserted']} inserted, {totals['updated']} updated, "
+          f"{totals['conflicts']} conflicts, {totals['failed']} failed) in {elapsed:.1f}s, {rate:.0f} rows/s",
+          file=stream, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a CSV or NDJSON file of contacts into a database.")
+    parser.add_argument("--app", choices=APP_NAMES, required=True, help="app whose models and validation to use")
+    parser.add_argument("database", help="sqlite database file")
+    parser.add_argument("file", help="contacts file, .csv or NDJSON")
+    parser.add_argument("--format", choices=("csv", "ndjson"), help="default: from the file extension")
+    parser.add_argument("--chunk", type=int, default=DEFAULT_CHUNK, help="rows per transaction")
+    parser.add_argument("--errors", help="append rejected rows to this NDJSON file")
+    parser.add_argument("--progress", type=float, default=2.0, help="seconds between progress lines")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and import from the start")
+    args = parser.parse_args()
+    raise SystemExit(run_import(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Bring an existing database file up to the current schema: missing tables and
+missing indexes are created, and the lookup indexes the unique ones replace
+are dropped; existing data is left alone. The apps do the same
+on startup; this is for migrating a db.sqlite3/contacts.db offline.
+
+    python migrate.py --app fastapi db.sqlite3
+    python migrate.py --app flask contacts.db
+"""
+import argparse
+
+from sqlalchemy import create_engine, inspect
+
+from common.apps import APP_NAMES, load_app
+
+
+def index_names(engine):
+    inspector = inspect(engine)
+    return {(table, index["name"]) for table in inspector.get_table_names()
+            for index in inspector.get_indexes(table)}
+
+
+def migrate(app, path):
+    engine = create_engine(f"sqlite:///{path}")
+    before = index_names(engine)
+    module = load_app(app, database=path)
+    module.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        module.create_indexes(conn)
+    after = index_names(engine)
+    return sorted(after - before), sorted(before - after)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add missing tables and indexes to a database file.")
+    parser.add_argument("--app", choices=APP_NAMES, required=True, help="app whose models define the schema")
+    parser.add_argument("path", help="sqlite database file")
+    args = parser.parse_args()
+
+    created, dropped = migrate(args.app, args.path)
+    for table, name in created:
+        print(f"created {name} on {table}")
+    for table, name in dropped:
+        print(f"dropped {name} on {table}")
+    if not created and not dropped:
+        print("schema already up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Classify a CSV or NDJSON file of contacts against an app's database without
+writing to it: for every row, whether POST /contacts would update an existing
+contact, hit an owner conflict, join another owner's individual or create a
+new contact.
+
+The opt-in tables are read once into a MatchSnapshot (common/batch_match.py)
+and the file is validated with the app's own rules and classified --chunk
+rows at a time. Every row is matched against the database as it is; rows of
+the file do not see each other, as they would in an import.
+
+    python reconcile.py --app flask contacts.db dump.csv --output outcomes.ndjson
+"""
+import argparse
+import json
+import sys
+import time
+from collections import Counter
+
+from sqlalchemy import create_engine
+
+from common.apps import APP_NAMES, load_app
+from common.batch_match import OUTCOMES, MatchSnapshot, numpy, outcomes, snapshot_statements
+from common.sqlite import configure_sqlite
+from import_contacts import chunked, read_records, validated, validator
+
+DEFAULT_CHUNK = 100_000
+
+
+def run_reconcile(args):
+    module = load_app(args.app, database=args.database)
+    engine = create_engine(f"sqlite:///{args.database}")
+    configure_sqlite(engine)
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        email_rows, phone_rows = (conn.execute(statement).all()
+                                  for statement in snapshot_statements(module.ContactPointEmail,
+                                                                       module.ContactPointPhone))
+    snapshot = MatchSnapshot(email_rows, phone_rows)
+    del email_rows, phone_rows
+    print(f"loaded {len(snapshot)} opt-in rows in {time.perf_counter() - start:.1f}s"
+          f"{'' if numpy is not None else ' (numpy not installed, matching per row)'}", file=sys.stderr)
+
+    fmt = args.format or ("csv" if args.file.lower().endswith(".csv") else "ndjson")
+    rows = validated(read_records(args.file, fmt), validator(args.app, module))
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    totals = Counter()
+    start = time.perf_counter()
+    try:
+        for chunk in chunked(rows, args.chunk):
+            valid = [contact for _, _, contact, _ in chunk if contact is not None]
+            matches = snapshot.classify([contact["email"] for contact in valid],
+                                        [contact["phonenumber"] for contact in valid],
+                                        [contact["matm_owner"] for contact in valid],
+                                        [contact["username"] for contact in valid])
+            kinds = outcomes(matches)
+            totals.update(kinds)
+            totals["failed"] += len(chunk) - len(valid)
+            if output:
+                results = iter(zip(matches, kinds))
+                for position, line, contact, errors in chunk:
+                    result = {"row": position + 1, "line": line}
+                    if contact is None:
+                        result["errors"] = errors
+                    else:
+                        match, kind = next(results)
+                        result.update(outcome=kind, contact_id=match.contact_id,
+                                      individual_contact_ids=list(match.individual_contact_ids))
+                    output.write(json.dumps(result) + "\n")
+    finally:
+        if output:
+            output.close()
+
+    elapsed = time.perf_counter() - start
+    count = sum(totals.values())
+    print(f"{count} rows ({', '.join(f'{totals[kind]} {kind}' for kind in OUTCOMES)}, {totals['failed']} failed) "
+          f"in {elapsed:.1f}s, {count / elapsed if elapsed else 0.0:.0f} rows/s")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify a file of contacts against a database without writing.")
+    parser.add_argument("--app", choices=APP_NAMES, required=True, help="app whose models and validation to use")
+    parser.add_argument("database", help="sqlite database file")
+    parser.add_argument("file", help="contacts file, .csv or NDJSON")
+    parser.add_argument("--format", choices=("csv", "ndjson"), help="default: from the file extension")
+    parser.add_argument("--chunk", type=int, default=DEFAULT_CHUNK, help="rows per classify() call")
+    parser.add_argument("--output", help="write one NDJSON result per row to this file")
+    args = parser.parse_args()
+    raise SystemExit(run_reconcile(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Serve one of the apps with several worker processes.
+
+    python serve.py fastapi --workers 4 --loop uvloop --http httptools
+    python serve.py fastapi_sync --workers 4 --database /srv/contacts.db
+    python serve.py flask --workers 4 --threads 8
+
+The FastAPI apps run under uvicorn; --loop and --http pick the event loop and
+HTTP parser (uvloop and httptools when installed, with "auto"). Flask runs
+under gunicorn with threaded workers when gunicorn is installed, and on the
+single-process development server otherwise.
+
+Before any worker starts the database is prepared once: schema and indexes
+created, WAL switched on, and the file read through so its pages are in the
+OS cache. That way the workers don't race each other to create the schema.
+Every connection then applies the --sqlite-profile preset (common/sqlite.py):
+WAL, busy timeout, synchronous level, page cache and mmap size. Once
+/health/ready answers, --warmup requests go to the read endpoints over fresh
+connections so they spread across the workers.
+
+The identity and response caches live in each process and can't see other
+workers' writes. With more than one worker they are off unless
+IDENTITY_CACHE_SIZE / RESPONSE_CACHE_BYTES are set explicitly.
+"""
+import argparse
+import importlib.util
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import requests
+from sqlalchemy import create_engine, make_url, text
+
+from common.apps import APP_NAMES, ROOT, load_app
+from common.sqlite import PROFILES, SQLITE_PROFILE, configure_sqlite
+
+DEFAULT_PORTS = {"flask": 5000, "fastapi": 8000, "fastapi_sync": 8001}
+
+# database file each app uses when neither --database nor DATABASE_URL is set
+DEFAULT_DATABASES = {"flask": "contacts.db", "fastapi": "db.sqlite3", "fastapi_sync": "contacts.db"}
+
+WARMUP_PATHS = ("/contacts?limit=100", "/contacts/1", "/email?limit=100", "/mobile?limit=100")
+
+STARTUP_TIMEOUT = 30
+
+HAVE_GUNICORN = importlib.util.find_spec("gunicorn") is not None
+
+
+def database_path(app, database=None):
+    """Absolute path of the sqlite file `app` will serve."""
+    if database is None:
+        url = os.environ.get("DATABASE_URL")
+        database = make_url(url).database if url else DEFAULT_DATABASES[app]
+    return os.path.abspath(database)
+
+
+def prepare_database(app, path, profile=None):
+    """Create the schema and indexes, set the journal mode and pull the file into the page cache."""
+    module = load_app(app, database=path, module_name=f"{app}_serve")
+    # flask and fastapi_sync connect at import; changing the journal mode needs the file to ourselves
+    getattr(module.engine, "sync_engine", module.engine).dispose()
+    engine = create_engine(f"sqlite:///{path}")
+    configure_sqlite(engine, profile)
+    module.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        module.create_indexes(conn)
+        conn.execute(text("PRAGMA optimize"))
+    engine.dispose()
+    with open(path, "rb") as f:
+        while f.read(1 << 20):
+            pass
+
+
+def server_command(args):
+    app_dir = os.path.join(ROOT, args.app)
+    if args.app == "flask":
+        if HAVE_GUNICORN:
+            return [sys.executable, "-m", "gunicorn", "app:app", "--chdir", app_dir,
+                    "--bind", f"{args.host}:{args.port}", "--workers", str(args.workers),
+                    "--worker-class", "gthread", "--threads", str(args.threads), "--log-level", args.log_level]
+        if args.workers > 1:
+            sys.exit("serving flask with more than one worker needs gunicorn")
+        return [sys.executable, "-m", "flask", "--app", os.path.join(app_dir, "app.py"), "run",
+                "--host", args.host, "--port", str(args.port),
+                "--with-threads" if args.threads > 1 else "--without-threads"]
+    return [sys.executable, "-m", "uvicorn", "app:app", "--app-dir", app_dir,
+            "--host", args.host, "--port", str(args.port), "--workers", str(args.workers),
+            "--loop", args.loop, "--http", args.http, "--log-level", args.log_level]
+
+
+def wait_ready(base_url, process=None, timeout=STARTUP_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            if requests.get(base_url + "/health/ready", timeout=1).status_code == 200:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def warm_up(base_url, count):
+    """`count` GETs over the read endpoints, each on a new connection."""
+    for i in range(count):
+        try:
+            requests.get(base_url + WARMUP_PATHS[i % len(WARMUP_PATHS)], timeout=10)
+        except requests.exceptions.RequestException:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve an app with several worker processes.")
+    parser.add_argument("app", choices=APP_NAMES)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None, help="default 5000 / 8000 / 8001")
+    parser.add_argument("--workers", type=int, default=None, help="default one per core")
+    parser.add_argument("--threads", type=int, default=8, help="threads per flask worker")
+    parser.add_argument("--loop", choices=["auto", "asyncio", "uvloop"], default="auto")
+    parser.add_argument("--http", choices=["auto", "h11", "httptools"], default="auto")
+    parser.add_argument("--database", default=None, help="sqlite file, default from DATABASE_URL")
+    parser.add_argument("--sqlite-profile", choices=list(PROFILES), default=SQLITE_PROFILE,
+                        help="connection PRAGMA preset, default SQLITE_PROFILE or durable")
+    parser.add_argument("--warmup", type=int, default=50, help="GET requests sent once the app is ready")
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args()
+    args.port = args.port or DEFAULT_PORTS[args.app]
+    if args.workers is None:
+        args.workers = 1 if args.app == "flask" and not HAVE_GUNICORN else os.cpu_count() or 1
+
+    path = database_path(args.app, args.database)
+    prepare_database(args.app, path, args.sqlite_profile)
+
+    env = dict(os.environ, SQLITE_PROFILE=args.sqlite_profile)
+    if args.workers > 1:
+        env.setdefault("IDENTITY_CACHE_SIZE", "0")
+        env.setdefault("RESPONSE_CACHE_BYTES", "0")
+    process = subprocess.Popen(server_command(args), env=env)
+    signal.signal(signal.SIGTERM, lambda signum, frame: process.terminate())
+    try:
+        base_url = f"http://{args.host}:{args.port}"
+        if args.warmup and wait_ready(base_url, process):
+            warm_up(base_url, args.warmup)
+            print(f"{args.app} ready on {base_url} with {args.workers} worker(s)", flush=True)
+        return process.wait()
+    except KeyboardInterrupt:
+        process.terminate()
+        return process.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
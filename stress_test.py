@@ -1,20 +1,37 @@
+import argparse
+import math
+import queue
 import random
 import string
+import threading
 import requests
 import time
 import json
+from collections import defaultdict, namedtuple
 
 FASTAPI_URL = "http://127.0.0.1:8000/contacts"
 FLASK_URL = "http://127.0.0.1:5000/contacts"
 
+TARGETS = {"fastapi": FASTAPI_URL, "flask": FLASK_URL}
 
 
-# Number of concurrent requests
+# Number of requests per pass
 NUM_REQUESTS = 50
 
-# Delay between requests (seconds)
+# Delay between requests (seconds), sequential mode only
 DELAY = 0.1
 
+# Number of worker threads (max in-flight requests) in concurrent mode
+CONCURRENCY = 16
+
+# Rows per GET /contacts page when checking for duplicates
+CHECK_PAGE_SIZE = 1000
+
+# Times a page shed with 503 is asked for again, after its Retry-After
+CHECK_ATTEMPTS = 5
+
+RESULT_FILE = "test_result_2.txt"
+
 payload_dict = {
     "username": "zxczxczxc",
     "phonenumber": 2222222222,
@@ -29,7 +46,6 @@ payload_dict = {
 headers = {
     "Content-Type": "application/json",
     "Accept": "*/*",
-    "Host": "127.0.0.1:8000",
     "Accept-Encoding": "gzip, deflate, br",
     "Connection": "keep-alive"
 }
@@ -37,7 +53,12 @@ headers = {
 GET = "get"
 POST = "post"
 
+# One unit of work for the concurrent load generator. `endpoint` is the label
+# the request is reported under.
+Job = namedtuple("Job", ["endpoint", "method", "url", "payload"])
+
 def update_payload(payload):
+    payload = dict(payload)
     payload["username"] =''.join(random.choices(string.ascii_letters, k=8))
     payload["phonenumber"] = random.randint(1000000000, 9999999999)
     payload["email"] = payload["username"] + "@test.com"
@@ -106,13 +127,301 @@ def run_test(call_method,url):
 
     return {"Method": call_method, "Url": url}
 
-result = run_test(POST,FASTAPI_URL)
 
-print(sum(time_taken))
+# CONCURRENT MODE
+
+class LoadStats:
+    """Thread-safe collector of per-endpoint latencies and errors."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.status_codes = defaultdict(lambda: defaultdict(int))
+        self.windows = {}
+        self.timings = defaultdict(list)
+
+    def record(self, endpoint, started, finished, status_code, timing=None):
+        with self.lock:
+            self.latencies[endpoint].append(finished - started)
+            if timing:
+                self.timings[endpoint].append(timing)
+            first, last = self.windows.get(endpoint, (started, finished))
+            self.windows[endpoint] = (min(first, started), max(last, finished))
+            self.status_codes[endpoint][status_code] += 1
+            if status_code is None or status_code >= 400:
+                self.errors[endpoint] += 1
+
+
+def parse_server_timing(value):
+    """{metric: (dur in ms or None, desc or None)} from a Server-Timing header."""
+    metrics = {}
+    for entry in value.split(","):
+        name, *params = (part.strip() for part in entry.split(";"))
+        if not name:
+            continue
+        dur = desc = None
+        for param in params:
+            key, _, param_value = param.partition("=")
+            if key == "dur":
+                dur = float(param_value)
+            elif key == "desc":
+                desc = param_value.strip('"')
+        metrics[name] = (dur, desc)
+    return metrics
+
+
+def timing_breakdown(timings):
+    """Mean server-side ms per phase, statements per request and budget overruns."""
+    count = len(timings)
+    breakdown = {}
+    phases = ("db", "queue", "validation", "serialization")
+    for phase in phases + ("total",):
+        breakdown[phase] = sum((timing.get(phase, (None, None))[0] or 0.0) for timing in timings) / count
+    breakdown["other"] = max(breakdown["total"] - sum(breakdown[phase] for phase in phases), 0.0)
+    queries = [int(timing["db"][1].split()[0]) for timing in timings if timing.get("db", (None, None))[1]]
+    breakdown["queries"] = sum(queries) / len(queries) if queries else 0.0
+    breakdown["over_budget"] = sum("db-budget" in timing for timing in timings)
+    return breakdown
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(stats):
+    """Per-endpoint throughput, error rate and latency percentiles (in ms)."""
+    summary = {}
+    for endpoint, values in stats.latencies.items():
+        values = sorted(values)
+        count = len(values)
+        first, last = stats.windows[endpoint]
+        elapsed = last - first
+        summary[endpoint] = {
+            "requests": count,
+            "errors": stats.errors[endpoint],
+            "error_rate": stats.errors[endpoint] / count,
+            "throughput": count / elapsed if elapsed else 0.0,
+            "p50": percentile(values, 50) * 1000,
+            "p90": percentile(values, 90) * 1000,
+            "p99": percentile(values, 99) * 1000,
+            "max": values[-1] * 1000,
+            "status_codes": {str(code): n for code, n in stats.status_codes[endpoint].items()},
+        }
+        if stats.timings[endpoint]:
+            summary[endpoint]["server_timing"] = timing_breakdown(stats.timings[endpoint])
+    return summary
+
+
+def format_table(summary):
+    lines = [f"{'endpoint':<32}{'reqs':>8}{'req/s':>10}{'err%':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+    for endpoint, row in summary.items():
+        lines.append(
+            f"{endpoint:<32}{row['requests']:>8}{row['throughput']:>10.1f}{row['error_rate'] * 100:>8.2f}"
+            f"{row['p50']:>10.2f}{row['p90']:>10.2f}{row['p99']:>10.2f}{row['max']:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def format_breakdown(summary):
+    """Where the server says the time went, from the Server-Timing headers."""
+    lines = [f"{'endpoint':<32}{'db ms':>10}{'queue ms':>10}{'valid ms':>10}{'ser ms':>10}{'other ms':>10}{'total ms':>10}"
+             f"{'queries':>9}{'>budget':>9}"]
+    for endpoint, row in summary.items():
+        timing = row.get("server_timing")
+        if timing is None:
+            continue
+        lines.append(
+            f"{endpoint:<32}{timing['db']:>10.2f}{timing['queue']:>10.2f}{timing['validation']:>10.2f}"
+            f"{timing['serialization']:>10.2f}{timing['other']:>10.2f}{timing['total']:>10.2f}{timing['queries']:>9.1f}{timing['over_budget']:>9}"
+        )
+    return "\n".join(lines) if len(lines) > 1 else ""
+
+
+_local = threading.local()
+
+def _session():
+    # one keep-alive connection pool per worker thread
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+        _local.session.headers.update(headers)
+    return _local.session
+
+
+def execute(job, stats, scheduled_at):
+    """Run one job and record its latency measured from `scheduled_at`."""
+    status_code = timing = None
+    try:
+        if job.method == POST:
+            response = _session().post(job.url, data=json.dumps(job.payload))
+        else:
+            response = _session().get(job.url)
+        status_code = response.status_code
+        if "Server-Timing" in response.headers:
+            timing = parse_server_timing(response.headers["Server-Timing"])
+    except requests.exceptions.RequestException:
+        pass
+    stats.record(job.endpoint, scheduled_at, time.perf_counter(), status_code, timing)
+
+
+def run_load(jobs, concurrency=CONCURRENCY, rate=None, stats=None):
+    """
+    Drive `jobs` against the server from `concurrency` worker threads.
+
+    Without `rate` this is closed-loop: every worker sends its next request as
+    soon as the previous one returns, so `concurrency` is the number of
+    requests in flight. With `rate` (requests/second) it is open-loop: jobs are
+    released on a fixed schedule whether or not the server keeps up, and
+    latency is measured from the scheduled send time, so queueing behind a
+    saturated server shows up in the percentiles instead of being hidden.
+    """
+    stats = stats or LoadStats()
+    pending = queue.Queue()
+
+    def worker():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            job, scheduled_at = item
+            execute(job, stats, scheduled_at or time.perf_counter())
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+
+    start = time.perf_counter()
+    for i, job in enumerate(jobs):
+        if rate:
+            scheduled_at = start + i / rate
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pending.put((job, scheduled_at))
+        else:
+            pending.put((job, None))
+
+    for _ in workers:
+        pending.put(None)
+    for thread in workers:
+        thread.join()
+    return stats
+
+
+def post_jobs(url, num_requests):
+    """First-time inserts followed by the same contacts under a second matm_owner."""
+    used_payload = [update_payload(payload_dict) for _ in range(num_requests)]
+    first_pass = [Job("POST /contacts (new)", POST, url, payload) for payload in used_payload]
+    second_pass = [Job("POST /contacts (repeat owner)", POST, url, dict(payload, matm_owner="TD01"))
+                   for payload in used_payload]
+    return first_pass, second_pass
+
+
+def duplicate_jobs(url, num_requests, copies):
+    """`copies` identical POSTs of each of `num_requests` new contacts, adjacent so they are in flight together."""
+    return [Job("POST /contacts (duplicate)", POST, url, payload)
+            for payload in (update_payload(payload_dict) for _ in range(num_requests))
+            for _ in range(copies)]
+
+
+def contact_key(contact):
+    return (contact["matm_owner"], contact["username"], contact["email"], int(contact["phonenumber"]))
+
+
+def check_page(session, url, params):
+    """One GET /contacts page; a 503 from admission control is retried after its Retry-After."""
+    for attempt in range(1, CHECK_ATTEMPTS + 1):
+        response = session.get(url, params=params)
+        if response.status_code != 503 or attempt == CHECK_ATTEMPTS:
+            break
+        time.sleep(int(response.headers.get("Retry-After", 1)))
+    # a page that never came back would undercount the duplicates
+    response.raise_for_status()
+    return response.json()
+
+
+def duplicate_contacts(url, payloads):
+    """
+    Stored contacts beyond the first for each (matm_owner, username, email,
+    phonenumber) the run POSTed, read back through every page of GET /contacts.
+    The payloads are random, so any such extra contact is a duplicate write.
+    """
+    keys = {contact_key(payload) for payload in payloads}
+    counts = defaultdict(int)
+    session = _session()
+    after = None
+    while True:
+        params = {"limit": CHECK_PAGE_SIZE}
+        if after is not None:
+            params["after"] = after
+        body = check_page(session, url, params)
+        for contact in body["contacts"]:
+            key = contact_key(contact)
+            if key in keys:
+                counts[key] += 1
+        after = body["next_cursor"]
+        if after is None:
+            return sum(count - 1 for count in counts.values())
+
+
+def run_concurrent_test(call_method, url, num_requests, concurrency, rate=None, duplicates=0):
+    """Endpoint summary and, for POSTs, the number of duplicate contacts stored."""
+    stats = LoadStats()
+    if call_method == GET:
+        run_load([Job("GET /contacts", GET, url, None)] * num_requests, concurrency, rate, stats)
+        return summarize(stats), None
+    passes = list(post_jobs(url, num_requests))
+    if duplicates:
+        passes.append(duplicate_jobs(url, num_requests, duplicates))
+    for jobs in passes:
+        run_load(jobs, concurrency, rate, stats)
+    return summarize(stats), duplicate_contacts(url, [job.payload for jobs in passes for job in jobs])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the contacts API.")
+    parser.add_argument("--target", default="fastapi",
+                        help="fastapi, flask or a full /contacts URL")
+    parser.add_argument("--method", choices=[GET, POST], default=POST)
+    parser.add_argument("--mode", choices=["sequential", "concurrent"], default="concurrent")
+    parser.add_argument("--requests", type=int, default=NUM_REQUESTS,
+                        help="requests per pass")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                        help="worker threads, i.e. max requests in flight")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="open-loop target rate in requests/second")
+    parser.add_argument("--duplicates", type=int, default=0,
+                        help="extra POST pass sending this many identical copies of each new contact at once")
+    args = parser.parse_args()
+
+    url = TARGETS.get(args.target, args.target)
+
+    if args.mode == "sequential":
+        result = run_test(args.method, url)
+        print(sum(time_taken))
+        with open(RESULT_FILE, "a") as f:
+            f.write(str(result) + str(sum(time_taken)) +"\n")
+        return
+
+    summary, duplicates = run_concurrent_test(args.method, url, args.requests, args.concurrency, args.rate,
+                                              args.duplicates)
+    print(format_table(summary))
+    breakdown = format_breakdown(summary)
+    if breakdown:
+        print()
+        print(breakdown)
+    if duplicates is not None:
+        print()
+        print(f"duplicate contacts stored: {duplicates}")
+    result = {"Method": args.method, "Url": url, "concurrency": args.concurrency,
+              "rate": args.rate, "endpoints": summary, "duplicate_contacts": duplicates}
+    with open(RESULT_FILE, "a") as f:
+        f.write(json.dumps(result) + "\n")
 
-f = open("test_result_2.txt", "a")
-f.write(str(result) + str(sum(time_taken)) +"\n")
-f.close()
 
-# total_time = [sum(Seconds) for Seconds in time_taken]
-# print(total_time)
\ No newline at end of file
+if __name__ == "__main__":
+    main()